@@ -0,0 +1,22 @@
+from django.contrib import admin
+from .models import BackgroundJob
+
+
+@admin.register(BackgroundJob)
+class BackgroundJobAdmin(admin.ModelAdmin):
+    list_display = ['id', 'kind', 'status', 'progress_display', 'created_at', 'started_at', 'finished_at']
+    list_filter = ['kind', 'status']
+    readonly_fields = [
+        'kind', 'status', 'params', 'processed', 'total', 'result', 'error',
+        'created_at', 'started_at', 'finished_at', 'updated_at',
+    ]
+    exclude = ['upload']
+
+    def progress_display(self, obj):
+        if obj.total is None:
+            return f"{obj.processed}"
+        return f"{obj.processed}/{obj.total}"
+    progress_display.short_description = 'Postęp'
+
+    def has_add_permission(self, request):
+        return False
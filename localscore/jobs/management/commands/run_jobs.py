@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from jobs.runner import run_next
+
+
+class Command(BaseCommand):
+    help = 'Worker wykonujący zadania w tle (obliczenia SCORE2, import danych)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--poll-interval', type=float, default=2.0,
+                            help='Ile sekund czekać, gdy kolejka jest pusta')
+        parser.add_argument('--once', action='store_true',
+                            help='Wykonaj zadania z kolejki i zakończ')
+
+    def handle(self, *args, **options):
+        self.stdout.write('Worker uruchomiony, oczekiwanie na zadania...')
+        while True:
+            close_old_connections()
+            if run_next():
+                continue
+            if options['once']:
+                return
+            time.sleep(options['poll_interval'])
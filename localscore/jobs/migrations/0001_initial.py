@@ -0,0 +1,40 @@
+# Generated by Django 5.2.4 on 2026-10-17 15:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BackgroundJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('score2_calculate_all', 'Obliczanie SCORE2 dla wszystkich pacjentów'), ('patients_import', 'Import danych pacjentów (Excel, CSV/TSV)')], max_length=50)),
+                ('status', models.CharField(choices=[('queued', 'W kolejce'), ('running', 'W trakcie'), ('succeeded', 'Zakończone'), ('failed', 'Błąd')], default='queued', max_length=20)),
+                ('params', models.JSONField(blank=True, default=dict)),
+                ('upload', models.FileField(blank=True, null=True, upload_to='imports/')),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('processed', models.PositiveIntegerField(default=0)),
+                ('total', models.PositiveIntegerField(blank=True, null=True)),
+                ('result', models.JSONField(blank=True, null=True)),
+                ('error', models.TextField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Zadanie w tle',
+                'verbose_name_plural': 'Zadania w tle',
+                'db_table': 'background_jobs',
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(fields=['status', 'created_at'], name='background__status_2e8f1f_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-17 17:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jobs', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='backgroundjob',
+            name='kind',
+            field=models.CharField(choices=[('score2_calculate_all', 'Obliczanie SCORE2 dla wszystkich pacjentów'), ('patients_import', 'Import danych pacjentów (Excel, CSV/TSV)'), ('score2_reference_refresh', 'Przeliczenie median referencyjnych')], max_length=50),
+        ),
+    ]
@@ -0,0 +1,177 @@
+from datetime import timedelta
+
+from django.db import models, transaction
+from django.utils import timezone
+
+
+class BackgroundJob(models.Model):
+    KIND_CHOICES = [
+        ('score2_calculate_all', 'Obliczanie SCORE2 dla wszystkich pacjentów'),
+        ('patients_import', 'Import danych pacjentów (Excel, CSV/TSV)'),
+        ('score2_reference_refresh', 'Przeliczenie median referencyjnych'),
+    ]
+
+    STATUS_CHOICES = [
+        ('queued', 'W kolejce'),
+        ('running', 'W trakcie'),
+        ('succeeded', 'Zakończone'),
+        ('failed', 'Błąd'),
+    ]
+
+    # A running job that has not been touched for this long lost its worker
+    # (killed or restarted); it is queued again, or failed after MAX_ATTEMPTS claims
+    STALE_AFTER = timedelta(minutes=15)
+    MAX_ATTEMPTS = 3
+    # The worker touches its running job this often, however long one step takes
+    HEARTBEAT_EVERY = timedelta(minutes=1)
+
+    kind = models.CharField(max_length=50, choices=KIND_CHOICES)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued')
+    params = models.JSONField(default=dict, blank=True)
+    # Uploaded file for import jobs, saved under MEDIA_ROOT (shared with the
+    # worker) so neither process holds the whole file in memory
+    upload = models.FileField(upload_to='imports/', blank=True, null=True)
+
+    attempts = models.PositiveIntegerField(default=0)
+    processed = models.PositiveIntegerField(default=0)
+    total = models.PositiveIntegerField(blank=True, null=True)
+    result = models.JSONField(blank=True, null=True)
+    error = models.TextField(blank=True, null=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'background_jobs'
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['status', 'created_at']),
+        ]
+        verbose_name = 'Zadanie w tle'
+        verbose_name_plural = 'Zadania w tle'
+
+    def __str__(self):
+        return f"{self.get_kind_display()} #{self.pk} ({self.get_status_display()})"
+
+    @classmethod
+    def enqueue(cls, kind: str, upload=None, **params) -> 'BackgroundJob':
+        job = cls(kind=kind, params=params)
+        if upload is not None:
+            # Written to storage chunk by chunk
+            job.upload.save(upload.name, upload, save=False)
+        job.save()
+        return job
+
+    @classmethod
+    def claim_next(cls):
+        """Mark the oldest queued job as running and return it, or None.
+
+        SKIP LOCKED lets several workers poll the same table without
+        picking up the same job.
+        """
+        cls.recover_stale()
+        with transaction.atomic():
+            job = (
+                cls.objects.select_for_update(skip_locked=True)
+                .filter(status='queued')
+                .order_by('created_at')
+                .first()
+            )
+            if job is None:
+                return None
+            job.status = 'running'
+            job.started_at = timezone.now()
+            job.attempts += 1
+            job.save(update_fields=['status', 'started_at', 'attempts', 'updated_at'])
+        return job
+
+    @classmethod
+    def recover_stale(cls) -> int:
+        """Requeue running jobs whose worker stopped touching them (see runner.heartbeat); returns how many were recovered"""
+        now = timezone.now()
+        stale = cls.objects.filter(status='running', updated_at__lt=now - cls.STALE_AFTER)
+        failed = list(stale.filter(attempts__gte=cls.MAX_ATTEMPTS))
+        for job in failed:
+            job.finish(error='Worker przestał odpowiadać')
+        requeued = stale.update(status='queued', started_at=None, updated_at=now)
+        return len(failed) + requeued
+
+    def heartbeat(self) -> bool:
+        """Show the job is still being worked on; False once it is no longer running"""
+        return bool(BackgroundJob.objects.filter(pk=self.pk, status='running').update(updated_at=timezone.now()))
+
+    def set_progress(self, processed: int, total: int = None, result=None):
+        """Store progress (and optionally partial results) without touching other columns"""
+        self.processed = processed
+        if total is not None:
+            self.total = total
+        if result is not None:
+            self.result = result
+        BackgroundJob.objects.filter(pk=self.pk).update(
+            processed=self.processed, total=self.total, result=self.result, updated_at=timezone.now()
+        )
+
+    def finish(self, result=None, error: str = None):
+        self.status = 'failed' if error else 'succeeded'
+        self.result = result
+        self.error = error
+        self.finished_at = timezone.now()
+        if self.upload:
+            self.upload.delete(save=False)
+        self.save(update_fields=['status', 'result', 'error', 'finished_at', 'upload', 'updated_at'])
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status in ('succeeded', 'failed')
+
+    @property
+    def elapsed_seconds(self):
+        if not self.started_at:
+            return None
+        end = self.finished_at or timezone.now()
+        return max((end - self.started_at).total_seconds(), 0.0)
+
+    @property
+    def percent(self):
+        if self.status == 'succeeded':
+            return 100.0
+        if not self.total:
+            return None
+        return round(min(self.processed / self.total, 1.0) * 100, 1)
+
+    @property
+    def throughput(self):
+        """Processed items per second"""
+        elapsed = self.elapsed_seconds
+        if not elapsed or not self.processed:
+            return None
+        return round(self.processed / elapsed, 1)
+
+    @property
+    def eta_seconds(self):
+        if self.is_finished:
+            return 0
+        rate = self.throughput
+        if not rate or self.total is None:
+            return None
+        return round(max(self.total - self.processed, 0) / rate)
+
+    def as_dict(self) -> dict:
+        return {
+            'id': self.pk,
+            'kind': self.kind,
+            'status': self.status,
+            'status_display': self.get_status_display(),
+            'processed': self.processed,
+            'total': self.total,
+            'percent': self.percent,
+            'throughput': self.throughput,
+            'eta_seconds': self.eta_seconds,
+            'result': self.result,
+            'error': self.error,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+        }
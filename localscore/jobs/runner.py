@@ -0,0 +1,72 @@
+import logging
+import threading
+import traceback
+from contextlib import contextmanager
+
+from django.db import connection
+from django.utils.module_loading import import_string
+
+from .models import BackgroundJob
+
+logger = logging.getLogger('jobs')
+
+# kind -> callable(job) returning a JSON-serializable result
+HANDLERS = {
+    'score2_calculate_all': 'score2.tasks.calculate_all',
+    'patients_import': 'patients.tasks.import_file',
+    'score2_reference_refresh': 'score2.tasks.refresh_reference',
+}
+
+
+@contextmanager
+def heartbeat(job: BackgroundJob):
+    """Touch the job from a timer thread while the block runs.
+
+    A single COPY or merge statement of a large import can outlast
+    STALE_AFTER without any progress report; without the heartbeat another
+    worker would requeue the job and import the file a second time.
+    """
+    stop = threading.Event()
+
+    def beat():
+        try:
+            while not stop.wait(BackgroundJob.HEARTBEAT_EVERY.total_seconds()):
+                job.heartbeat()
+        except Exception as e:
+            logger.error(f"JOB_HEARTBEAT;{job.pk};{job.kind};{str(e)}")
+        finally:
+            # The thread has its own connection
+            connection.close()
+
+    thread = threading.Thread(target=beat, name=f'job-{job.pk}-heartbeat', daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def run_job(job: BackgroundJob):
+    """Run a claimed job and record its outcome"""
+    logger.info(f"JOB_START;{job.pk};{job.kind};")
+    try:
+        handler = import_string(HANDLERS[job.kind])
+        with heartbeat(job):
+            result = handler(job)
+    except Exception as e:
+        logger.error(f"JOB_FAILED;{job.pk};{job.kind};{str(e)}\n{traceback.format_exc()}")
+        job.finish(error=str(e))
+    else:
+        logger.info(f"JOB_END;{job.pk};{job.kind};{job.processed}/{job.total}")
+        job.finish(result=result)
+    return job
+
+
+def run_next() -> bool:
+    """Run the oldest queued job; False if there was nothing to do"""
+    job = BackgroundJob.claim_next()
+    if job is None:
+        return False
+    run_job(job)
+    return True
@@ -0,0 +1,92 @@
+from datetime import timedelta
+import time
+from unittest import mock
+
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from .models import BackgroundJob
+from .runner import run_job
+
+
+class BackgroundJobProgressTests(SimpleTestCase):
+
+    def test_throughput_and_eta(self):
+        started = timezone.now() - timedelta(seconds=10)
+        job = BackgroundJob(status='running', processed=500, total=2000, started_at=started)
+        self.assertEqual(job.percent, 25.0)
+        self.assertAlmostEqual(job.throughput, 50.0, delta=1)
+        self.assertAlmostEqual(job.eta_seconds, 30, delta=1)
+
+    def test_unknown_total_and_finished(self):
+        job = BackgroundJob(status='queued')
+        self.assertIsNone(job.percent)
+        self.assertIsNone(job.throughput)
+        self.assertIsNone(job.eta_seconds)
+
+        job = BackgroundJob(status='succeeded', processed=10, total=10,
+                            started_at=timezone.now() - timedelta(seconds=5), finished_at=timezone.now())
+        self.assertEqual(job.percent, 100.0)
+        self.assertEqual(job.eta_seconds, 0)
+        self.assertEqual(job.as_dict()['status'], 'succeeded')
+
+
+class StaleJobRecoveryTests(TestCase):
+
+    def _stale(self, **fields):
+        job = BackgroundJob.objects.create(kind='score2_calculate_all', status='running', **fields)
+        BackgroundJob.objects.filter(pk=job.pk).update(updated_at=timezone.now() - BackgroundJob.STALE_AFTER * 2)
+        return job
+
+    def test_stale_running_job_is_claimed_again(self):
+        job = self._stale(attempts=1)
+        live = BackgroundJob.objects.create(kind='score2_calculate_all', status='running', attempts=1)
+        claimed = BackgroundJob.claim_next()
+        self.assertEqual(claimed.pk, job.pk)
+        self.assertEqual(claimed.attempts, 2)
+        live.refresh_from_db()
+        self.assertEqual(live.status, 'running')
+
+    def test_job_failing_repeatedly_is_given_up(self):
+        job = self._stale(attempts=BackgroundJob.MAX_ATTEMPTS)
+        self.assertIsNone(BackgroundJob.claim_next())
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'failed')
+        self.assertIsNotNone(job.finished_at)
+
+    def test_calculate_all_reuses_only_a_matching_job(self):
+        url = reverse('score2:calculate_all')
+        first = self.client.post(url).json()['job_id']
+        self.assertEqual(self.client.post(url).json()['job_id'], first)
+        forced = self.client.post(url, {'force': '1'}).json()['job_id']
+        self.assertNotEqual(forced, first)
+        self.assertTrue(BackgroundJob.objects.get(pk=forced).params['force'])
+
+
+class HeartbeatTests(TransactionTestCase):
+    """A step that outlasts STALE_AFTER must not get the job requeued under a live worker"""
+
+    def test_long_step_keeps_the_job_claimed(self):
+        BackgroundJob.objects.create(kind='score2_calculate_all')
+        job = BackgroundJob.claim_next()
+        recovered = []
+
+        def long_step(job):
+            # One statement running for longer than STALE_AFTER, without progress
+            BackgroundJob.objects.filter(pk=job.pk).update(updated_at=timezone.now() - BackgroundJob.STALE_AFTER * 2)
+            deadline = time.monotonic() + 5
+            while time.monotonic() < deadline:
+                job.refresh_from_db(fields=['updated_at'])
+                if job.updated_at > timezone.now() - BackgroundJob.STALE_AFTER:
+                    break
+                time.sleep(0.02)
+            recovered.append(BackgroundJob.recover_stale())
+            return {}
+
+        with mock.patch.object(BackgroundJob, 'HEARTBEAT_EVERY', timedelta(seconds=0.05)), \
+                mock.patch('jobs.runner.import_string', return_value=long_step):
+            run_job(job)
+        self.assertEqual(recovered, [0])
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ('succeeded', 1))
@@ -0,0 +1,13 @@
+from django.http import JsonResponse
+from django.shortcuts import get_object_or_404
+from django.views import View
+
+from .models import BackgroundJob
+
+
+class JobStatusView(View):
+    """Polling endpoint for background job progress"""
+
+    def get(self, request, pk):
+        job = get_object_or_404(BackgroundJob, pk=pk)
+        return JsonResponse({'success': True, 'job': job.as_dict()})
@@ -39,9 +39,11 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
 
     'patients',
     'score2',
+    'jobs',
 ]
 
 MIDDLEWARE = [
@@ -185,6 +187,11 @@ LOGGING = {
             'level': 'DEBUG',
             'propagate': False,
         },
+        'jobs': {
+            'handlers': ['file', 'console'],
+            'level': 'DEBUG',
+            'propagate': False,
+        },
     },
 }
 
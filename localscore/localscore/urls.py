@@ -11,4 +11,5 @@ urlpatterns = [
     # App URLs
     path('patients/', include('patients.urls')),
     path('score2/', include('score2.urls')),
+    path('jobs/', include('jobs.urls')),
 ]
\ No newline at end of file
@@ -6,9 +6,10 @@ from .models import Patient, Visit, PatientDiagnosis, VisitDiagnosis, Diagnosis
 @admin.register(Patient)
 class PatientAdmin(admin.ModelAdmin):
     list_display = ['pesel', 'full_name', 'age_display', 'gender', 'has_visits', 'has_diabetes_display', 'created_at']
-    list_filter = ['gender', 'created_at', 'updated_at']
+    list_filter = ['gender', 'has_diabetes', 'effective_smoking_status', 'current_risk_level', 'created_at', 'updated_at']
     search_fields = ['pesel', 'full_name', 'phone_mobile', 'phone_landline']
-    readonly_fields = ['created_at', 'updated_at']
+    readonly_fields = ['created_at', 'updated_at', 'has_diabetes', 'diabetes_age_at_diagnosis',
+                       'effective_smoking_status', 'smoking_info_source']
     
     fieldsets = (
         ('Dane podstawowe', {
@@ -17,6 +18,9 @@ class PatientAdmin(admin.ModelAdmin):
         ('Kontakt', {
             'fields': ('address', 'phone_mobile', 'phone_landline')
         }),
+        ('Dane kliniczne (z rozpoznań)', {
+            'fields': ('has_diabetes', 'diabetes_age_at_diagnosis', 'effective_smoking_status', 'smoking_info_source')
+        }),
         ('Metadata', {
             'fields': ('created_at', 'updated_at'),
             'classes': ('collapse',)
@@ -28,7 +32,7 @@ class PatientAdmin(admin.ModelAdmin):
     age_display.short_description = 'Wiek'
     
     def has_visits(self, obj):
-        count = obj.visits.count()
+        count = obj.visits_count
         if count > 0:
             return format_html(
                 '<span style="color: green;">✓ {} wizyt</span>',
@@ -36,12 +40,14 @@ class PatientAdmin(admin.ModelAdmin):
             )
         return format_html('<span style="color: red;">✗ Brak wizyt</span>')
     has_visits.short_description = 'Wizyty'
+    has_visits.admin_order_field = 'visits_count'
     
     def has_diabetes_display(self, obj):
-        if obj.has_diabetes():
+        if obj.has_diabetes:
             return format_html('<span style="color: red;">✓ Tak</span>')
         return format_html('<span style="color: green;">✗ Nie</span>')
     has_diabetes_display.short_description = 'Cukrzyca'
+    has_diabetes_display.admin_order_field = 'has_diabetes'
 
 
 class VisitDiagnosisInline(admin.TabularInline):
@@ -56,8 +62,7 @@ class VisitAdmin(admin.ModelAdmin):
     search_fields = ['patient__pesel', 'patient__full_name']
     readonly_fields = ['quarter', 'created_at']
     date_hierarchy = 'visit_date'
-    inlines = [VisitDiagnosisInline]
-    
+    inlines = [VisitDiagnosisInline]    
     fieldsets = (
         ('Pacjent i data', {
             'fields': ('patient', 'visit_date', 'quarter')
@@ -115,8 +120,7 @@ class PatientDiagnosisAdmin(admin.ModelAdmin):
     list_filter = ['diagnosis_code', 'diagnosed_at', 'created_at']
     search_fields = ['patient__pesel', 'patient__full_name', 'diagnosis_code']
     readonly_fields = ['created_at']
-    date_hierarchy = 'diagnosed_at'
-    
+    date_hierarchy = 'diagnosed_at'    
     def patient_pesel(self, obj):
         return obj.patient.pesel
     patient_pesel.short_description = 'PESEL'
@@ -131,8 +135,7 @@ class VisitDiagnosisAdmin(admin.ModelAdmin):
     list_display = ['patient_pesel', 'patient_name', 'visit_date', 'diagnosis_code']
     list_filter = ['diagnosis_code', 'visit__visit_date', 'created_at']
     search_fields = ['visit__patient__pesel', 'visit__patient__full_name', 'diagnosis_code']
-    readonly_fields = ['created_at']
-    
+    readonly_fields = ['created_at']    
     def patient_pesel(self, obj):
         return obj.visit.patient.pesel
     patient_pesel.short_description = 'PESEL'
@@ -148,8 +151,10 @@ class VisitDiagnosisAdmin(admin.ModelAdmin):
 
 @admin.register(Diagnosis)
 class DiagnosisAdmin(admin.ModelAdmin):
-    list_display = ['code', 'description', 'usage_count']
+    list_display = ['code', 'description', 'diabetes_type', 'smoking_marker', 'usage_count']
+    list_filter = ['is_diabetes', 'diabetes_type', 'smoking_marker']
     search_fields = ['code', 'description']
+    readonly_fields = ['is_diabetes', 'diabetes_type', 'smoking_marker']
     
     def usage_count(self, obj):
         chronic_count = PatientDiagnosis.objects.filter(diagnosis_code=obj.code).count()
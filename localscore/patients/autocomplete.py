@@ -0,0 +1,61 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+
+from .models import Patient, data_version, fold_name
+
+# Entries per process; the registration desk retypes the same few prefixes
+CACHE_SIZE = 512
+# Entries are keyed by the data version, the TTL only bounds memory held by old versions
+CACHE_TTL = 60
+
+RESULT_LIMIT = 10
+MIN_QUERY_LENGTH = 2
+
+_lock = threading.Lock()
+_cache = OrderedDict()
+
+
+def search_patients(query: str) -> list:
+    """Autocomplete hits for `query` from one indexed query, through a per-process LRU cache"""
+    query = ' '.join(query.split())
+    if len(query) < MIN_QUERY_LENGTH:
+        return []
+    key = (data_version(), date.today(), fold_name(query))
+    now = time.monotonic()
+    with _lock:
+        entry = _cache.get(key)
+        if entry is not None and now - entry[0] < CACHE_TTL:
+            _cache.move_to_end(key)
+            return entry[1]
+
+    results = _query(query)
+    with _lock:
+        _cache[key] = (now, results)
+        _cache.move_to_end(key)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return results
+
+
+def clear_cache():
+    with _lock:
+        _cache.clear()
+
+
+def _query(query: str) -> list:
+    patients = Patient.objects.search(query).only('full_name', 'pesel', 'date_of_birth', 'has_diabetes')
+    if query.isdigit():
+        patients = patients.order_by('pesel')
+    else:
+        patients = patients.with_search_rank(query).order_by('-search_rank', 'full_name')
+    return [
+        {
+            'id': patient.id,
+            'text': f"{patient.full_name or patient.pesel} ({patient.pesel})",
+            'age': patient.age,
+            'has_diabetes': patient.has_diabetes,
+        }
+        for patient in patients[:RESULT_LIMIT]
+    ]
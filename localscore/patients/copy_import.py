@@ -0,0 +1,343 @@
+"""CSV/TSV import through PostgreSQL COPY.
+
+The upload is streamed with COPY FROM STDIN into an unlogged staging table
+of text columns, cleaned into a typed staging table in one statement and
+merged into the patient tables with set-based SQL. Both steps follow the
+Excel import. A ten-digit PESEL gets its leading zero back, rows whose PESEL
+fails the check digit or date test are rejected and reported, and a missing
+date of birth is read from the PESEL. Patient data and the visit come from
+each patient's first row, existing patients only get non-empty
+address/phones, existing visits are left untouched, and chronic diagnoses
+keep the last non-empty value in file order.
+"""
+import csv
+import logging
+import uuid
+
+from django.db import connection, transaction
+from django.db.models.expressions import RawSQL
+
+from .importing import (
+    COLS, DATE_COLUMNS, PESEL_CENTURIES, PESEL_WEIGHTS, REJECT_NO_PESEL, REJECT_PESEL_CHECKSUM, REJECT_PESEL_DATE,
+    REJECT_PESEL_FORMAT, RejectedRows, build_rename_map,
+)
+from .models import Patient, diagnosis_flags_sql, refresh_clinical_flags, refresh_summary
+
+logger = logging.getLogger('patients')
+
+CSV_EXTENSIONS = ('.csv', '.tsv', '.txt')
+
+SAMPLE_SIZE = 64 * 1024
+
+
+def _valid_date(iso: str) -> str:
+    """SQL date from ISO text, NULL when the text is not a valid date"""
+    return f"CASE WHEN pg_input_is_valid({iso}, 'date') THEN ({iso})::date END"
+
+
+# Text -> type conversions used when building the typed staging table.
+# Dates (YYYY-MM-DD or DD.MM.YYYY) are rewritten to ISO text and only cast when
+# pg_input_is_valid() (PostgreSQL 16) accepts them: to_date() raises on
+# impossible values such as 2023-02-30, which would abort the whole load.
+_ISO_DATE_SQL = """coalesce(
+    substring({c} from '^\\d{{4}}-\\d{{1,2}}-\\d{{1,2}}'),
+    regexp_replace(substring({c} from '^\\d{{1,2}}[./-]\\d{{1,2}}[./-]\\d{{4}}'),
+                   '^(\\d+)[./-](\\d+)[./-](\\d+)$', '\\3-\\2-\\1')
+)"""
+_DATE_SQL = _valid_date(_ISO_DATE_SQL)
+# A ten-digit PESEL lost its leading zero to a numeric cell, as in importing.parse_pesels()
+_PESEL_SQL = "CASE WHEN length({c}) = 10 THEN lpad({c}, 11, '0') ELSE {c} END"
+# Values that would not fit the target column are dropped rather than failing the load
+_NUMBER_SQL = """CASE WHEN replace({c}, ',', '.') ~ '^-?\\d+(\\.\\d+)?$'
+    AND abs(replace({c}, ',', '.')::numeric) < {limit} THEN round(replace({c}, ',', '.')::numeric, {scale}) END"""
+
+NUMERIC_COLUMNS = {
+    # column: (upper bound, scale)
+    'systolic_pressure': (100000, 0),
+    'hba1c': (1000, 2),
+    'egfr': (10000, 2),
+    'cholesterol_total': (10000, 2),
+    'cholesterol_hdl': (10000, 2),
+}
+
+
+def sniff_format(sample: bytes, filename: str):
+    """(delimiter, PostgreSQL encoding, header fields) of a CSV/TSV upload"""
+    try:
+        text = sample.decode('utf-8')
+        encoding = 'UTF8'
+    except UnicodeDecodeError as e:
+        if e.start >= len(sample) - 3:
+            # Sample cut in the middle of a multi-byte character
+            text = sample[:e.start].decode('utf-8')
+            encoding = 'UTF8'
+        else:
+            text = sample.decode('cp1250')
+            encoding = 'WIN1250'
+    text = text.lstrip('﻿')
+    header_line = text.splitlines()[0] if text else ''
+    if filename.lower().endswith('.tsv'):
+        delimiter = '\t'
+    else:
+        delimiter = max(('\t', ';', ','), key=header_line.count)
+    header = next(csv.reader([header_line], delimiter=delimiter), [])
+    return delimiter, encoding, header
+
+
+def import_csv(fileobj, filename: str = '', progress=None) -> dict:
+    """Import a CSV/TSV export; returns the same counts and 'rejected' report as the Excel import"""
+    sample = fileobj.read(SAMPLE_SIZE)
+    fileobj.seek(0)
+    delimiter, encoding, header = sniff_format(sample, filename)
+
+    rename_map = build_rename_map(header)
+    missing = [v for v in COLS.values() if v not in rename_map.values()]
+    if missing:
+        raise ValueError(f"Brakuje kolumn: {missing}")
+    source = {}
+    for i, raw in enumerate(header):
+        target = rename_map.get(raw)
+        if target and target not in source:
+            source[target] = f'col_{i}'
+
+    suffix = uuid.uuid4().hex[:12]
+    raw_table = f'import_staging_raw_{suffix}'
+    clean_table = f'import_staging_{suffix}'
+    steps = 7
+
+    def step(done):
+        if progress is not None:
+            progress(done, steps)
+
+    with connection.cursor() as cursor:
+        try:
+            columns = ', '.join(f'col_{i} text' for i in range(len(header)))
+            cursor.execute(f'CREATE UNLOGGED TABLE {raw_table} (row_no bigserial, {columns})')
+            cursor.copy_expert(
+                f"COPY {raw_table} ({', '.join(f'col_{i}' for i in range(len(header)))}) FROM STDIN "
+                f"WITH (FORMAT csv, HEADER true, DELIMITER E'{_escape(delimiter)}', ENCODING '{encoding}')",
+                fileobj,
+            )
+            step(1)
+            cursor.execute(_clean_sql(raw_table, clean_table, source))
+            rejected = _reject(cursor, clean_table)
+            cursor.execute(f'CREATE INDEX ON {clean_table} (pesel, row_no)')
+            cursor.execute(f'ANALYZE {clean_table}')
+            step(2)
+            with transaction.atomic():
+                results = _merge(cursor, clean_table, step)
+        finally:
+            cursor.execute(f'DROP TABLE IF EXISTS {raw_table}')
+            cursor.execute(f'DROP TABLE IF EXISTS {clean_table}')
+
+    results['rows_rejected'] = rejected.total
+    results['rejected'] = rejected.as_dict()
+
+    logger.info(f"CSV_IMPORT;;;{filename};{results};")
+    return results
+
+
+def _escape(delimiter: str) -> str:
+    return '\\t' if delimiter == '\t' else delimiter.replace("'", "''")
+
+
+def _literal(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def _pesel_dob_sql(pesel: str) -> str:
+    """SQL date of birth encoded in an 11-digit PESEL, NULL when it is not a valid date"""
+    month = f"substr({pesel}, 3, 2)::int"
+    centuries = ' '.join(f"WHEN {i} THEN {year}" for i, year in enumerate(PESEL_CENTURIES))
+    year = f"(CASE {month} / 20 {centuries} END + substr({pesel}, 1, 2)::int)"
+    return _valid_date(f"concat({year}, '-', {month} % 20, '-', substr({pesel}, 5, 2))")
+
+
+def _pesel_checksum_sql(pesel: str) -> str:
+    """SQL check of the PESEL control digit"""
+    weighted = ' + '.join(f"{w} * substr({pesel}, {i}, 1)::int" for i, w in enumerate(PESEL_WEIGHTS, start=1))
+    return f"(10 - ({weighted}) % 10) % 10 = substr({pesel}, 11, 1)::int"
+
+
+def _clean_sql(raw_table: str, clean_table: str, source: dict) -> str:
+    """Typed staging table; the PESEL is normalized and checked as in importing.clean_batch().
+
+    Rows with an invalid PESEL get a reject_reason; completely empty rows are dropped.
+    """
+    def text(field):
+        return f"NULLIF(btrim({source[field]}), '')"
+
+    selects = ['n.pesel']
+    for field in COLS.values():
+        if field == 'pesel':
+            continue
+        if field == 'dob':
+            selects.append(f"coalesce({_DATE_SQL.format(c=text(field))}, d.dob) AS dob")
+        elif field in DATE_COLUMNS:
+            selects.append(f"{_DATE_SQL.format(c=text(field))} AS {field}")
+        elif field in NUMERIC_COLUMNS:
+            limit, scale = NUMERIC_COLUMNS[field]
+            selects.append(f"{_NUMBER_SQL.format(c=text(field), limit=limit, scale=scale)} AS {field}")
+        else:
+            selects.append(f"{text(field)} AS {field}")
+    selects.append(f"""CASE
+            WHEN n.pesel = '' THEN {_literal(REJECT_NO_PESEL)}
+            WHEN n.pesel !~ '^\\d{{11}}$' THEN {_literal(REJECT_PESEL_FORMAT)}
+            WHEN NOT {_pesel_checksum_sql('n.pesel')} THEN {_literal(REJECT_PESEL_CHECKSUM)}
+            WHEN d.dob IS NULL THEN {_literal(REJECT_PESEL_DATE)}
+        END AS reject_reason""")
+    raw_pesel = f"regexp_replace(btrim(coalesce({source['pesel']}, '')), '\\.0$', '')"
+    return f"""
+        CREATE UNLOGGED TABLE {clean_table} AS
+        SELECT row_no, {', '.join(selects)}
+        FROM {raw_table}
+        CROSS JOIN LATERAL (SELECT {_PESEL_SQL.format(c=raw_pesel)} AS pesel) n
+        CROSS JOIN LATERAL (
+            SELECT CASE WHEN n.pesel ~ '^\\d{{11}}$' THEN {_pesel_dob_sql('n.pesel')} END AS dob
+        ) d
+        WHERE concat({', '.join(source.values())}) <> ''
+    """
+
+
+def _reject(cursor, clean_table: str) -> RejectedRows:
+    """Report the staging rows with an invalid PESEL and remove them before the merge"""
+    rejected = RejectedRows()
+    cursor.execute(f"""
+        SELECT reject_reason, count(*) FROM {clean_table}
+        WHERE reject_reason IS NOT NULL GROUP BY reject_reason
+    """)
+    rejected.counts.update(dict(cursor.fetchall()))
+    cursor.execute(f"""
+        SELECT row_no, pesel, reject_reason FROM {clean_table}
+        WHERE reject_reason IS NOT NULL ORDER BY row_no LIMIT %s
+    """, [rejected.limit])
+    # row_no counts data rows; the header is line 1 of the file
+    rejected.rows = [{'row': row_no + 1, 'pesel': pesel, 'reason': reason} for row_no, pesel, reason in cursor]
+    cursor.execute(f'DELETE FROM {clean_table} WHERE reject_reason IS NOT NULL')
+    return rejected
+
+
+def _merge(cursor, clean_table: str, step) -> dict:
+    firsts = f"(SELECT DISTINCT ON (pesel) * FROM {clean_table} ORDER BY pesel, row_no)"
+
+    # Patients: gender comes from the (validated) PESEL; over-long names and
+    # phone numbers are cut to the column size. The other NOT NULL columns
+    # (flags, counters) take their database defaults (Patient db_default).
+    cursor.execute(f"""
+        INSERT INTO patients (pesel, full_name, date_of_birth, gender, address, phone_mobile,
+                              phone_landline, created_at, updated_at)
+        SELECT f.pesel, left(f.full_name, 200), f.dob,
+               CASE WHEN substr(f.pesel, 10, 1)::int % 2 = 1 THEN 'M' ELSE 'F' END,
+               f.address, left(f.phone_mobile, 20), left(f.phone_landline, 20), now(), now()
+        FROM {firsts} f
+        ON CONFLICT (pesel) DO UPDATE SET
+            address = coalesce(EXCLUDED.address, patients.address),
+            phone_mobile = coalesce(EXCLUDED.phone_mobile, patients.phone_mobile),
+            phone_landline = coalesce(EXCLUDED.phone_landline, patients.phone_landline),
+            -- updated_at marks the patient for recompute, so only when the contact data changed
+            updated_at = CASE
+                WHEN (coalesce(EXCLUDED.address, patients.address),
+                      coalesce(EXCLUDED.phone_mobile, patients.phone_mobile),
+                      coalesce(EXCLUDED.phone_landline, patients.phone_landline))
+                     IS DISTINCT FROM (patients.address, patients.phone_mobile, patients.phone_landline)
+                THEN now() ELSE patients.updated_at END
+    """)
+    patients_processed = cursor.rowcount
+    step(3)
+
+    # Patients given a new visit are marked as changed, as the Visit signal would
+    cursor.execute(f"""
+        WITH inserted AS (
+            INSERT INTO visits (patient_id, visit_date, quarter, systolic_pressure, hba1c, egfr,
+                                cholesterol_total, cholesterol_hdl, created_at)
+            SELECT p.id, f.visit_date,
+                   extract(year FROM f.visit_date)::int || 'H' || extract(quarter FROM f.visit_date)::int,
+                   f.systolic_pressure, f.hba1c, f.egfr, f.cholesterol_total, f.cholesterol_hdl, now()
+            FROM {firsts} f
+            JOIN patients p ON p.pesel = f.pesel
+            WHERE f.visit_date IS NOT NULL
+            ON CONFLICT (patient_id, visit_date) DO NOTHING
+            RETURNING patient_id
+        ), marked AS (
+            UPDATE patients SET inputs_changed_at = now()
+            WHERE id IN (SELECT patient_id FROM inserted)
+        )
+        SELECT count(*) FROM inserted
+    """)
+    (visits_processed,) = cursor.fetchone()
+    step(4)
+
+    flags = diagnosis_flags_sql('code')
+    cursor.execute(f"""
+        INSERT INTO diagnoses (code, {', '.join(flags)})
+        SELECT code, {', '.join(flags.values())} FROM (SELECT DISTINCT code FROM (
+            SELECT btrim(unnest(string_to_array(visit_dx, ','))) AS code FROM {firsts} f
+            UNION ALL
+            SELECT chronic_dx FROM {clean_table}
+        ) codes
+        WHERE code <> '' AND length(code) <= 10) new_codes
+        ON CONFLICT (code) DO NOTHING
+    """)
+    cursor.execute(f"""
+        INSERT INTO visit_diagnoses (visit_id, diagnosis_code, created_at)
+        SELECT DISTINCT v.id, dx.code, now()
+        FROM {firsts} f
+        JOIN patients p ON p.pesel = f.pesel
+        JOIN visits v ON v.patient_id = p.id AND v.visit_date = f.visit_date
+        CROSS JOIN LATERAL (SELECT btrim(unnest(string_to_array(f.visit_dx, ','))) AS code) dx
+        WHERE dx.code <> '' AND length(dx.code) <= 10
+        ON CONFLICT (visit_id, diagnosis_code) DO NOTHING
+    """)
+    step(5)
+
+    # Chronic diagnoses: a new row starts from the first file row, then every
+    # later non-empty value (non-zero for the age) overwrites, as in the Excel path
+    cursor.execute(f"""
+        WITH rows AS (
+            SELECT s.row_no, p.id AS patient_id, s.chronic_dx AS code,
+                   s.chronic_dx_date, s.last_chronic_visit,
+                   CASE WHEN s.chronic_dx_date IS NOT NULL AND s.dob IS NOT NULL
+                        THEN date_part('year', age(s.chronic_dx_date, s.dob)) END AS age_at
+            FROM {clean_table} s
+            JOIN patients p ON p.pesel = s.pesel
+            WHERE s.chronic_dx IS NOT NULL AND length(s.chronic_dx) <= 10
+        ), folded AS (
+            SELECT patient_id, code,
+                   (array_agg(chronic_dx_date ORDER BY row_no)) [1] AS first_dx_date,
+                   (array_agg(last_chronic_visit ORDER BY row_no)) [1] AS first_last_visit,
+                   (array_agg(age_at ORDER BY row_no)) [1] AS first_age_at,
+                   (array_agg(chronic_dx_date ORDER BY row_no DESC) FILTER (WHERE chronic_dx_date IS NOT NULL)) [1] AS dx_date,
+                   (array_agg(last_chronic_visit ORDER BY row_no DESC) FILTER (WHERE last_chronic_visit IS NOT NULL)) [1] AS last_visit,
+                   (array_agg(age_at ORDER BY row_no DESC) FILTER (WHERE age_at <> 0)) [1] AS age_at
+            FROM rows
+            GROUP BY patient_id, code
+        )
+        INSERT INTO patient_diagnoses (patient_id, diagnosis_code, diagnosed_at,
+                                       last_visit_with_condition, age_at_diagnosis, created_at)
+        SELECT f.patient_id, f.code,
+               CASE WHEN d.id IS NULL THEN coalesce(f.dx_date, f.first_dx_date) ELSE coalesce(f.dx_date, d.diagnosed_at) END,
+               CASE WHEN d.id IS NULL THEN coalesce(f.last_visit, f.first_last_visit)
+                    ELSE coalesce(f.last_visit, d.last_visit_with_condition) END,
+               CASE WHEN d.id IS NULL THEN coalesce(f.age_at, f.first_age_at) ELSE coalesce(f.age_at, d.age_at_diagnosis) END,
+               now()
+        FROM folded f
+        LEFT JOIN patient_diagnoses d ON d.patient_id = f.patient_id AND d.diagnosis_code = f.code
+        ON CONFLICT (patient_id, diagnosis_code) DO UPDATE SET
+            diagnosed_at = EXCLUDED.diagnosed_at,
+            last_visit_with_condition = EXCLUDED.last_visit_with_condition,
+            age_at_diagnosis = EXCLUDED.age_at_diagnosis
+        RETURNING (xmax = 0)
+    """)
+    diagnoses_processed = sum(1 for (inserted,) in cursor.fetchall() if inserted)
+    step(6)
+
+    imported = Patient.objects.filter(pesel__in=RawSQL(f'SELECT pesel FROM {clean_table}', ()))
+    refresh_clinical_flags(imported)
+    refresh_summary(imported)
+    step(7)
+
+    return {
+        'patients_processed': patients_processed,
+        'visits_processed': visits_processed,
+        'diagnoses_processed': diagnoses_processed,
+    }
@@ -0,0 +1,177 @@
+from typing import Optional
+
+from score2.models import Score2Result
+from .models import Patient, Visit
+from .snapshot import PatientClinicalSnapshot
+
+
+def detail_context(patient: Patient) -> dict:
+    """Context of the patient detail page from one snapshot of the patient's rows.
+
+    Visits and diagnoses come from PatientClinicalSnapshot (two queries),
+    the SCORE2 results from one more; everything else is derived in memory,
+    so the page costs the same number of queries however many visits it shows.
+    """
+    snapshot = PatientClinicalSnapshot.load(patient)
+    results = list(Score2Result.objects.filter(patient=patient).order_by('created_at'))
+    visits_by_id = {visit.pk: visit for visit in snapshot.visits}
+    for result in results:
+        result.patient = patient
+        result.visit = visits_by_id[result.visit_id]
+
+    smoking_status, smoking_info = snapshot.get_smoking_status()
+    has_diabetes = snapshot.has_diabetes
+    diabetes_age = snapshot.get_diabetes_age_at_diagnosis()
+    latest_visit = snapshot.latest_visit
+
+    possible_scores, missing_data, data_sources = score_requirements(
+        patient, latest_visit, has_diabetes, diabetes_age, smoking_status, smoking_info
+    )
+    return {
+        'visit_data': visit_rows(patient, snapshot.visits, results),
+        'smoking_status': smoking_status,
+        'smoking_info': smoking_info,
+        'has_diabetes': has_diabetes,
+        'diabetes_age': diabetes_age,
+        'latest_visit': latest_visit,
+        'possible_scores': possible_scores,
+        'missing_data': missing_data,
+        'data_sources': data_sources,
+        'score_stats': score_stats(results),
+    }
+
+
+def visit_rows(patient: Patient, visits, results) -> list:
+    """Visits newest first, each with its SCORE2 result and the patient's age at the visit"""
+    by_visit = {result.visit_id: result for result in results}
+    return [
+        {
+            'visit': visit,
+            'score': by_visit.get(visit.pk),
+            'has_score': visit.pk in by_visit,
+            'age': patient.calculate_age(visit.visit_date),
+        }
+        for visit in visits
+    ]
+
+
+def score_stats(results) -> Optional[dict]:
+    """Trend of the successful results in calculation order, when there are at least two"""
+    successful = [result for result in results if result.is_calculation_successful]
+    if len(successful) < 2:
+        return None
+    first_score, latest_score = successful[0], successful[-1]
+    if not (first_score.score_value and latest_score.score_value):
+        return None
+    trend = float(latest_score.score_value) - float(first_score.score_value)
+    values = [result.score_value for result in successful if result.score_value is not None]
+    return {
+        'count': len(successful),
+        'first_score': first_score,
+        'latest_score': latest_score,
+        'trend': trend,
+        'trend_direction': 'up' if trend > 0 else 'down' if trend < 0 else 'stable',
+        'trend_percentage': abs(trend),
+        'average_score': sum(values) / len(values),
+    }
+
+
+def score_requirements(patient: Patient, latest_visit: Optional[Visit], has_diabetes: bool,
+                       diabetes_age: Optional[float], smoking_status: str, smoking_info: str):
+    """(possible_scores, missing_data, data_sources) for the latest visit: which SCORE2 variants
+    its data allows, and where each input comes from or what is missing"""
+    possible_scores = []
+    missing_data = []
+    data_sources = {}
+    if not latest_visit:
+        return possible_scores, missing_data, data_sources
+
+    age = patient.calculate_age(latest_visit.visit_date)
+
+    # Check data availability and sources for each score type
+    if 40 <= age <= 69:
+        # SCORE2 requirements
+        missing_score2 = []
+        sources_score2 = {}
+
+        # Systolic pressure
+        if latest_visit.systolic_pressure:
+            sources_score2['systolic_pressure'] = f"{latest_visit.systolic_pressure} mmHg (wizyta)"
+        else:
+            missing_score2.append('ciśnienie skurczowe')
+
+        # Cholesterol
+        if latest_visit.cholesterol_total and latest_visit.cholesterol_hdl:
+            sources_score2['cholesterol'] = f"TC: {latest_visit.cholesterol_total}, HDL: {latest_visit.cholesterol_hdl} (wizyta)"
+        elif latest_visit.cholesterol_total:
+            missing_score2.append('cholesterol HDL')
+            sources_score2['cholesterol'] = f"TC: {latest_visit.cholesterol_total} (wizyta), brak HDL"
+        elif latest_visit.cholesterol_hdl:
+            missing_score2.append('cholesterol całkowity')
+            sources_score2['cholesterol'] = f"HDL: {latest_visit.cholesterol_hdl} (wizyta), brak TC"
+        else:
+            missing_score2.append('cholesterol całkowity i HDL')
+
+        # Smoking status source
+        sources_score2['smoking'] = f"{smoking_status} ({smoking_info})"
+
+        if not missing_score2:
+            possible_scores.append('SCORE2')
+        data_sources['SCORE2'] = {'missing': missing_score2, 'sources': sources_score2}
+
+        # SCORE2-Diabetes requirements (if has diabetes)
+        if has_diabetes:
+            missing_diabetes = missing_score2.copy()  # Start with SCORE2 requirements
+            sources_diabetes = sources_score2.copy()
+
+            # Additional diabetes requirements
+            if latest_visit.hba1c:
+                sources_diabetes['hba1c'] = f"{latest_visit.hba1c}% (wizyta)"
+            else:
+                missing_diabetes.append('hemoglobina glikowana (HbA1c)')
+
+            if latest_visit.egfr:
+                sources_diabetes['egfr'] = f"{latest_visit.egfr} ml/min/1.73m² (wizyta)"
+            else:
+                missing_diabetes.append('eGFR')
+
+            if diabetes_age:
+                sources_diabetes['diabetes_age'] = f"{diabetes_age} lat (diagnoza)"
+            else:
+                missing_diabetes.append('wiek przy diagnozie cukrzycy')
+
+            if not missing_diabetes:
+                possible_scores.append('SCORE2-Diabetes')
+            data_sources['SCORE2-Diabetes'] = {'missing': missing_diabetes, 'sources': sources_diabetes}
+
+    elif age >= 70:
+        # SCORE2-OP requirements
+        missing_op = []
+        sources_op = {}
+
+        if latest_visit.systolic_pressure:
+            sources_op['systolic_pressure'] = f"{latest_visit.systolic_pressure} mmHg (wizyta)"
+        else:
+            missing_op.append('ciśnienie skurczowe')
+
+        if latest_visit.cholesterol_total and latest_visit.cholesterol_hdl:
+            sources_op['cholesterol'] = f"TC: {latest_visit.cholesterol_total}, HDL: {latest_visit.cholesterol_hdl} (wizyta)"
+        else:
+            missing_chol = []
+            if not latest_visit.cholesterol_total:
+                missing_chol.append('cholesterol całkowity')
+            if not latest_visit.cholesterol_hdl:
+                missing_chol.append('cholesterol HDL')
+            missing_op.extend(missing_chol)
+
+        sources_op['smoking'] = f"{smoking_status} ({smoking_info})"
+        sources_op['diabetes'] = f"{'Tak' if has_diabetes else 'Nie'} (diagnoza)"
+
+        if not missing_op:
+            possible_scores.append('SCORE2-OP')
+        data_sources['SCORE2-OP'] = {'missing': missing_op, 'sources': sources_op}
+
+    else:
+        missing_data.append('Wiek poza zakresem 40-89 lat')
+
+    return possible_scores, missing_data, data_sources
@@ -0,0 +1,602 @@
+"""Streaming reader for the NFZ patient export.
+
+Rows are read one at a time with openpyxl in read-only mode, mapped onto the
+import columns, cleaned column-wise in batches (clean_batch) and grouped per
+patient, so memory use depends on the batch and chunk sizes rather than on
+the size of the file. Exports list each patient's rows
+together; a PESEL that shows up again further down is emitted as a
+continuation group. import_chunk() then writes a chunk of groups with one
+multi-row upsert per table; import_excel() drives the whole file and falls
+back to import_groups() (one patient at a time) for a chunk that fails.
+"""
+import logging
+import re
+import unicodedata
+from collections import Counter, namedtuple
+from itertools import islice
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+import openpyxl
+import pandas as pd
+from django.db import transaction
+
+from .models import (
+    Patient, Visit, PatientDiagnosis, VisitDiagnosis, Diagnosis, mark_inputs_changed, refresh_clinical_flags,
+    refresh_summary,
+)
+
+logger = logging.getLogger('patients')
+
+# Export header -> import column
+COLS = {
+    "PACJENT": "full_name",
+    "IDENTYFIAKTOR": "pesel",
+    "DATA URODZENIA": "dob",
+    "ROZPOZNANIE Z WIZYTY": "visit_dx",
+    "DATA OSTATNIEJ WIZYTY": "visit_date",
+    "ROZPOZNANIE PRZEWLEKŁE": "chronic_dx",
+    "ADRES": "address",
+    "TEL. KOMÓRKOWY": "phone_mobile",
+    "TEL. STACJONARNY": "phone_landline",
+    "DATA ROZPOZNANIA SCHORZENIA PRZEWLEKłEGO": "chronic_dx_date",
+    "DATA OSTATNIEJ WIZYTY ZE SCHORZENIEM PRZEWLEKŁYM": "last_chronic_visit",
+    "ŚR. CIśNIENIE SKURCZOWE": "systolic_pressure",
+    "HEMOGLOBINA GLIKOWANA": "hba1c",
+    "EGFR": "egfr",
+    "CHOLESTEROL CAŁKOWITY": "cholesterol_total",
+    "CHOLESTEROL HDL": "cholesterol_hdl",
+}
+
+DATE_COLUMNS = ("dob", "visit_date", "chronic_dx_date", "last_chronic_visit")
+
+# Rows are cleaned this many at a time
+CLEAN_BATCH_SIZE = 5000
+
+# Import columns plus the values derived from them during cleaning
+ImportRow = namedtuple('ImportRow', [*COLS.values(), 'gender', 'age_at_diagnosis'])
+
+PESEL_WEIGHTS = np.array([1, 3, 7, 9, 1, 3, 7, 9, 1, 3])
+# Month offset in the PESEL -> first year of the century
+PESEL_CENTURIES = np.array([1900, 2000, 2100, 2200, 1800])
+
+REJECT_NO_PESEL = 'brak numeru PESEL'
+REJECT_PESEL_FORMAT = 'PESEL nie składa się z 11 cyfr'
+REJECT_PESEL_CHECKSUM = 'błędna cyfra kontrolna PESEL'
+REJECT_PESEL_DATE = 'PESEL zawiera nieprawidłową datę urodzenia'
+
+# Rows of one patient; `continuation` is set when the PESEL was already seen
+# earlier in the file, in which case only its chronic diagnoses are merged
+PatientGroup = namedtuple('PatientGroup', ['pesel', 'rows', 'continuation'])
+
+
+def canonical(s: str) -> str:
+    """Normalize string for column matching"""
+    s = unicodedata.normalize("NFKD", s)
+    s = "".join(ch for ch in s if not unicodedata.combining(ch))
+    s = s.upper()
+    return re.sub(r"[^A-Z0-9]", "", s)
+
+
+def build_rename_map(raw_cols, template=COLS) -> dict:
+    """Build column rename mapping"""
+    canon_to_target = {canonical(k): v for k, v in template.items()}
+    rename_map = {}
+    for raw in raw_cols:
+        c = canonical(raw)
+        if c in canon_to_target:
+            rename_map[raw] = canon_to_target[c]
+    return rename_map
+
+
+class RejectedRows:
+    """Rows left out of an import, counted per reason; the first `limit` are kept for the report"""
+
+    def __init__(self, limit: int = 100):
+        self.limit = limit
+        self.counts = Counter()
+        self.rows = []
+
+    def add(self, row_number: int, pesel: str, reason: str):
+        self.counts[reason] += 1
+        if len(self.rows) < self.limit:
+            self.rows.append({'row': row_number, 'pesel': pesel, 'reason': reason})
+
+    @property
+    def total(self) -> int:
+        return sum(self.counts.values())
+
+    def as_dict(self) -> dict:
+        return {'total': self.total, 'by_reason': dict(self.counts), 'rows': self.rows}
+
+
+def read_rows(fileobj, filename: str = '',
+              rejected: RejectedRows = None) -> Tuple[Iterator[ImportRow], Optional[int]]:
+    """Clean rows of an .xlsx (streamed) or .xls file and the approximate number of rows, if known.
+
+    Rows that cannot be imported are skipped and recorded in `rejected`.
+    """
+    if filename.lower().endswith('.xls'):
+        # openpyxl cannot read the legacy format; .xls sheets top out at 65k rows anyway
+        df = pd.read_excel(fileobj)
+        values = (tuple(None if pd.isna(v) else v for v in row) for row in df.itertuples(index=False))
+        return _rows(df.columns.tolist(), values, rejected), len(df)
+
+    workbook = openpyxl.load_workbook(fileobj, read_only=True, data_only=True)
+    sheet = workbook.worksheets[0]
+    values = sheet.iter_rows(values_only=True)
+    header = next(values, None) or ()
+    total = sheet.max_row - 1 if sheet.max_row else None
+
+    def stream():
+        try:
+            yield from _rows(header, values, rejected)
+        finally:
+            workbook.close()
+
+    return stream(), total
+
+
+def _rows(header, values: Iterable[tuple], rejected: RejectedRows = None) -> Iterator[ImportRow]:
+    return clean_rows(map_cells(header, values), rejected)
+
+
+def clean_rows(cells: Iterable[tuple], rejected: RejectedRows = None) -> Iterator[ImportRow]:
+    """Clean raw rows (cells in COLS order) CLEAN_BATCH_SIZE at a time"""
+    cells = iter(cells)
+    first_row = 2  # sheet row number of the first data row, after the header
+    while True:
+        batch = list(islice(cells, CLEAN_BATCH_SIZE))
+        if not batch:
+            return
+        yield from clean_batch(batch, first_row, rejected)
+        first_row += len(batch)
+
+
+def map_cells(header, values: Iterable[tuple]) -> Iterator[tuple]:
+    """Raw cells of each sheet row, reordered to COLS order"""
+    raw_cols = [str(c) for c in header if c is not None]
+    rename_map = build_rename_map(raw_cols)
+    missing = [v for v in COLS.values() if v not in rename_map.values()]
+    if missing:
+        raise ValueError(f"Brakuje kolumn: {missing}")
+
+    # First matching header wins, like DataFrame.loc on the renamed frame
+    positions = {}
+    for i, raw in enumerate(header):
+        target = rename_map.get(str(raw)) if raw is not None else None
+        if target and target not in positions:
+            positions[target] = i
+    index = [positions[field] for field in COLS.values()]
+
+    for row in values:
+        yield tuple(row[i] if i < len(row) else None for i in index)
+
+
+def clean_batch(batch: List[tuple], first_row: int = 2, rejected: RejectedRows = None) -> Iterator[ImportRow]:
+    """Clean raw rows (cells in COLS order) column by column.
+
+    Dates are parsed per column, the PESEL is normalized and its check digit
+    verified, gender and a missing date of birth are taken from the PESEL and
+    the age at diagnosis is computed for all rows at once. Rows without a
+    valid PESEL go to `rejected`; completely empty rows are dropped silently.
+    """
+    frame = pd.DataFrame(batch, columns=list(COLS.values()), dtype=object)
+    pesel, gender, pesel_dob, reason = parse_pesels(frame['pesel'])
+    dates = {column: parse_dates(frame[column]) for column in DATE_COLUMNS}
+    dates['dob'] = dates['dob'].fillna(pesel_dob)
+    age_at = age_in_years(dates['dob'], dates['chronic_dx_date'])
+
+    empty = frame.isna().all(axis=1).to_numpy()
+    valid = reason.isna().to_numpy()
+    if rejected is not None:
+        for position in np.flatnonzero(~valid & ~empty):
+            rejected.add(first_row + int(position), pesel.iat[position] or '', reason.iat[position])
+
+    columns = {column: frame[column].tolist() for column in COLS.values()}
+    columns['pesel'] = pesel.tolist()
+    for column, parsed in dates.items():
+        columns[column] = parsed.dt.date.where(parsed.notna(), None).tolist()
+    columns['gender'] = gender.tolist()
+    columns['age_at_diagnosis'] = age_at.astype(object).where(age_at.notna(), None).tolist()
+
+    fields = ImportRow._fields
+    for position, values in enumerate(zip(*(columns[field] for field in fields))):
+        if valid[position]:
+            yield ImportRow._make(values)
+
+
+def parse_dates(values: pd.Series) -> pd.Series:
+    """Parse a column of date cells: datetime64 series, NaT where the value is not a date.
+
+    Cells that openpyxl already returned as dates stringify to ISO format,
+    so one ISO pass and one day-first pass cover nearly everything; only the
+    leftovers go through the slower per-value parser.
+    """
+    text = values.astype('string').str.strip()
+    parsed = pd.to_datetime(text, format='ISO8601', errors='coerce')
+    for fmt in ('%d.%m.%Y', 'mixed'):
+        todo = parsed.isna() & text.notna() & (text != '')
+        if not todo.any():
+            break
+        parsed[todo] = pd.to_datetime(text[todo], format=fmt, dayfirst=True, errors='coerce')
+    return parsed
+
+
+def parse_pesels(values: pd.Series):
+    """Normalize a PESEL column and decode it.
+
+    Returns (pesel, gender, date of birth, rejection reason) series; the
+    reason is NA for valid numbers. A ten-digit number is taken to have lost
+    its leading zero to a numeric cell.
+    """
+    pesel = values.astype('string').str.strip().str.replace(r'\.0$', '', regex=True)
+    pesel = pesel.where(pesel.str.len() != 10, pesel.str.zfill(11))
+
+    reason = pd.Series(pd.NA, index=values.index, dtype='string')
+    blank = pesel.isna() | (pesel == '')
+    well_formed = pesel.str.fullmatch(r'\d{11}').fillna(False).astype(bool)
+    reason[blank] = REJECT_NO_PESEL
+    reason[~blank & ~well_formed] = REJECT_PESEL_FORMAT
+
+    gender = pd.Series(None, index=values.index, dtype=object)
+    dob = pd.Series(pd.NaT, index=values.index, dtype='datetime64[ns]')
+    if well_formed.any():
+        digits = np.frombuffer(pesel[well_formed].str.cat().encode('ascii'), dtype=np.uint8)
+        digits = digits.reshape(-1, 11).astype(np.int64) - ord('0')
+        checksum_ok = (10 - digits[:, :10] @ PESEL_WEIGHTS % 10) % 10 == digits[:, 10]
+
+        month = digits[:, 2] * 10 + digits[:, 3]
+        born = pd.to_datetime(pd.DataFrame({
+            'year': PESEL_CENTURIES[month // 20] + digits[:, 0] * 10 + digits[:, 1],
+            'month': month % 20,
+            'day': digits[:, 4] * 10 + digits[:, 5],
+        }), errors='coerce')
+
+        index = pesel.index[well_formed]
+        reason[index[~checksum_ok]] = REJECT_PESEL_CHECKSUM
+        reason[index[checksum_ok & born.isna().to_numpy()]] = REJECT_PESEL_DATE
+        gender[index] = np.where(digits[:, 9] % 2, 'M', 'F')
+        dob[index] = born.to_numpy()
+    return pesel.astype(object).where(pesel.notna(), None), gender, dob, reason
+
+
+def age_in_years(born: pd.Series, on: pd.Series) -> pd.Series:
+    """Whole years from `born` to `on` (relativedelta(on, born).years), NA if either is missing"""
+    later = on >= born
+    start = born.where(later, on)
+    end = on.where(later, born)
+    years = end.dt.year - start.dt.year
+    before_birthday = (end.dt.month < start.dt.month) | (
+        (end.dt.month == start.dt.month) & (end.dt.day < start.dt.day)
+    )
+    years = (years - before_birthday.astype(int)).astype('Int64')
+    return years.where(later, -years)
+
+
+def iter_patient_groups(rows: Iterable[ImportRow], chunk_size: int) -> Iterator[List[PatientGroup]]:
+    """Group consecutive rows by PESEL and yield at most `chunk_size` groups at a time"""
+    seen = set()
+    chunk = []
+    pesel, group_rows = None, []
+
+    def close_group():
+        chunk.append(PatientGroup(pesel, group_rows, pesel in seen))
+        seen.add(pesel)
+
+    for row in rows:
+        if row.pesel != pesel:
+            if group_rows:
+                close_group()
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = []
+            pesel, group_rows = row.pesel, []
+        group_rows.append(row)
+
+    if group_rows:
+        close_group()
+    if chunk:
+        yield chunk
+
+
+VISIT_MEASUREMENTS = ('systolic_pressure', 'hba1c', 'egfr', 'cholesterol_total', 'cholesterol_hdl')
+
+
+def import_chunk(groups: List[PatientGroup], known_codes: set = None) -> dict:
+    """Write one chunk of patient groups with a single upsert per table.
+
+    Produces the same rows and counts as importing the groups one by one:
+    existing patients only get non-empty address/phones, existing visits are
+    left untouched, and chronic diagnoses are folded in file order (first row
+    creates, later rows overwrite only non-empty values). Database errors
+    propagate so the caller can retry the chunk row by row.
+
+    Dictionary rows are only inserted for codes missing from `known_codes`;
+    the set is extended once the chunk commits.
+    """
+    results = {'patients_processed': 0, 'visits_processed': 0, 'diagnoses_processed': 0}
+    firsts = [group for group in groups if not group.continuation]
+    pesels = {group.pesel for group in groups}
+
+    # Patients
+    existing = {p.pesel: p for p in Patient.objects.filter(pesel__in=pesels)}
+    # New patients and those whose contact data changed; the rest keep their updated_at
+    patients = []
+    for group in firsts:
+        row = group.rows[0]
+        current = existing.get(group.pesel)
+        if current is None:
+            patients.append(Patient(
+                pesel=row.pesel, full_name=row.full_name, date_of_birth=row.dob, gender=row.gender,
+                address=row.address, phone_mobile=row.phone_mobile, phone_landline=row.phone_landline,
+            ))
+            continue
+        contact = (current.address, current.phone_mobile, current.phone_landline)
+        current.address = row.address or current.address
+        current.phone_mobile = row.phone_mobile or current.phone_mobile
+        current.phone_landline = row.phone_landline or current.phone_landline
+        if (current.address, current.phone_mobile, current.phone_landline) != contact:
+            patients.append(current)
+    Patient.objects.bulk_create(
+        patients,
+        update_conflicts=True,
+        unique_fields=['pesel'],
+        update_fields=['address', 'phone_mobile', 'phone_landline', 'updated_at'],
+    )
+    patient_ids = {p.pesel: p.pk for p in existing.values()}
+    patient_ids.update({p.pesel: p.pk for p in patients})
+    results['patients_processed'] = len(firsts)
+
+    # Visits: only from each patient's first row, never overwriting an existing one
+    visit_rows = [
+        (patient_ids[group.pesel], group.rows[0]) for group in firsts
+        if group.pesel in patient_ids and group.rows[0].visit_date
+    ]
+    existing_visits = {
+        (v.patient_id, v.visit_date): v.pk
+        for v in Visit.objects.filter(patient_id__in=[pid for pid, _ in visit_rows]).only('pk', 'patient_id', 'visit_date')
+    }
+    new_visits = {}
+    for patient_id, row in visit_rows:
+        key = (patient_id, row.visit_date)
+        if key in existing_visits or key in new_visits:
+            continue
+        visit = Visit(patient_id=patient_id, visit_date=row.visit_date, **{
+            field: getattr(row, field) for field in VISIT_MEASUREMENTS if not pd.isna(getattr(row, field))
+        })
+        visit.quarter = visit.get_quarter()
+        new_visits[key] = visit
+    # The no-op update on conflict makes PostgreSQL return ids for every row
+    Visit.objects.bulk_create(
+        new_visits.values(),
+        update_conflicts=True,
+        unique_fields=['patient', 'visit_date'],
+        update_fields=['quarter'],
+    )
+    visit_ids = dict(existing_visits)
+    visit_ids.update({key: v.pk for key, v in new_visits.items()})
+    results['visits_processed'] = len(new_visits)
+    # bulk_create skips the Visit signal that marks the SCORE2 inputs as changed
+    mark_inputs_changed(Patient.objects.filter(pk__in={patient_id for patient_id, _ in new_visits}))
+
+    # Visit diagnoses
+    codes = set()
+    visit_diagnoses = set()
+    for patient_id, row in visit_rows:
+        if row.visit_dx:
+            for code in str(row.visit_dx).split(','):
+                code = code.strip()
+                if code:
+                    codes.add(code)
+                    visit_diagnoses.add((visit_ids[patient_id, row.visit_date], code))
+
+    # Chronic diagnoses, folded in file order
+    chronic_rows = [
+        (patient_ids[group.pesel], row) for group in groups if group.pesel in patient_ids
+        for row in group.rows if row.chronic_dx
+    ]
+    chronic = {
+        (d.patient_id, d.diagnosis_code): d
+        for d in PatientDiagnosis.objects.filter(patient_id__in={pid for pid, _ in chronic_rows})
+    }
+    created = set()
+    written = set()
+    for patient_id, row in chronic_rows:
+        code = str(row.chronic_dx)
+        codes.add(code)
+        written.add((patient_id, code))
+        age_at = row.age_at_diagnosis
+        diagnosis = chronic.get((patient_id, code))
+        if diagnosis is None:
+            chronic[patient_id, code] = PatientDiagnosis(
+                patient_id=patient_id, diagnosis_code=code, diagnosed_at=row.chronic_dx_date,
+                last_visit_with_condition=row.last_chronic_visit, age_at_diagnosis=age_at,
+            )
+            created.add((patient_id, code))
+            continue
+        if row.chronic_dx_date:
+            diagnosis.diagnosed_at = row.chronic_dx_date
+        if row.last_chronic_visit:
+            diagnosis.last_visit_with_condition = row.last_chronic_visit
+        if age_at:
+            diagnosis.age_at_diagnosis = age_at
+    results['diagnoses_processed'] = len(created)
+
+    new_codes = codes - known_codes if known_codes is not None else codes
+    if new_codes:
+        Diagnosis.objects.bulk_create([Diagnosis.from_code(code) for code in new_codes], ignore_conflicts=True)
+        if known_codes is not None:
+            transaction.on_commit(lambda: known_codes.update(new_codes))
+    VisitDiagnosis.objects.bulk_create(
+        [VisitDiagnosis(visit_id=visit_id, diagnosis_code=code) for visit_id, code in visit_diagnoses],
+        ignore_conflicts=True,
+    )
+    PatientDiagnosis.objects.bulk_create(
+        [chronic[key] for key in written],
+        update_conflicts=True,
+        unique_fields=['patient', 'diagnosis_code'],
+        update_fields=['diagnosed_at', 'last_visit_with_condition', 'age_at_diagnosis'],
+    )
+    # bulk_create sends no signals, so refresh the derived columns here
+    chunk_patients = Patient.objects.filter(pk__in=patient_ids.values())
+    refresh_clinical_flags(chunk_patients)
+    refresh_summary(chunk_patients)
+    return results
+
+
+# Patients imported per transaction
+IMPORT_CHUNK_SIZE = 200
+
+
+def import_excel(fileobj, filename: str = '', progress=None, chunk_size: int = IMPORT_CHUNK_SIZE) -> dict:
+    """Stream the Excel file and import it chunk by chunk.
+
+    `progress(rows_done, rows_total)` is called after every committed chunk;
+    rows_total is an estimate taken from the sheet dimensions. Rows without
+    a valid PESEL are skipped and listed under 'rejected'.
+    """
+    rejected = RejectedRows()
+    # Diagnosis codes already in the dictionary; only new ones get inserted
+    known_codes = set(Diagnosis.objects.values_list('code', flat=True))
+    rows, total_rows = read_rows(fileobj, filename or getattr(fileobj, 'name', ''), rejected)
+
+    results = {'patients_processed': 0, 'visits_processed': 0, 'diagnoses_processed': 0}
+    rows_done = 0
+
+    # Commit every `chunk_size` patients so progress is visible to other connections
+    for chunk in iter_patient_groups(rows, chunk_size):
+        try:
+            with transaction.atomic():
+                chunk_results = import_chunk(chunk, known_codes)
+        except Exception as e:
+            # Some row breaks the multi-row upsert; redo the chunk patient by patient
+            logger.warning(f"IMPORT_FALLBACK;;;Bulk import of chunk failed, importing row by row;{str(e)};")
+            chunk_results = import_groups(chunk, known_codes)
+        for key, value in chunk_results.items():
+            results[key] += value
+        rows_done += sum(len(group.rows) for group in chunk)
+        if progress is not None:
+            progress(rows_done, max(total_rows or 0, rows_done))
+
+    results['rows_rejected'] = rejected.total
+    results['rejected'] = rejected.as_dict()
+    return results
+
+
+def import_groups(groups: List[PatientGroup], known_codes: set) -> dict:
+    """Import patient groups one at a time, skipping the ones that fail"""
+    results = {'patients_processed': 0, 'visits_processed': 0, 'diagnoses_processed': 0}
+    with transaction.atomic():
+        for group in groups:
+            try:
+                with transaction.atomic():
+                    patient_results = import_patient_group(group.rows, group.continuation, known_codes)
+                if not group.continuation:
+                    results['patients_processed'] += 1
+                results['visits_processed'] += patient_results.get('visits', 0)
+                results['diagnoses_processed'] += patient_results.get('diagnoses', 0)
+            except Exception as e:
+                logger.warning(f"IMPORT_ERROR;{group.pesel};;;Patient skipped;{str(e)}")
+                continue
+    return results
+
+
+def import_patient_group(rows: List[ImportRow], continuation: bool = False, known_codes: set = None) -> dict:
+    """Process all rows for a single patient.
+
+    A continuation group (the PESEL appeared earlier in the file) only
+    adds chronic diagnoses; patient data and the visit come from the
+    patient's first row, as before.
+    """
+    known_codes = set() if known_codes is None else known_codes
+    first_row = rows[0]
+
+    if continuation:
+        patient = Patient.objects.get(pesel=first_row.pesel)
+        results = {'visits': 0, 'diagnoses': 0}
+    else:
+        # Create or update patient
+        patient, created = Patient.objects.get_or_create(
+            pesel=first_row.pesel,
+            defaults={
+                'full_name': first_row.full_name,
+                'date_of_birth': first_row.dob,
+                'gender': first_row.gender,
+                'address': first_row.address,
+                'phone_mobile': first_row.phone_mobile,
+                'phone_landline': first_row.phone_landline,
+            }
+        )
+
+        if not created:
+            # Update existing patient data (except basic info)
+            contact = (patient.address, patient.phone_mobile, patient.phone_landline)
+            if first_row.address:
+                patient.address = first_row.address
+            if first_row.phone_mobile:
+                patient.phone_mobile = first_row.phone_mobile
+            if first_row.phone_landline:
+                patient.phone_landline = first_row.phone_landline
+            # Saving bumps updated_at, which marks the patient for recompute
+            if (patient.address, patient.phone_mobile, patient.phone_landline) != contact:
+                patient.save()
+
+        results = {'visits': 0, 'diagnoses': 0}
+
+        # Create visit if visit_date exists and visit doesn't exist yet
+        if first_row.visit_date:
+            # build defaults dict, skipping any NaN/None
+            defaults = {}
+            for field in VISIT_MEASUREMENTS:
+                val = getattr(first_row, field)
+                # pd.isna covers both None and np.nan
+                if not pd.isna(val):
+                    defaults[field] = val
+
+            visit, visit_created = Visit.objects.get_or_create(
+                patient=patient,
+                visit_date=first_row.visit_date,
+                defaults=defaults
+            )
+            if visit_created:
+                results['visits'] = 1
+
+            # Add visit diagnoses
+            if first_row.visit_dx:
+                for code in str(first_row.visit_dx).split(','):
+                    code = code.strip()
+                    if code and not VisitDiagnosis.objects.filter(visit=visit, diagnosis_code=code).exists():
+                        VisitDiagnosis(visit=visit, diagnosis_code=code).save(known_codes=known_codes)
+
+    # Process chronic diagnoses
+    for row in rows:
+        if row.chronic_dx:
+            age_at = row.age_at_diagnosis
+
+            diagnosis = PatientDiagnosis.objects.filter(patient=patient, diagnosis_code=row.chronic_dx).first()
+            diag_created = diagnosis is None
+            if diag_created:
+                diagnosis = PatientDiagnosis(
+                    patient=patient,
+                    diagnosis_code=row.chronic_dx,
+                    diagnosed_at=row.chronic_dx_date,
+                    last_visit_with_condition=row.last_chronic_visit,
+                    age_at_diagnosis=age_at,
+                )
+            else:
+                # Update existing diagnosis
+                if row.chronic_dx_date:
+                    diagnosis.diagnosed_at = row.chronic_dx_date
+                if row.last_chronic_visit:
+                    diagnosis.last_visit_with_condition = row.last_chronic_visit
+                if age_at:
+                    diagnosis.age_at_diagnosis = age_at
+            # Known codes skip the dictionary lookup in save()
+            diagnosis.save(known_codes=known_codes)
+
+            if diag_created:
+                results['diagnoses'] += 1
+
+    return results
+
@@ -0,0 +1,60 @@
+import csv
+import re
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from patients.copy_import import SAMPLE_SIZE, sniff_format
+from patients.models import Diagnosis
+
+# PostgreSQL encoding names returned by sniff_format -> Python codecs
+ENCODINGS = {'UTF8': 'utf-8-sig', 'WIN1250': 'cp1250'}
+
+ICD10_CODE = re.compile(r'^[A-Z]\d{2}(\.\w{1,4})?$')
+
+BATCH_SIZE = 5000
+
+
+class Command(BaseCommand):
+    help = 'Wczytuje słownik ICD-10 (kod i opis, CSV/TSV) do tabeli rozpoznań i wylicza flagi kategorii'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Plik słownika: pierwsza kolumna kod, druga opis')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        try:
+            with open(path, 'rb') as f:
+                sample = f.read(SAMPLE_SIZE)
+        except OSError as e:
+            raise CommandError(f'Nie można otworzyć pliku: {e}')
+        delimiter, encoding, _ = sniff_format(sample, path)
+
+        entries = {}
+        skipped = 0
+        with open(path, encoding=ENCODINGS[encoding], newline='') as f:
+            for row in csv.reader(f, delimiter=delimiter):
+                code = row[0].strip().upper() if row else ''
+                if not ICD10_CODE.match(code):
+                    # Header, chapter titles and blank lines
+                    skipped += 1
+                    continue
+                description = row[1].strip() if len(row) > 1 else ''
+                entries[code] = Diagnosis.from_code(code, description or None)
+
+        existing = set(Diagnosis.objects.values_list('code', flat=True))
+        diagnoses = list(entries.values())
+        with transaction.atomic():
+            for start in range(0, len(diagnoses), BATCH_SIZE):
+                Diagnosis.objects.bulk_create(
+                    diagnoses[start:start + BATCH_SIZE],
+                    update_conflicts=True,
+                    unique_fields=['code'],
+                    update_fields=['description', 'is_diabetes', 'diabetes_type', 'smoking_marker'],
+                )
+
+        created = len(entries.keys() - existing)
+        self.stdout.write(self.style.SUCCESS(
+            f'Wczytano {len(entries)} kodów: nowe {created}, zaktualizowane {len(entries) - created}, '
+            f'pominięte wiersze {skipped}'
+        ))
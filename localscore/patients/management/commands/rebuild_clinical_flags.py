@@ -0,0 +1,40 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from patients.models import Patient, refresh_clinical_flags, refresh_summary
+
+BATCH_SIZE = 5000
+
+
+class Command(BaseCommand):
+    help = ('Przelicza od nowa zapisane u pacjentów flagi kliniczne (cukrzyca, wiek rozpoznania, palenie) '
+            'oraz kolumny listy (liczba wizyt i wyników, bieżący SCORE2)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                            help='Liczba pacjentów aktualizowanych jednym zapytaniem')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        started = time.monotonic()
+        updated = 0
+        last_pk = 0
+        # Id ranges keep each UPDATE (and its row locks) short
+        while True:
+            ids = list(
+                Patient.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:batch_size]
+            )
+            if not ids:
+                break
+            with transaction.atomic():
+                batch = Patient.objects.filter(pk__gte=ids[0], pk__lte=ids[-1])
+                updated += refresh_clinical_flags(batch)
+                refresh_summary(batch)
+            last_pk = ids[-1]
+            self.stdout.write(f'Zaktualizowano {updated} pacjentów')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Przeliczono flagi kliniczne i kolumny listy {updated} pacjentów w {time.monotonic() - started:.1f} s'
+        ))
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.4 on 2026-10-17 15:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0002_patient_smoking_status'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='visit',
+            constraint=models.UniqueConstraint(fields=('patient', 'visit_date'), name='visits_patient_visit_date_uniq'),
+        ),
+    ]
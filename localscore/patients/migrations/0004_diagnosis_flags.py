@@ -0,0 +1,62 @@
+# Generated by Django 5.2.4 on 2026-10-17 15:24
+
+from django.db import migrations, models
+
+# Category rules as of this migration (frozen copy of patients.models.diagnosis_flags)
+DIABETES_TYPES = {'E10': 'type1', 'E11': 'type2', 'E13': 'other', 'E14': 'unspecified'}
+SMOKER_CODE = 'F17.2'
+NON_SMOKER_CODES = ('Z87.7', 'Z58.7')
+
+
+def diagnosis_flags(code):
+    diabetes_type = DIABETES_TYPES.get(code[:3], '')
+    if code == SMOKER_CODE:
+        smoking_marker = 'smoker'
+    elif code in NON_SMOKER_CODES:
+        smoking_marker = 'non_smoker'
+    else:
+        smoking_marker = ''
+    return {'is_diabetes': bool(diabetes_type), 'diabetes_type': diabetes_type, 'smoking_marker': smoking_marker}
+
+
+def fill_flags(apps, schema_editor):
+    """Add dictionary rows for codes used without one and compute the flags of every code"""
+    Diagnosis = apps.get_model('patients', 'Diagnosis')
+    PatientDiagnosis = apps.get_model('patients', 'PatientDiagnosis')
+    VisitDiagnosis = apps.get_model('patients', 'VisitDiagnosis')
+
+    used = set(PatientDiagnosis.objects.values_list('diagnosis_code', flat=True).distinct())
+    used.update(VisitDiagnosis.objects.values_list('diagnosis_code', flat=True).distinct())
+    Diagnosis.objects.bulk_create([Diagnosis(code=code) for code in used if code], ignore_conflicts=True)
+
+    diagnoses = list(Diagnosis.objects.all())
+    for diagnosis in diagnoses:
+        for field, value in diagnosis_flags(diagnosis.code).items():
+            setattr(diagnosis, field, value)
+    Diagnosis.objects.bulk_update(diagnoses, ['is_diabetes', 'diabetes_type', 'smoking_marker'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0003_visit_unique_patient_date'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='diagnosis',
+            name='diabetes_type',
+            field=models.CharField(blank=True, choices=[('type1', 'Typ 1 (E10)'), ('type2', 'Typ 2 (E11)'), ('other', 'Inna określona (E13)'), ('unspecified', 'Nieokreślona (E14)')], default='', max_length=12),
+        ),
+        migrations.AddField(
+            model_name='diagnosis',
+            name='is_diabetes',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.AddField(
+            model_name='diagnosis',
+            name='smoking_marker',
+            field=models.CharField(blank=True, choices=[('smoker', 'Pali'), ('non_smoker', 'Nie pali')], db_index=True, default='', max_length=12),
+        ),
+        migrations.RunPython(fill_flags, migrations.RunPython.noop),
+    ]
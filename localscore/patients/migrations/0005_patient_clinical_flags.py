@@ -0,0 +1,73 @@
+# Generated by Django 5.2.4 on 2026-10-17 15:26
+
+from django.db import migrations, models
+from django.db.models import Case, Exists, F, OuterRef, Subquery, Value, When
+
+# Smoking status codes in priority order, as of this migration
+SMOKING_CODES = [('F17.2', 'smoker'), ('Z87.7', 'non_smoker'), ('Z58.7', 'non_smoker')]
+
+
+def fill_flags(apps, schema_editor):
+    """Frozen copy of patients.models.clinical_flag_expressions() on the historical models"""
+    Patient = apps.get_model('patients', 'Patient')
+    Diagnosis = apps.get_model('patients', 'Diagnosis')
+    PatientDiagnosis = apps.get_model('patients', 'PatientDiagnosis')
+    VisitDiagnosis = apps.get_model('patients', 'VisitDiagnosis')
+
+    def has_diagnosis(**lookup):
+        return (
+            Exists(PatientDiagnosis.objects.filter(patient=OuterRef('pk'), **lookup))
+            | Exists(VisitDiagnosis.objects.filter(visit__patient=OuterRef('pk'), **lookup))
+        )
+
+    diabetes_codes = Diagnosis.objects.filter(is_diabetes=True).values('code')
+    Patient.objects.update(
+        has_diabetes=Case(
+            When(has_diagnosis(diagnosis_code__in=diabetes_codes), then=Value(True)),
+            default=Value(False),
+        ),
+        diabetes_age_at_diagnosis=Subquery(
+            PatientDiagnosis.objects.filter(
+                patient=OuterRef('pk'), diagnosis_code__in=diabetes_codes, age_at_diagnosis__isnull=False,
+            ).order_by('diagnosed_at').values('age_at_diagnosis')[:1]
+        ),
+        effective_smoking_status=Case(
+            *[When(has_diagnosis(diagnosis_code=code), then=Value(status)) for code, status in SMOKING_CODES],
+            default=F('smoking_status'),
+        ),
+        smoking_info_source=Case(
+            *[When(has_diagnosis(diagnosis_code=code), then=Value(code)) for code, _ in SMOKING_CODES],
+            default=Value('patient_setting'),
+        ),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0004_diagnosis_flags'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='patient',
+            name='diabetes_age_at_diagnosis',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=5, null=True),
+        ),
+        migrations.AddField(
+            model_name='patient',
+            name='effective_smoking_status',
+            field=models.CharField(choices=[('non_smoker', 'Nie pali'), ('smoker', 'Pali'), ('assumed_non_smoker', 'Zakładany niepali (brak danych)')], default='assumed_non_smoker', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='patient',
+            name='has_diabetes',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.AddField(
+            model_name='patient',
+            name='smoking_info_source',
+            field=models.CharField(default='patient_setting', max_length=20),
+        ),
+        migrations.RunPython(fill_flags, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 5.2.4 on 2026-10-17 15:29
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count(queryset):
+    """Row count of a correlated queryset as a subquery (0 when empty)"""
+    return Coalesce(Subquery(queryset.order_by().values('patient').annotate(n=Count('pk')).values('n')), 0)
+
+
+def fill_summary(apps, schema_editor):
+    """Frozen copy of patients.models.summary_expressions() for the columns added here"""
+    Patient = apps.get_model('patients', 'Patient')
+    Visit = apps.get_model('patients', 'Visit')
+    Score2Result = apps.get_model('score2', 'Score2Result')
+
+    current = Score2Result.objects.filter(patient=OuterRef('pk')).order_by('-visit__visit_date', '-created_at')
+    Patient.objects.update(
+        visits_count=count(Visit.objects.filter(patient=OuterRef('pk'))),
+        score2_count=count(Score2Result.objects.filter(patient=OuterRef('pk'))),
+        current_score_value=Subquery(current.values('score_value')[:1]),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0005_patient_clinical_flags'),
+        ('score2', '0005_recompute_runs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='patient',
+            name='current_score_value',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=5, null=True),
+        ),
+        migrations.AddField(
+            model_name='patient',
+            name='score2_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='patient',
+            name='visits_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='patient',
+            index=models.Index(fields=['-current_score_value', '-updated_at', '-id'], name='patients_score_order_idx'),
+        ),
+        migrations.RunPython(fill_summary, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.4 on 2026-10-17 15:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0007_data_version'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='patient',
+            name='patients_score_order_idx',
+        ),
+        migrations.AddIndex(
+            model_name='patient',
+            index=models.Index(models.OrderBy(models.F('current_score_value'), descending=True, nulls_last=True), models.OrderBy(models.F('updated_at'), descending=True), models.OrderBy(models.F('id'), descending=True), name='patients_score_order_idx'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.4 on 2026-10-17 15:34
+
+import django.contrib.postgres.indexes
+from django.contrib.postgres.operations import TrigramExtension
+import django.db.models.functions.comparison
+import django.db.models.functions.text
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0008_list_keyset_index'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddField(
+            model_name='patient',
+            name='search_name',
+            field=models.GeneratedField(db_persist=True, expression=django.db.models.functions.text.Lower(models.Func(django.db.models.functions.comparison.Coalesce('full_name', models.Value('')), models.Value('ąćęłńóśźżáäâàãåčďéëêèěíïîìľĺňñöôòõőřŕšťúüûùůűýÿžĄĆĘŁŃÓŚŹŻÁÄÂÀÃÅČĎÉËÊÈĚÍÏÎÌĽĹŇÑÖÔÒÕŐŘŔŠŤÚÜÛÙŮŰÝŸŽ'), models.Value('acelnoszzaaaaaacdeeeeeiiiillnnooooorrstuuuuuuyyzacelnoszzaaaaaacdeeeeeiiiillnnooooorrstuuuuuuyyz'), function='translate')), output_field=models.CharField(max_length=200)),
+        ),
+        migrations.AddIndex(
+            model_name='patient',
+            index=models.Index(django.contrib.postgres.indexes.OpClass('pesel', name='varchar_pattern_ops'), name='patients_pesel_prefix_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='patient',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass('search_name', name='gin_trgm_ops'), name='patients_search_name_trgm'),
+        ),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 5.2.4 on 2026-10-17 15:35
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def fill_current_score(apps, schema_editor):
+    """Frozen copy of patients.models.summary_expressions() for the columns added here"""
+    Patient = apps.get_model('patients', 'Patient')
+    Score2Result = apps.get_model('score2', 'Score2Result')
+
+    current = Score2Result.objects.filter(patient=OuterRef('pk')).order_by('-visit__visit_date', '-created_at')
+    Patient.objects.update(
+        current_score_type=Subquery(current.values('score_type')[:1]),
+        current_risk_level=Subquery(current.values('risk_level')[:1]),
+        current_score_visit_date=Subquery(current.values('visit__visit_date')[:1]),
+        score_computed_at=Subquery(current.values('updated_at')[:1]),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0009_patient_search'),
+        ('score2', '0005_recompute_runs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='patient',
+            name='current_risk_level',
+            field=models.CharField(blank=True, max_length=20, null=True),
+        ),
+        migrations.AddField(
+            model_name='patient',
+            name='current_score_type',
+            field=models.CharField(blank=True, max_length=20, null=True),
+        ),
+        migrations.AddField(
+            model_name='patient',
+            name='current_score_visit_date',
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='patient',
+            name='score_computed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        # Fill before building the indexes
+        migrations.RunPython(fill_current_score, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='patient',
+            index=models.Index(models.F('current_risk_level'), models.OrderBy(models.F('current_score_value'), descending=True, nulls_last=True), models.OrderBy(models.F('updated_at'), descending=True), models.OrderBy(models.F('id'), descending=True), name='patients_risk_order_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='patient',
+            index=models.Index(fields=['current_score_visit_date', 'id'], name='patients_score_visit_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-17 16:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0010_patient_current_score'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='patient',
+            name='inputs_changed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.2.4 on 2026-10-17 17:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0011_patient_inputs_changed_at'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='patient',
+            name='effective_smoking_status',
+            field=models.CharField(choices=[('non_smoker', 'Nie pali'), ('smoker', 'Pali'), ('assumed_non_smoker', 'Zakładany niepali (brak danych)')], db_default='assumed_non_smoker', default='assumed_non_smoker', max_length=20),
+        ),
+        migrations.AlterField(
+            model_name='patient',
+            name='has_diabetes',
+            field=models.BooleanField(db_default=False, db_index=True, default=False),
+        ),
+        migrations.AlterField(
+            model_name='patient',
+            name='score2_count',
+            field=models.PositiveIntegerField(db_default=0, default=0),
+        ),
+        migrations.AlterField(
+            model_name='patient',
+            name='smoking_info_source',
+            field=models.CharField(db_default='patient_setting', default='patient_setting', max_length=20),
+        ),
+        migrations.AlterField(
+            model_name='patient',
+            name='smoking_status',
+            field=models.CharField(choices=[('non_smoker', 'Nie pali'), ('smoker', 'Pali'), ('assumed_non_smoker', 'Zakładany niepali (brak danych)')], db_default='assumed_non_smoker', default='assumed_non_smoker', max_length=20),
+        ),
+        migrations.AlterField(
+            model_name='patient',
+            name='visits_count',
+            field=models.PositiveIntegerField(db_default=0, default=0),
+        ),
+    ]
@@ -1,9 +1,107 @@
-from django.db import models
+from django.db import connection, models, transaction
+from django.contrib.postgres.indexes import GinIndex, OpClass
+from django.contrib.postgres.search import TrigramSimilarity
+from django.db.models import Case, Count, Exists, F, Func, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Coalesce, Lower
 from django.core.validators import RegexValidator
 from datetime import date
 from dateutil.relativedelta import relativedelta
-from django.db.models import Q 
 from django.core.exceptions import ValidationError
+from django.utils import timezone
+
+# ICD-10 categories treated as diabetes (matched as code prefixes) and their type
+DIABETES_TYPES = {
+    'E10': 'type1',
+    'E11': 'type2',
+    'E13': 'other',
+    'E14': 'unspecified',
+}
+DIABETES_CODES = tuple(DIABETES_TYPES)
+
+# ICD-10 codes that determine smoking status, in priority order
+SMOKER_CODE = 'F17.2'         # zaburzenia z powodu nikotyny
+NON_SMOKER_CODES = (
+    'Z87.7',                  # Wywiad osobniczy dotyczący palenia tytoniu
+    'Z58.7',                  # Narażenie na dym tytoniowy
+)
+# Diagnosis.smoking_marker of those codes, in the same order
+SMOKING_MARKERS = {SMOKER_CODE: 'smoker', **{code: 'non_smoker' for code in NON_SMOKER_CODES}}
+
+
+def smoking_status_from_codes(codes, patient_setting):
+    """Resolve (status, source) from a patient's diagnosis codes, falling back to the patient setting"""
+    # Priority 1: Smoker diagnosis
+    if SMOKER_CODE in codes:
+        return 'smoker', SMOKER_CODE
+
+    # Priority 2: Non-smoker diagnoses
+    for code in NON_SMOKER_CODES:
+        if code in codes:
+            return 'non_smoker', code
+
+    # Priority 3: Ex-smoker diagnoses (if we want to add them in the future)
+    # elif 'Z87.891' in codes:  # Personal history of nicotine dependence
+    #     return 'ex_smoker', 'diagnosis_Z87.891'
+
+    # Priority 4: User setting from model field
+    return patient_setting, 'patient_setting'
+
+
+# Accented letters folded to ASCII in Patient.search_name, in both cases so the
+# result does not depend on the database locale; fold_name() applies the same table
+_ACCENTED = 'ąćęłńóśźżáäâàãåčďéëêèěíïîìľĺňñöôòõőřŕšťúüûùůűýÿž'
+_UNACCENTED = 'acelnoszzaaaaaacdeeeeeiiiillnnooooorrstuuuuuuyyz'
+NAME_FOLD_FROM = _ACCENTED + _ACCENTED.upper()
+NAME_FOLD_TO = _UNACCENTED * 2
+_NAME_FOLD_TABLE = str.maketrans(NAME_FOLD_FROM, NAME_FOLD_TO)
+
+
+def fold_name(text: str) -> str:
+    """Lowercase ASCII form of a name, as stored in Patient.search_name"""
+    return text.translate(_NAME_FOLD_TABLE).lower()
+
+
+class PatientQuerySet(models.QuerySet):
+    """Per-patient aggregates as subquery annotations, so a page or chunk is one query"""
+
+    def with_latest_visit(self):
+        """latest_visit_id, latest_visit_date and latest_visit_quarter"""
+        visits = Visit.objects.filter(patient=OuterRef('pk')).order_by('-visit_date')
+        return self.annotate(
+            latest_visit_id=Subquery(visits.values('pk')[:1]),
+            latest_visit_date=Subquery(visits.values('visit_date')[:1]),
+            latest_visit_quarter=Subquery(visits.values('quarter')[:1]),
+        )
+
+    def search(self, query: str):
+        """Patients whose PESEL starts with `query` (all digits) or whose name contains every word of it.
+
+        Both are LIKE patterns served by indexes: the PESEL prefix by
+        patients_pesel_prefix_idx, the words by the trigram index on search_name.
+        """
+        query = query.strip()
+        if query.isdigit():
+            return self.filter(pesel__startswith=query)
+        return self.filter(*[Q(search_name__contains=word) for word in fold_name(query).split()])
+
+    def with_search_rank(self, query: str):
+        """search_rank: trigram similarity of the folded name to `query`"""
+        return self.annotate(search_rank=TrigramSimilarity('search_name', fold_name(query.strip())))
+
+
+def _latest_results():
+    """SCORE2 results of the patient (OuterRef), current one first"""
+    from score2.models import Score2Result
+    return Score2Result.objects.filter(patient=OuterRef('pk')).order_by('-visit__visit_date', '-created_at')
+
+
+def _count(queryset):
+    """Row count of a correlated queryset as a subquery (0 when empty)"""
+    return Coalesce(
+        Subquery(queryset.order_by().values('patient').annotate(n=Count('pk')).values('n')),
+        0,
+    )
+
 
 class Patient(models.Model):
     GENDER_CHOICES = [
@@ -23,6 +121,14 @@ class Patient(models.Model):
         validators=[RegexValidator(regex=r'^\d{11}$', message='PESEL musi zawierać 11 cyfr')]
     )
     full_name = models.CharField(max_length=200, blank=True, null=True)
+    # full_name lowercased without diacritics (fold_name), for indexed search
+    search_name = models.GeneratedField(
+        expression=Lower(Func(
+            Coalesce('full_name', Value('')), Value(NAME_FOLD_FROM), Value(NAME_FOLD_TO), function='translate'
+        )),
+        output_field=models.CharField(max_length=200),
+        db_persist=True,
+    )
     date_of_birth = models.DateField()
     gender = models.CharField(max_length=1, choices=GENDER_CHOICES)
     address = models.TextField(blank=True, null=True)
@@ -33,12 +139,61 @@ class Patient(models.Model):
     smoking_status = models.CharField(
         max_length=20, 
         choices=SMOKING_CHOICES, 
-        default='assumed_non_smoker'
+        default='assumed_non_smoker',
+        db_default='assumed_non_smoker',
+    )
+
+    # Derived from diagnoses; kept current by patients.signals, the import
+    # and the rebuild_clinical_flags command (see clinical_flag_expressions).
+    # NOT NULL columns also have database defaults, for the raw SQL of the CSV import.
+    has_diabetes = models.BooleanField(default=False, db_default=False, db_index=True)
+    diabetes_age_at_diagnosis = models.DecimalField(max_digits=5, decimal_places=2, blank=True, null=True)
+    effective_smoking_status = models.CharField(
+        max_length=20,
+        choices=SMOKING_CHOICES,
+        default='assumed_non_smoker',
+        db_default='assumed_non_smoker',
     )
+    smoking_info_source = models.CharField(max_length=20, default='patient_setting', db_default='patient_setting')
+
+    # Columns of the patient list, kept current like the flags above (see summary_expressions).
+    # current_* describe the current SCORE2 result, that of the latest scored visit;
+    # current_score_value is null when that calculation did not succeed.
+    visits_count = models.PositiveIntegerField(default=0, db_default=0)
+    score2_count = models.PositiveIntegerField(default=0, db_default=0)
+    current_score_value = models.DecimalField(max_digits=5, decimal_places=2, blank=True, null=True)
+    current_score_type = models.CharField(max_length=20, blank=True, null=True)
+    current_risk_level = models.CharField(max_length=20, blank=True, null=True)
+    current_score_visit_date = models.DateField(blank=True, null=True)
+    score_computed_at = models.DateTimeField(blank=True, null=True)
+    # Last change to the visits or diagnoses SCORE2 is computed from; the
+    # recompute only rescores patients changed since their stored result
+    inputs_changed_at = models.DateTimeField(blank=True, null=True)
+
+    objects = PatientQuerySet.as_manager()
     
     class Meta:
         db_table = 'patients'
         ordering = ['full_name', 'pesel']
+        indexes = [
+            # Sort and keyset of the patient list (patients.pagination.LIST_ORDERING)
+            models.Index(
+                F('current_score_value').desc(nulls_last=True), F('updated_at').desc(), F('id').desc(),
+                name='patients_score_order_idx',
+            ),
+            # Risk-level recall lists in the same order, so the filtered list is one range scan
+            models.Index(
+                F('current_risk_level'), F('current_score_value').desc(nulls_last=True), F('updated_at').desc(),
+                F('id').desc(),
+                name='patients_risk_order_idx',
+            ),
+            # Patients due for recalculation, oldest score first
+            models.Index(fields=['current_score_visit_date', 'id'], name='patients_score_visit_idx'),
+            # PESEL prefix search (LIKE '7203%') regardless of the database collation
+            models.Index(OpClass('pesel', name='varchar_pattern_ops'), name='patients_pesel_prefix_idx'),
+            # Name search (LIKE '%kowal%') and similarity ranking
+            GinIndex(OpClass('search_name', name='gin_trgm_ops'), name='patients_search_name_trgm'),
+        ]
     
     def __str__(self):
         return f"{self.full_name or self.pesel} ({self.pesel})"
@@ -59,68 +214,169 @@ class Patient(models.Model):
         """Get the most recent visit for this patient"""
         return self.visits.order_by('-visit_date').first()
     
-    def has_diabetes(self) -> bool:
-        codes = ['E10', 'E11', 'E13', 'E14']
-        q = Q()
-        for c in codes:
-            q |= Q(chronic_diagnoses__diagnosis_code__startswith=c)
-            q |= Q(visits__diagnoses__diagnosis_code__startswith=c)
-        return self.__class__.objects.filter(pk=self.pk).filter(q).exists()
-    
-    def get_diabetes_age_at_diagnosis(self):
-        """Get age at first diabetes diagnosis"""
-        diabetes_codes = ['E10', 'E11', 'E13', 'E14']
-
-        # Build a Q that matches any diagnosis_code starting with one of the codes
-        prefix_q = Q()
-        for c in diabetes_codes:
-            prefix_q |= Q(diagnosis_code__startswith=c)
-
-        # Now filter chronic_diagnoses using that Q plus age_at_diagnosis not null
-        chronic_dx = (
-            self.chronic_diagnoses
-                .filter(prefix_q, age_at_diagnosis__isnull=False)
-                .order_by('diagnosed_at')
-                .first()
-        )
+    def save(self, *args, **kwargs):
+        # Without a smoking diagnosis the effective status follows the setting
+        if self.smoking_info_source == 'patient_setting':
+            self.effective_smoking_status = self.smoking_status
+            update_fields = kwargs.get('update_fields')
+            if update_fields is not None and 'smoking_status' in update_fields:
+                kwargs['update_fields'] = {*update_fields, 'effective_smoking_status'}
+        super().save(*args, **kwargs)
+
+    def refresh_clinical_flags(self):
+        """Recompute the stored clinical flags from the database and reload them"""
+        refresh_clinical_flags(Patient.objects.filter(pk=self.pk))
+        self.refresh_from_db(fields=CLINICAL_FLAG_FIELDS)
+
+
+CLINICAL_FLAG_FIELDS = ['has_diabetes', 'diabetes_age_at_diagnosis', 'effective_smoking_status', 'smoking_info_source']
+
+
+def _has_diagnosis(**diagnosis_codes):
+    """Condition: the patient (OuterRef) has a chronic or visit diagnosis matching the lookup"""
+    return (
+        Exists(PatientDiagnosis.objects.filter(patient=OuterRef('pk'), **diagnosis_codes))
+        | Exists(VisitDiagnosis.objects.filter(visit__patient=OuterRef('pk'), **diagnosis_codes))
+    )
+
+
+def _smoking_diagnoses():
+    """Smoking-marked Diagnosis rows of the patient (OuterRef) in priority order, SMOKER_CODE first"""
+    priority = list(SMOKING_MARKERS)
+    return Diagnosis.objects.exclude(smoking_marker='').filter(
+        Exists(PatientDiagnosis.objects.filter(patient=OuterRef(OuterRef('pk')), diagnosis_code=OuterRef('code')))
+        | Exists(VisitDiagnosis.objects.filter(visit__patient=OuterRef(OuterRef('pk')), diagnosis_code=OuterRef('code')))
+    ).order_by(
+        Case(*[When(code=code, then=Value(i)) for i, code in enumerate(priority)], default=Value(len(priority))),
+        'code',
+    )
+
+
+def clinical_flag_expressions() -> dict:
+    """Expressions computing CLINICAL_FLAG_FIELDS for patient querysets.
+
+    Same rules as PatientClinicalSnapshot: diabetes through the Diagnosis
+    flags, age from the oldest dated chronic diabetes diagnosis that has one,
+    smoking status from the highest-priority Diagnosis smoking marker,
+    falling back to the patient setting.
+    """
+    diabetes_codes = Diagnosis.objects.filter(is_diabetes=True).values('code')
+    smoking_diagnoses = _smoking_diagnoses()
+    return {
+        'has_diabetes': Case(
+            When(_has_diagnosis(diagnosis_code__in=diabetes_codes), then=Value(True)),
+            default=Value(False),
+        ),
+        'diabetes_age_at_diagnosis': Subquery(
+            PatientDiagnosis.objects.filter(
+                patient=OuterRef('pk'), diagnosis_code__in=diabetes_codes, age_at_diagnosis__isnull=False,
+            ).order_by('diagnosed_at').values('age_at_diagnosis')[:1]
+        ),
+        'effective_smoking_status': Coalesce(
+            Subquery(smoking_diagnoses.values('smoking_marker')[:1]), F('smoking_status'),
+        ),
+        'smoking_info_source': Coalesce(
+            Subquery(smoking_diagnoses.values('code')[:1]), Value('patient_setting'),
+        ),
+    }
 
-        if chronic_dx:
-            return float(chronic_dx.age_at_diagnosis)
-        return None
-    
-    def get_smoking_status(self):
-        """Determine smoking status based on diagnoses with priority over user setting"""
-        # Check diagnoses first
-        all_diagnoses = set()
-        chronic = self.chronic_diagnoses.values_list('diagnosis_code', flat=True)
-        all_diagnoses.update(chronic)
-        visit_dx = VisitDiagnosis.objects.filter(
-            visit__patient=self
-        ).values_list('diagnosis_code', flat=True)
-        all_diagnoses.update(visit_dx)
-        
-        # Priority 1: Smoker diagnosis (F17.2 - zaburzenia z powodu nikotyny)
-        if 'F17.2' in all_diagnoses:
-            return 'smoker', 'F17.2'
-        
-        # Priority 2: Non-smoker diagnoses
-        if 'Z87.7' in all_diagnoses:
-            return 'non_smoker', 'Z87.7'  # Wywiad osobniczy dotyczący palenia tytoniu
-        elif 'Z58.7' in all_diagnoses:
-            return 'non_smoker', 'Z58.7'  # Narażenie na dym tytoniowy
-        
-        # Priority 3: Ex-smoker diagnoses (if we want to add them in the future)
-        # elif 'Z87.891' in all_diagnoses:  # Personal history of nicotine dependence
-        #     return 'ex_smoker', 'diagnosis_Z87.891'
-        
-        # Priority 4: User setting from model field
-        return self.smoking_status, 'patient_setting'   
 
+def _is_distinct_from(lhs, rhs):
+    """Condition: lhs IS DISTINCT FROM rhs (inequality treating NULLs as equal)"""
+    return Func(lhs, rhs, template='%(expressions)s', arg_joiner=' IS DISTINCT FROM ',
+                output_field=models.BooleanField())
+
+
+def refresh_clinical_flags(patients) -> int:
+    """Recompute the clinical flags of a patient queryset with a single UPDATE.
+
+    Only patients whose flags differ are written, and as the flags are
+    SCORE2 inputs, only those are marked as changed (see mark_inputs_changed).
+    Returns the number of patients whose flags changed.
+    """
+    bump_data_version()
+    expressions = clinical_flag_expressions()
+    changed = Q(*[_is_distinct_from(F(name), value) for name, value in expressions.items()], _connector=Q.OR)
+    return patients.filter(changed).update(**expressions, inputs_changed_at=timezone.now())
+
+
+def mark_inputs_changed(patients) -> int:
+    """Record that the SCORE2 inputs of a patient queryset changed (visits, diagnoses)"""
+    return patients.update(inputs_changed_at=timezone.now())
+
+
+SUMMARY_FIELDS = [
+    'visits_count', 'score2_count', 'current_score_value', 'current_score_type', 'current_risk_level',
+    'current_score_visit_date', 'score_computed_at',
+]
+
+
+def summary_expressions() -> dict:
+    """Expressions computing SUMMARY_FIELDS: visit and result counts and the current score"""
+    from score2.models import Score2Result
+    current = _latest_results()
+    return {
+        'visits_count': _count(Visit.objects.filter(patient=OuterRef('pk'))),
+        'score2_count': _count(Score2Result.objects.filter(patient=OuterRef('pk'))),
+        'current_score_value': Subquery(current.values('score_value')[:1]),
+        'current_score_type': Subquery(current.values('score_type')[:1]),
+        'current_risk_level': Subquery(current.values('risk_level')[:1]),
+        'current_score_visit_date': Subquery(current.values('visit__visit_date')[:1]),
+        'score_computed_at': Subquery(current.values('updated_at')[:1]),
+    }
+
+
+def refresh_summary(patients) -> int:
+    """Recompute the list summary columns of a patient queryset with a single UPDATE"""
+    bump_data_version()
+    return patients.update(**summary_expressions())
+
+
+def diagnosis_flags(code: str) -> dict:
+    """Category flags of an ICD-10 code, as stored on Diagnosis"""
+    diabetes_type = DIABETES_TYPES.get(code[:3], '')
+    return {
+        'is_diabetes': bool(diabetes_type),
+        'diabetes_type': diabetes_type,
+        'smoking_marker': SMOKING_MARKERS.get(code, ''),
+    }
+
+
+def diagnosis_flags_sql(code: str) -> dict:
+    """SQL expressions of diagnosis_flags() for the SQL expression `code`, built from the same tables"""
+
+    def lookup(key: str, mapping: dict) -> str:
+        whens = ' '.join(f"WHEN '{value}' THEN '{result}'" for value, result in mapping.items())
+        return f"CASE {key} {whens} ELSE '' END"
+
+    diabetes_type = lookup(f'left({code}, 3)', DIABETES_TYPES)
+    return {
+        'is_diabetes': f"({diabetes_type}) <> ''",
+        'diabetes_type': diabetes_type,
+        'smoking_marker': lookup(code, SMOKING_MARKERS),
+    }
 
 
 class Diagnosis(models.Model):
+    DIABETES_TYPE_CHOICES = [
+        ('type1', 'Typ 1 (E10)'),
+        ('type2', 'Typ 2 (E11)'),
+        ('other', 'Inna określona (E13)'),
+        ('unspecified', 'Nieokreślona (E14)'),
+    ]
+
+    SMOKING_MARKER_CHOICES = [
+        ('smoker', 'Pali'),
+        ('non_smoker', 'Nie pali'),
+    ]
+
     code = models.CharField(max_length=10, unique=True, primary_key=True)
     description = models.TextField(blank=True, null=True)
+    # Precomputed from the code (diagnosis_flags) so clinical checks are equality lookups
+    is_diabetes = models.BooleanField(default=False, db_index=True)
+    diabetes_type = models.CharField(max_length=12, choices=DIABETES_TYPE_CHOICES, blank=True, default='')
+    smoking_marker = models.CharField(max_length=12, choices=SMOKING_MARKER_CHOICES, blank=True, default='',
+                                      db_index=True)
     
     class Meta:
         db_table = 'diagnoses'
@@ -129,6 +385,29 @@ class Diagnosis(models.Model):
     def __str__(self):
         return f"{self.code}: {self.description or 'Brak opisu'}"
 
+    @classmethod
+    def from_code(cls, code: str, description: str = None) -> 'Diagnosis':
+        """Unsaved instance with its flags set, for bulk_create"""
+        return cls(code=code, description=description, **diagnosis_flags(code))
+
+    @classmethod
+    def ensure(cls, code: str, known_codes: set = None):
+        """Create the dictionary row of a code if missing.
+
+        Codes in `known_codes` are skipped without a query; codes looked up
+        are added to it once the transaction commits.
+        """
+        if not code or (known_codes is not None and code in known_codes):
+            return
+        cls.objects.get_or_create(code=code)
+        if known_codes is not None:
+            transaction.on_commit(lambda: known_codes.add(code))
+
+    def save(self, *args, **kwargs):
+        for field, value in diagnosis_flags(self.code).items():
+            setattr(self, field, value)
+        super().save(*args, **kwargs)
+
 
 class PatientDiagnosis(models.Model):
     patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='chronic_diagnoses')
@@ -146,6 +425,11 @@ class PatientDiagnosis(models.Model):
     def __str__(self):
         return f"{self.patient.pesel} - {self.diagnosis_code}"
 
+    def save(self, *args, known_codes: set = None, **kwargs):
+        # The clinical flags are looked up through the dictionary row
+        Diagnosis.ensure(self.diagnosis_code, known_codes)
+        super().save(*args, **kwargs)
+
 
 class Visit(models.Model):
     patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='visits')
@@ -161,6 +445,9 @@ class Visit(models.Model):
     class Meta:
         db_table = 'visits'
         ordering = ['-visit_date']
+        constraints = [
+            models.UniqueConstraint(fields=['patient', 'visit_date'], name='visits_patient_visit_date_uniq'),
+        ]
     
     def __str__(self):
         return f"{self.patient.pesel} - {self.visit_date}"
@@ -198,4 +485,37 @@ class VisitDiagnosis(models.Model):
         unique_together = ['visit', 'diagnosis_code']
     
     def __str__(self):
-        return f"{self.visit.patient.pesel} ({self.visit.visit_date}) - {self.diagnosis_code}"
\ No newline at end of file
+        return f"{self.visit.patient.pesel} ({self.visit.visit_date}) - {self.diagnosis_code}"
+
+    def save(self, *args, known_codes: set = None, **kwargs):
+        Diagnosis.ensure(self.diagnosis_code, known_codes)
+        super().save(*args, **kwargs)
+
+
+class DataVersion(models.Model):
+    """Single-row counter of changes to patient data, used in cache keys"""
+    version = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'data_version'
+
+
+def data_version() -> int:
+    return DataVersion.objects.filter(pk=1).values_list('version', flat=True).first() or 0
+
+
+def _increment_data_version():
+    if not DataVersion.objects.filter(pk=1).update(version=F('version') + 1, updated_at=timezone.now()):
+        DataVersion.objects.get_or_create(pk=1, defaults={'version': 1})
+
+
+def bump_data_version():
+    """Invalidate everything cached under data_version() once the current transaction commits.
+
+    Scheduled once per transaction, after commit, so the row is not locked
+    for the length of an import and readers never cache uncommitted data.
+    """
+    if any(func is _increment_data_version for _, func, _ in connection.run_on_commit):
+        return
+    transaction.on_commit(_increment_data_version)
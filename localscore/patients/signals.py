@@ -0,0 +1,32 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import (
+    Patient, PatientDiagnosis, Visit, VisitDiagnosis, bump_data_version, mark_inputs_changed, refresh_clinical_flags,
+    refresh_summary,
+)
+
+
+@receiver([post_save, post_delete], sender=PatientDiagnosis)
+def patient_diagnosis_changed(sender, instance, **kwargs):
+    refresh_clinical_flags(Patient.objects.filter(pk=instance.patient_id))
+
+
+@receiver([post_save, post_delete], sender=VisitDiagnosis)
+def visit_diagnosis_changed(sender, instance, **kwargs):
+    # The visit may already be gone when deleted together with it
+    refresh_clinical_flags(Patient.objects.filter(
+        pk__in=Visit.objects.filter(pk=instance.visit_id).values('patient_id')
+    ))
+
+
+@receiver([post_save, post_delete], sender=Visit)
+def visit_changed(sender, instance, **kwargs):
+    patients = Patient.objects.filter(pk=instance.patient_id)
+    mark_inputs_changed(patients)
+    refresh_summary(patients)
+
+
+@receiver([post_save, post_delete], sender=Patient)
+def patient_changed(sender, instance, **kwargs):
+    bump_data_version()
@@ -0,0 +1,128 @@
+from collections import defaultdict
+from datetime import date
+from decimal import Decimal
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from django.db.models import BooleanField, DateField, DecimalField, Value
+
+from .models import (
+    Patient, Visit, PatientDiagnosis, VisitDiagnosis,
+    DIABETES_CODES, smoking_status_from_codes,
+)
+
+
+class ChronicDiagnosis:
+    """Lightweight row of PatientDiagnosis fields the scoring needs"""
+    __slots__ = ('code', 'diagnosed_at', 'age_at_diagnosis')
+
+    def __init__(self, code: str, diagnosed_at: Optional[date], age_at_diagnosis: Optional[Decimal]):
+        self.code = code
+        self.diagnosed_at = diagnosed_at
+        self.age_at_diagnosis = age_at_diagnosis
+
+
+class PatientClinicalSnapshot:
+    """In-memory view of a patient's visits and diagnoses.
+
+    Derives the same clinical flags that Patient stores (see
+    clinical_flag_expressions) from the loaded rows, plus the visit lookups
+    the SCORE2 fallbacks need, without further queries.
+    Use load() for one patient or load_many() for a chunk; both take two
+    queries regardless of the number of patients.
+    """
+
+    def __init__(self, patient: Patient, visits: Iterable[Visit],
+                 diagnosis_codes: Iterable[str], chronic_diagnoses: Iterable[ChronicDiagnosis]):
+        self.patient = patient
+        # Newest first, same as Visit.Meta.ordering
+        self.visits = sorted(visits, key=lambda v: v.visit_date, reverse=True)
+        self.diagnosis_codes = set(diagnosis_codes)
+        # Oldest diagnosis first, undated ones last (PostgreSQL ASC ordering)
+        self.chronic_diagnoses = sorted(
+            chronic_diagnoses,
+            key=lambda d: (d.diagnosed_at is None, d.diagnosed_at or date.min),
+        )
+
+    @classmethod
+    def load(cls, patient: Patient) -> 'PatientClinicalSnapshot':
+        return cls.load_many([patient])[patient.pk]
+
+    @classmethod
+    def load_many(cls, patients: Iterable[Patient]) -> Dict[int, 'PatientClinicalSnapshot']:
+        """Snapshots for a chunk of patients keyed by patient id"""
+        patients = list(patients)
+        by_id = {p.pk: p for p in patients}
+        if not by_id:
+            return {}
+
+        visits = defaultdict(list)
+        for visit in Visit.objects.filter(patient_id__in=list(by_id)):
+            visit.patient = by_id[visit.patient_id]
+            visits[visit.patient_id].append(visit)
+
+        codes = defaultdict(set)
+        chronic = defaultdict(list)
+        for patient_id, code, diagnosed_at, age_at_diagnosis, is_chronic in _diagnosis_rows(list(by_id)):
+            codes[patient_id].add(code)
+            if is_chronic:
+                chronic[patient_id].append(ChronicDiagnosis(code, diagnosed_at, age_at_diagnosis))
+
+        return {
+            patient_id: cls(patient, visits[patient_id], codes[patient_id], chronic[patient_id])
+            for patient_id, patient in by_id.items()
+        }
+
+    # Clinical flags
+
+    @property
+    def has_diabetes(self) -> bool:
+        return any(code.startswith(DIABETES_CODES) for code in self.diagnosis_codes)
+
+    def get_diabetes_age_at_diagnosis(self) -> Optional[float]:
+        """Age at first chronic diabetes diagnosis that has one recorded"""
+        for dx in self.chronic_diagnoses:
+            if dx.code.startswith(DIABETES_CODES) and dx.age_at_diagnosis is not None:
+                return float(dx.age_at_diagnosis)
+        return None
+
+    def get_smoking_status(self) -> Tuple[str, str]:
+        return smoking_status_from_codes(self.diagnosis_codes, self.patient.smoking_status)
+
+    # Visit lookups
+
+    @property
+    def latest_visit(self) -> Optional[Visit]:
+        return self.visits[0] if self.visits else None
+
+    def visit_on(self, visit_date: date) -> Optional[Visit]:
+        for visit in self.visits:
+            if visit.visit_date == visit_date:
+                return visit
+        return None
+
+    def previous_visits(self, visit_date: date, *fields: str, limit: int = 5) -> List[Visit]:
+        """Up to `limit` visits before `visit_date`, newest first, having all `fields` filled in"""
+        found = []
+        for visit in self.visits:
+            if visit.visit_date >= visit_date:
+                continue
+            if all(getattr(visit, f) is not None for f in fields):
+                found.append(visit)
+                if len(found) == limit:
+                    break
+        return found
+
+
+def _diagnosis_rows(patient_ids):
+    """(patient_id, code, diagnosed_at, age_at_diagnosis, is_chronic) for chronic and visit diagnoses"""
+    chronic = PatientDiagnosis.objects.filter(patient_id__in=patient_ids).order_by().values_list(
+        'patient_id', 'diagnosis_code', 'diagnosed_at', 'age_at_diagnosis',
+        Value(True, output_field=BooleanField()),
+    )
+    visit_dx = VisitDiagnosis.objects.filter(visit__patient_id__in=patient_ids).order_by().values_list(
+        'visit__patient_id', 'diagnosis_code',
+        Value(None, output_field=DateField()),
+        Value(None, output_field=DecimalField(max_digits=5, decimal_places=2)),
+        Value(False, output_field=BooleanField()),
+    )
+    return chronic.union(visit_dx, all=True)
@@ -0,0 +1,64 @@
+from datetime import date
+
+from dateutil.relativedelta import relativedelta
+from django.core.cache import cache
+from django.db.models import Count, Q
+
+from .models import Patient, data_version
+
+# Keys carry the data version and the date, so entries never go stale;
+# the timeout only bounds how long unused versions occupy the cache
+STATS_TIMEOUT = 60 * 60 * 24
+
+# Risk levels shown as cards in the patient list header
+EXCLUDED_RISK_LEVELS = ('not_applicable', 'age_out_of_range')
+
+
+def eligible_filter(today: date) -> Q:
+    """Patients aged 40-89, the SCORE2/SCORE2-OP range"""
+    return Q(
+        date_of_birth__gt=today - relativedelta(years=90),
+        date_of_birth__lte=today - relativedelta(years=40),
+    )
+
+
+def list_statistics_aggregates(today: date) -> dict:
+    """Count(filter=...) per header number, for a single aggregate() over patients"""
+    from score2.models import Score2Result
+    eligible = eligible_filter(today)
+    scored = eligible & Q(current_score_value__isnull=False)
+    aggregates = {
+        'total_patients': Count('pk'),
+        'eligible_patients': Count('pk', filter=eligible),
+        'patients_with_visits': Count('pk', filter=eligible & Q(visits_count__gt=0)),
+        'patients_with_scores': Count('pk', filter=scored),
+    }
+    for risk_level, _ in Score2Result.RISK_LEVEL_CHOICES:
+        if risk_level not in EXCLUDED_RISK_LEVELS:
+            aggregates[f'risk_{risk_level}'] = Count('pk', filter=scored & Q(current_risk_level=risk_level))
+    return aggregates
+
+
+def list_statistics() -> dict:
+    """Summary numbers of the patient list header, cached per data version and day"""
+    from score2.models import Score2Result
+    today = date.today()
+    key = f'patients:list_stats:{data_version()}:{today.isoformat()}'
+    stats = cache.get(key)
+    if stats is not None:
+        return stats
+
+    counts = Patient.objects.aggregate(**list_statistics_aggregates(today))
+    stats = {
+        'total_patients': counts['total_patients'],
+        'eligible_patients': counts['eligible_patients'],
+        'patients_with_visits': counts['patients_with_visits'],
+        'patients_with_scores': counts['patients_with_scores'],
+        'risk_level_stats': {
+            risk_level: {'count': counts[f'risk_{risk_level}'], 'display_name': display_name}
+            for risk_level, display_name in Score2Result.RISK_LEVEL_CHOICES
+            if risk_level not in EXCLUDED_RISK_LEVELS
+        },
+    }
+    cache.set(key, stats, STATS_TIMEOUT)
+    return stats
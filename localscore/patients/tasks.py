@@ -0,0 +1,18 @@
+from score2.reference import schedule_refresh
+from score2.stats import schedule_statistics_refresh
+from .copy_import import CSV_EXTENSIONS, import_csv
+from .importing import import_excel
+
+
+def import_file(job):
+    """Background job: import the Excel or CSV/TSV file uploaded with the job, streamed from storage"""
+    filename = job.params.get('filename', '')
+    progress = lambda done, total: job.set_progress(done, total)
+    with job.upload.open('rb') as fileobj:
+        if filename.lower().endswith(CSV_EXTENSIONS):
+            results = import_csv(fileobj, filename, progress=progress)
+        else:
+            results = import_excel(fileobj, filename, progress=progress)
+    schedule_refresh()
+    schedule_statistics_refresh()
+    return results
@@ -1,3 +1,560 @@
-from django.test import TestCase
+from datetime import date, datetime, timezone
+from decimal import Decimal
+import io
+import os
+import tempfile
+from unittest import mock
 
-# Create your tests here.
+import openpyxl
+
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection, transaction
+from django.test import SimpleTestCase, TestCase
+from django.urls import reverse
+from jobs.models import BackgroundJob
+from jobs.runner import run_job
+from score2.models import Score2Result
+
+from .models import (
+    CLINICAL_FLAG_FIELDS, NAME_FOLD_FROM, NAME_FOLD_TO, Diagnosis, Patient, PatientDiagnosis, Visit, VisitDiagnosis,
+    clinical_flag_expressions, diagnosis_flags, diagnosis_flags_sql, fold_name,
+)
+from .pagination import LIST_ORDERING, decode_cursor, encode_cursor, keyset_page
+from .snapshot import ChronicDiagnosis, PatientClinicalSnapshot
+from .stats import list_statistics, list_statistics_aggregates
+from . import autocomplete
+from .copy_import import import_csv, sniff_format
+from .detail import score_requirements, score_stats, visit_rows
+from .importing import (
+    COLS, REJECT_NO_PESEL, REJECT_PESEL_CHECKSUM, REJECT_PESEL_DATE, REJECT_PESEL_FORMAT, RejectedRows,
+    import_chunk, import_excel, import_groups, iter_patient_groups, read_rows,
+)
+
+
+def _snapshot(visits=(), codes=(), chronic=(), smoking_status='assumed_non_smoker'):
+    patient = Patient(pk=1, pesel='72031512345', date_of_birth=date(1972, 3, 15), gender='M',
+                      smoking_status=smoking_status)
+    visits = [Visit(patient=patient, visit_date=d, **values) for d, values in visits]
+    return PatientClinicalSnapshot(patient, visits, codes, chronic)
+
+
+class PatientClinicalSnapshotTests(SimpleTestCase):
+
+    def test_diabetes_flags(self):
+        snapshot = _snapshot(
+            codes={'I10', 'E11.9'},
+            chronic=[
+                ChronicDiagnosis('E11.9', None, Decimal('40.00')),
+                ChronicDiagnosis('E11.9', date(2015, 1, 1), Decimal('42.00')),
+                ChronicDiagnosis('I10', date(2010, 1, 1), Decimal('37.00')),
+            ],
+        )
+        self.assertTrue(snapshot.has_diabetes)
+        # Oldest dated diagnosis wins, undated ones sort last
+        self.assertEqual(snapshot.get_diabetes_age_at_diagnosis(), 42.0)
+        self.assertFalse(_snapshot(codes={'E78.0'}).has_diabetes)
+
+    def test_smoking_status_priority(self):
+        self.assertEqual(_snapshot(codes={'Z87.7', 'F17.2'}).get_smoking_status(), ('smoker', 'F17.2'))
+        self.assertEqual(_snapshot(codes={'Z58.7', 'Z87.7'}).get_smoking_status(), ('non_smoker', 'Z87.7'))
+        self.assertEqual(_snapshot(smoking_status='smoker').get_smoking_status(), ('smoker', 'patient_setting'))
+
+    def test_diagnosis_flags_match_code_rules(self):
+        self.assertEqual(diagnosis_flags('E11.9'),
+                         {'is_diabetes': True, 'diabetes_type': 'type2', 'smoking_marker': ''})
+        self.assertEqual(Diagnosis.from_code('E10').diabetes_type, 'type1')
+        self.assertFalse(diagnosis_flags('E16.0')['is_diabetes'])
+        self.assertEqual(diagnosis_flags('F17.2')['smoking_marker'], 'smoker')
+        self.assertEqual(diagnosis_flags('Z58.7')['smoking_marker'], 'non_smoker')
+        # Smoking markers are exact codes, not prefixes
+        self.assertEqual(diagnosis_flags('F17.20')['smoking_marker'], '')
+
+    def test_clinical_flag_expressions_cover_stored_fields(self):
+        self.assertEqual(list(clinical_flag_expressions()), CLINICAL_FLAG_FIELDS)
+        for field in CLINICAL_FLAG_FIELDS:
+            Patient._meta.get_field(field)
+
+    def test_visit_lookups(self):
+        snapshot = _snapshot(visits=[
+            (date(2024, 1, 10), {'systolic_pressure': 150}),
+            (date(2025, 6, 1), {}),
+            (date(2023, 5, 5), {'systolic_pressure': 140}),
+            (date(2022, 5, 5), {'systolic_pressure': 135, 'cholesterol_total': Decimal('5.2')}),
+        ])
+        self.assertEqual(snapshot.latest_visit.visit_date, date(2025, 6, 1))
+        self.assertEqual(snapshot.visit_on(date(2023, 5, 5)).systolic_pressure, 140)
+        self.assertIsNone(snapshot.visit_on(date(2020, 1, 1)))
+
+        previous = snapshot.previous_visits(date(2025, 6, 1), 'systolic_pressure')
+        self.assertEqual([v.visit_date.year for v in previous], [2024, 2023, 2022])
+        self.assertEqual(len(snapshot.previous_visits(date(2025, 6, 1), 'systolic_pressure', limit=2)), 2)
+        previous = snapshot.previous_visits(date(2025, 6, 1), 'systolic_pressure', 'cholesterol_total')
+        self.assertEqual([v.visit_date.year for v in previous], [2022])
+
+    def test_score2_fallbacks_use_snapshot(self):
+        from score2.views import CalculateScore2View
+
+        snapshot = _snapshot(visits=[
+            (date(2025, 6, 1), {'cholesterol_total': Decimal('5.5')}),
+            (date(2024, 1, 10), {'systolic_pressure': 150, 'cholesterol_total': Decimal('5.9'),
+                                 'cholesterol_hdl': Decimal('1.2')}),
+        ])
+        view = CalculateScore2View()
+        self.assertEqual(view._get_systolic_pressure(snapshot, date(2025, 6, 1)),
+                         (150, 'poprzednia wizyta (2024-01-10)'))
+        self.assertEqual(view._get_cholesterol_values(snapshot, date(2025, 6, 1)),
+                         (5.9, 1.2, 'poprzednia wizyta (2024-01-10)', 'previous_visit'))
+
+
+class PatientDetailContextTests(SimpleTestCase):
+
+    def test_visit_rows_and_score_stats(self):
+        snapshot = _snapshot(visits=[
+            (date(2023, 5, 1), {'pk': 1}), (date(2024, 5, 1), {'pk': 2}), (date(2025, 5, 1), {'pk': 3}),
+        ])
+        results = [
+            Score2Result(visit_id=1, is_calculation_successful=True, score_value=Decimal('4.00')),
+            Score2Result(visit_id=2, is_calculation_successful=False, score_value=None),
+            Score2Result(visit_id=3, is_calculation_successful=True, score_value=Decimal('7.00')),
+        ]
+        rows = visit_rows(snapshot.patient, snapshot.visits, results)
+        self.assertEqual([row['visit'].pk for row in rows], [3, 2, 1])
+        self.assertEqual([row['age'] for row in rows], [53, 52, 51])
+        self.assertIs(rows[1]['score'], results[1])
+
+        stats = score_stats(results)
+        self.assertEqual((stats['count'], stats['trend'], stats['trend_direction']), (2, 3.0, 'up'))
+        self.assertEqual(stats['average_score'], Decimal('5.5'))
+        self.assertIsNone(score_stats(results[:2]))
+
+    def test_score_requirements(self):
+        snapshot = _snapshot(visits=[(date(2025, 5, 1), {'systolic_pressure': 140, 'cholesterol_total': 5.2})])
+        possible, missing, sources = score_requirements(
+            snapshot.patient, snapshot.latest_visit, True, None, 'smoker', 'F17.2'
+        )
+        self.assertEqual(possible, [])
+        self.assertEqual(sources['SCORE2']['missing'], ['cholesterol HDL'])
+        self.assertEqual(sources['SCORE2-Diabetes']['missing'],
+                         ['cholesterol HDL', 'hemoglobina glikowana (HbA1c)', 'eGFR', 'wiek przy diagnozie cukrzycy'])
+        self.assertEqual(score_requirements(snapshot.patient, None, False, None, '', ''), ([], [], {}))
+
+
+def _patient(pesel, born, **fields):
+    return Patient.objects.create(pesel=pesel, date_of_birth=born, gender='M', **fields)
+
+
+class PatientListStatisticsTests(TestCase):
+
+    def setUp(self):
+        _patient('60010100011', date(1960, 1, 1), visits_count=2,
+                 current_score_value=Decimal('5.00'), current_risk_level='low_to_moderate')
+        _patient('50010100012', date(1950, 1, 1), visits_count=1,
+                 current_score_value=Decimal('20.00'), current_risk_level='very_high')
+        # Failed calculation: no value, so not counted as scored
+        _patient('70010100013', date(1970, 1, 1), visits_count=1, current_risk_level='high')
+        # Outside the 40-89 range
+        _patient('90010100014', date(1990, 1, 1), visits_count=1,
+                 current_score_value=Decimal('3.00'), current_risk_level='low_to_moderate')
+        _patient('30010100015', date(1930, 1, 1))
+
+    def test_header_numbers_come_from_one_aggregate(self):
+        with self.assertNumQueries(1):
+            counts = Patient.objects.aggregate(**list_statistics_aggregates(date(2025, 6, 1)))
+        self.assertEqual(counts, {
+            'total_patients': 5, 'eligible_patients': 3, 'patients_with_visits': 3, 'patients_with_scores': 2,
+            'risk_low_to_moderate': 1, 'risk_high': 0, 'risk_very_high': 1,
+        })
+
+    def test_cached_per_data_version(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        # data version + aggregate, then the data version only
+        with self.assertNumQueries(2):
+            stats = list_statistics()
+        with self.assertNumQueries(1):
+            self.assertEqual(list_statistics(), stats)
+        self.assertEqual(stats['patients_with_scores'], 2)
+        self.assertEqual(stats['risk_level_stats']['very_high']['count'], 1)
+
+
+class PatientListPaginationTests(TestCase):
+
+    def test_cursor_round_trip(self):
+        updated_at = datetime(2025, 3, 1, 12, 30, 15, 123456, tzinfo=timezone.utc)
+        scored = Patient(pk=7, current_score_value=Decimal('12.50'), updated_at=updated_at)
+        self.assertEqual(decode_cursor(encode_cursor(scored)), (Decimal('12.50'), updated_at, 7))
+        unscored = Patient(pk=8, current_score_value=None, updated_at=updated_at)
+        self.assertEqual(decode_cursor(encode_cursor(unscored)), (None, updated_at, 8))
+        for cursor in ('', 'xyz', encode_cursor(scored)[:-3]):
+            with self.assertRaises(ValueError):
+                decode_cursor(cursor)
+
+    def test_pages_follow_list_ordering_across_unscored_patients(self):
+        for i, value in enumerate(['4.00', '9.50', None, '4.00', None, '12.00', None, '1.00', None]):
+            _patient(f'{i:011d}', date(1960, 1, 1), current_score_value=value and Decimal(value))
+        expected = list(Patient.objects.order_by(*LIST_ORDERING).values_list('pk', flat=True))
+
+        seen, cursor = [], None
+        while True:
+            page = keyset_page(Patient.objects.all(), cursor, 2)
+            seen += [patient.pk for patient in page.object_list]
+            self.assertEqual((page.count, page.count_is_exact), (9, True))
+            if not page.has_next:
+                break
+            cursor = page.next_cursor
+        self.assertEqual(seen, expected)
+
+
+class PatientSearchTests(TestCase):
+
+    def setUp(self):
+        self.lukasz = _patient('72031512344', date(1972, 3, 15), full_name='ŁUKASZ Źdźbło-Wężyk')
+        self.jan = _patient('44010100019', date(1944, 1, 1), full_name='Jan Kowalski')
+        self.anna = _patient('55020200020', date(1955, 2, 2), full_name='Anna Kowalska')
+
+    def test_fold_name(self):
+        self.assertEqual(fold_name('ŁUKASZ Źdźbło-Wężyk'), 'lukasz zdzblo-wezyk')
+        self.assertEqual(fold_name('Müller Jörg'), 'muller jorg')
+        self.assertEqual(len(NAME_FOLD_FROM), len(NAME_FOLD_TO))
+
+    def test_name_words_and_pesel_prefix(self):
+        def found(query):
+            return set(Patient.objects.search(query))
+
+        self.assertEqual(found('kowal'), {self.jan, self.anna})
+        self.assertEqual(found('zdzblo ŁUK'), {self.lukasz})
+        self.assertEqual(found('kowalski anna'), set())
+        self.assertEqual(found('4401'), {self.jan})
+        ranked = Patient.objects.search('kowalski').with_search_rank('kowalski jan').order_by('-search_rank')
+        self.assertEqual(ranked.first(), self.jan)
+
+
+class PatientAutocompleteTests(TestCase):
+
+    def setUp(self):
+        autocomplete.clear_cache()
+        self.addCleanup(autocomplete.clear_cache)
+
+    def test_cache_is_keyed_by_data_version(self):
+        with mock.patch.object(autocomplete, '_query', return_value=[{'id': 1}]) as query, \
+                mock.patch.object(autocomplete, 'data_version', return_value=3) as version:
+            self.assertEqual(autocomplete.search_patients('Kowal'), [{'id': 1}])
+            autocomplete.search_patients('  kowal ')
+            self.assertEqual(query.call_count, 1)
+            version.return_value = 4
+            autocomplete.search_patients('Kowal')
+            self.assertEqual(query.call_count, 2)
+            self.assertEqual(autocomplete.search_patients('K'), [])
+            self.assertEqual(query.call_count, 2)
+
+    def test_hits_come_from_one_query_then_the_cache(self):
+        jan = _patient('44010100019', date(1944, 1, 1), full_name='Jan Kowalski')
+        _patient('55020200020', date(1955, 2, 2), full_name='Anna Nowak')
+        # data version + search, then the data version only
+        with self.assertNumQueries(2):
+            hits = autocomplete.search_patients('kowal')
+        self.assertEqual([(hit['id'], hit['text']) for hit in hits], [(jan.pk, 'Jan Kowalski (44010100019)')])
+        with self.assertNumQueries(1):
+            self.assertEqual(autocomplete.search_patients('Kowal'), hits)
+
+
+def _workbook(rows, headers=tuple(COLS)):
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet.append(list(headers))
+    for row in rows:
+        sheet.append([row.get(field) for field in COLS.values()])
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    buffer.seek(0)
+    return buffer
+
+
+class StreamingImportTests(SimpleTestCase):
+
+    def test_rows_are_mapped_and_cleaned(self):
+        # Header spelling differs from COLS only in case/diacritics
+        headers = [h.lower().replace('Ł', 'L') for h in COLS]
+        buffer = _workbook([
+            {'pesel': 72031512344, 'dob': datetime(1972, 3, 15), 'visit_date': '05.06.2025',
+             'systolic_pressure': 140},
+            {'pesel': None, 'visit_date': '01.01.2025'},
+        ], headers)
+        rows, total = read_rows(buffer, 'export.xlsx')
+        rows = list(rows)
+        self.assertEqual(total, 2)
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0].pesel, '72031512344')
+        self.assertEqual(rows[0].dob, date(1972, 3, 15))
+        self.assertEqual(rows[0].visit_date, date(2025, 6, 5))
+        self.assertEqual(rows[0].systolic_pressure, 140)
+
+    def test_missing_columns(self):
+        rows, _ = read_rows(_workbook([], headers=list(COLS)[:-1]), 'export.xlsx')
+        with self.assertRaisesMessage(ValueError, 'cholesterol_hdl'):
+            list(rows)
+
+    def test_groups_are_chunked_and_marked_as_continuation(self):
+        a, b, c = '44010100019', '55020200020', '66030300031'
+        rows, _ = read_rows(_workbook([{'pesel': p} for p in [a, a, b, c, c, a]]), 'export.xlsx')
+        chunks = list(iter_patient_groups(rows, chunk_size=2))
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 2])
+        groups = [(g.pesel, len(g.rows), g.continuation) for chunk in chunks for g in chunk]
+        self.assertEqual(groups, [(a, 2, False), (b, 1, False), (c, 2, False), (a, 1, True)])
+
+    def test_values_derived_from_pesel(self):
+        rows, _ = read_rows(_workbook([
+            # 2000s birth in a numeric cell that lost its leading zero
+            {'pesel': 2220812348, 'chronic_dx_date': '07.02.2012'},
+            {'pesel': '72031512344', 'dob': '20.03.1972', 'chronic_dx_date': date(2000, 3, 20)},
+        ]), 'export.xlsx')
+        first, second = rows
+        self.assertEqual((first.pesel, first.dob, first.gender), ('02220812348', date(2002, 2, 8), 'F'))
+        self.assertEqual(first.age_at_diagnosis, 9)
+        # The date of birth from the file wins over the PESEL
+        self.assertEqual((second.dob, second.age_at_diagnosis), (date(1972, 3, 20), 28))
+
+    def test_invalid_pesels_are_rejected(self):
+        rejected = RejectedRows()
+        rows, _ = read_rows(_workbook([
+            {'pesel': '72031512345'},
+            {'pesel': '85130112340'},
+            {'pesel': 'X123'},
+            {'full_name': 'Jan Kowalski'},
+            {},
+            {'pesel': '44010100019'},
+        ]), 'export.xlsx', rejected)
+        self.assertEqual([row.pesel for row in rows], ['44010100019'])
+        self.assertEqual(rejected.total, 4)
+        self.assertEqual([(r['row'], r['reason']) for r in rejected.rows], [
+            (2, REJECT_PESEL_CHECKSUM), (3, REJECT_PESEL_DATE), (4, REJECT_PESEL_FORMAT), (5, REJECT_NO_PESEL),
+        ])
+
+    def test_csv_format_is_sniffed(self):
+        header = ';'.join(COLS)
+        delimiter, encoding, fields = sniff_format(('﻿' + header + '\n1;2\n').encode('utf-8'), 'export.csv')
+        self.assertEqual((delimiter, encoding), (';', 'UTF8'))
+        self.assertEqual(fields, list(COLS))
+
+        delimiter, encoding, fields = sniff_format(header.replace(';', '\t').encode('cp1250'), 'export.txt')
+        self.assertEqual((delimiter, encoding), ('\t', 'WIN1250'))
+        self.assertEqual(fields, list(COLS))
+
+
+class ImportJobTests(TestCase):
+
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        override = self.settings(MEDIA_ROOT=media.name)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def test_upload_is_streamed_from_storage_and_removed(self):
+        upload = SimpleUploadedFile('export.xlsx', _workbook([
+            {'pesel': '72031512344', 'visit_date': '05.06.2025', 'systolic_pressure': 140},
+        ]).getvalue())
+        response = self.client.post(reverse('patients:import_data'), {'file': upload})
+        job = BackgroundJob.objects.get(pk=response.json()['job_id'])
+        path = job.upload.path
+        self.assertTrue(os.path.exists(path))
+
+        run_job(BackgroundJob.claim_next())
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'succeeded', job.error)
+        self.assertEqual(job.result['patients_processed'], 1)
+        self.assertFalse(job.upload)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(Patient.objects.get(pesel='72031512344').visits_count, 1)
+
+
+def _csv(rows, delimiter=';'):
+    lines = [delimiter.join(COLS)]
+    for row in rows:
+        lines.append(delimiter.join(str(row.get(field, '')) for field in COLS.values()))
+    return io.BytesIO(('\n'.join(lines) + '\n').encode('utf-8'))
+
+
+class CsvImportTests(TestCase):
+
+    def test_sql_diagnosis_flags_match_diagnosis_flags(self):
+        codes = ['E11.9', 'E10', 'E14.1', 'F17.2', 'F17.20', 'Z87.7', 'Z58.7', 'I10']
+        flags = diagnosis_flags_sql('code')
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT code, {', '.join(flags.values())} FROM unnest(%s::text[]) AS code", [codes])
+            stored = {code: dict(zip(flags, values)) for code, *values in cursor.fetchall()}
+        self.assertEqual(stored, {code: diagnosis_flags(code) for code in codes})
+
+    def test_impossible_dates_become_null(self):
+        results = import_csv(_csv([
+            {'pesel': '72031512344', 'dob': '15.03.1972', 'visit_date': '2023-02-30',
+             'chronic_dx': 'I10', 'chronic_dx_date': '31.02.2020', 'last_chronic_visit': '2020-13-01'},
+            {'pesel': '44010100019', 'dob': '1944-01-01', 'visit_date': '05/06/2025'},
+        ]), 'export.csv')
+        self.assertEqual((results['patients_processed'], results['visits_processed']), (2, 1))
+        diagnosis = PatientDiagnosis.objects.get(patient__pesel='72031512344')
+        self.assertIsNone(diagnosis.diagnosed_at)
+        self.assertIsNone(diagnosis.last_visit_with_condition)
+        self.assertFalse(Visit.objects.filter(patient__pesel='72031512344').exists())
+        self.assertEqual(Visit.objects.get(patient__pesel='44010100019').visit_date, date(2025, 6, 5))
+
+    def test_pesels_are_normalized_and_checked_like_the_excel_import(self):
+        rows = [
+            {'pesel': '2220812348', 'visit_date': '05.06.2025'},
+            {'pesel': '02220812348', 'chronic_dx': 'I10'},
+            {'pesel': '72031512345'},
+            {'pesel': '85130112340'},
+            {'pesel': 'X123'},
+            {'full_name': 'Jan Kowalski'},
+            {},
+        ]
+        csv_results = import_csv(_csv(rows), 'export.csv')
+        patient = Patient.objects.get()
+        self.assertEqual((patient.pesel, patient.date_of_birth, patient.gender), ('02220812348', date(2002, 2, 8), 'F'))
+        self.assertEqual(patient.chronic_diagnoses.count(), 1)
+
+        excel_results = import_excel(_workbook(rows), 'export.xlsx')
+        self.assertEqual(csv_results['rejected'], excel_results['rejected'])
+        self.assertEqual(csv_results['rows_rejected'], 4)
+        self.assertEqual(Patient.objects.count(), 1)
+
+
+# An existing patient (visit and chronic diagnosis already stored) reappears
+# further down the file; the other two are new, one with an unknown code
+IMPORT_ROWS = [
+    {'pesel': '72031512344', 'address': 'Nowa 2', 'visit_date': '05.06.2025', 'systolic_pressure': 140,
+     'visit_dx': 'I10, E11.9', 'chronic_dx': 'E11.9', 'chronic_dx_date': '01.01.2015'},
+    {'pesel': '72031512344', 'chronic_dx': 'I10', 'last_chronic_visit': '01.05.2025'},
+    {'pesel': '44010100019', 'full_name': 'Jan Kowalski', 'visit_date': '01.02.2025', 'systolic_pressure': 130,
+     'cholesterol_total': '5.2', 'cholesterol_hdl': '1.3', 'visit_dx': 'Z99.X1', 'chronic_dx': 'F17.2'},
+    {'pesel': '02220812348', 'visit_date': '03.03.2025'},
+    {'pesel': '72031512344', 'chronic_dx': 'E78.0', 'chronic_dx_date': '01.01.2018'},
+]
+
+
+def _existing_patient():
+    patient = _patient('72031512344', date(1972, 3, 15), full_name='Anna Nowak', address='Stara 1',
+                       phone_mobile='500100200')
+    Visit.objects.create(patient=patient, visit_date=date(2025, 6, 5), systolic_pressure=150)
+    Diagnosis.ensure('I10')
+    PatientDiagnosis.objects.create(patient=patient, diagnosis_code='I10', diagnosed_at=date(2010, 1, 1),
+                                    age_at_diagnosis=Decimal('37.00'))
+
+
+def _import_state():
+    """Everything an import writes, in a comparable form"""
+    return {
+        'patients': list(Patient.objects.order_by('pesel').values_list(
+            'pesel', 'full_name', 'date_of_birth', 'gender', 'address', 'phone_mobile', 'phone_landline',
+            'has_diabetes', 'effective_smoking_status', 'visits_count')),
+        'visits': list(Visit.objects.order_by('patient__pesel', 'visit_date').values_list(
+            'patient__pesel', 'visit_date', 'quarter', 'systolic_pressure', 'cholesterol_total', 'cholesterol_hdl')),
+        'visit_diagnoses': list(VisitDiagnosis.objects.order_by('visit__patient__pesel', 'diagnosis_code').values_list(
+            'visit__patient__pesel', 'diagnosis_code')),
+        'chronic': list(PatientDiagnosis.objects.order_by('patient__pesel', 'diagnosis_code').values_list(
+            'patient__pesel', 'diagnosis_code', 'diagnosed_at', 'last_visit_with_condition', 'age_at_diagnosis')),
+        'diagnoses': list(Diagnosis.objects.order_by('code').values_list(
+            'code', 'is_diabetes', 'diabetes_type', 'smoking_marker')),
+    }
+
+
+def _rolled_back(run):
+    """Call run(), returning its result and the import state; the writes are discarded"""
+    with transaction.atomic():
+        results = run()
+        state = _import_state()
+        transaction.set_rollback(True)
+    return results, state
+
+
+class ImportMergeTests(TestCase):
+    """The chunked and CSV imports must write what the per-patient path writes"""
+
+    def setUp(self):
+        _existing_patient()
+
+    def test_chunk_matches_per_patient_import(self):
+        known_codes = set(Diagnosis.objects.values_list('code', flat=True))
+        rows, _ = read_rows(_workbook(IMPORT_ROWS), 'export.xlsx')
+        (groups,) = iter_patient_groups(rows, chunk_size=10)
+        self.assertEqual([group.continuation for group in groups], [False, False, False, True])
+
+        chunk_results, chunk_state = _rolled_back(lambda: import_chunk(groups, set(known_codes)))
+        row_results, row_state = _rolled_back(lambda: import_groups(groups, set(known_codes)))
+        self.assertEqual(chunk_results, row_results)
+        self.assertEqual(chunk_state, row_state)
+
+        self.assertEqual(chunk_results, {'patients_processed': 3, 'visits_processed': 2, 'diagnoses_processed': 3})
+        anna = chunk_state['patients'][-1]
+        # Contact data is updated, the stored visit is left as it was
+        self.assertEqual(anna[4:6], ('Nowa 2', '500100200'))
+        self.assertTrue(anna[7])
+        self.assertEqual(anna[9], 1)
+        self.assertIn(('72031512344', date(2025, 6, 5), '2025H2', 150, None, None), chunk_state['visits'])
+        self.assertIn(('72031512344', 'I10', date(2010, 1, 1), date(2025, 5, 1), Decimal('37.00')),
+                      chunk_state['chronic'])
+        self.assertIn(('Z99.X1', False, '', ''), chunk_state['diagnoses'])
+
+    def test_csv_merge_matches_excel_import(self):
+        csv_results, csv_state = _rolled_back(lambda: import_csv(_csv(IMPORT_ROWS), 'export.csv'))
+        excel_results, excel_state = _rolled_back(lambda: import_excel(_workbook(IMPORT_ROWS), 'export.xlsx'))
+        self.assertEqual(csv_results, excel_results)
+        self.assertEqual(csv_state, excel_state)
+        self.assertEqual(len(csv_state['patients']), 3)
+
+    def test_reimport_does_not_mark_patients_as_changed(self):
+        stamped = datetime(2025, 1, 1, tzinfo=timezone.utc)
+        stamps = lambda: list(Patient.objects.order_by('pesel').values_list('updated_at', 'inputs_changed_at'))
+
+        def chunk():
+            rows, _ = read_rows(_workbook(IMPORT_ROWS), 'export.xlsx')
+            (groups,) = iter_patient_groups(rows, chunk_size=10)
+            return import_chunk(groups, set())
+
+        def per_patient():
+            rows, _ = read_rows(_workbook(IMPORT_ROWS), 'export.xlsx')
+            (groups,) = iter_patient_groups(rows, chunk_size=10)
+            return import_groups(groups, set())
+
+        for run in (chunk, per_patient, lambda: import_csv(_csv(IMPORT_ROWS), 'export.csv')):
+            with transaction.atomic():
+                run()
+                Patient.objects.update(updated_at=stamped, inputs_changed_at=stamped)
+                run()
+                self.assertEqual(stamps(), [(stamped, stamped)] * 3)
+                transaction.set_rollback(True)
+
+
+class DerivedColumnSignalTests(TestCase):
+
+    def test_visit_and_diagnosis_saves_refresh_the_patient(self):
+        patient = _patient('72031512344', date(1972, 3, 15))
+        visit = Visit.objects.create(patient=patient, visit_date=date(2025, 6, 5))
+        # The dictionary row is created on save
+        VisitDiagnosis.objects.create(visit=visit, diagnosis_code='E11.9')
+        patient.refresh_from_db()
+        self.assertEqual(patient.visits_count, 1)
+        self.assertTrue(patient.has_diabetes)
+
+        visit.delete()
+        patient.refresh_from_db()
+        self.assertEqual(patient.visits_count, 0)
+        self.assertFalse(patient.has_diabetes)
+
+    def test_smoking_flags_follow_the_diagnosis_markers(self):
+        patient = _patient('72031512344', date(1972, 3, 15))
+        visit = Visit.objects.create(patient=patient, visit_date=date(2025, 6, 5))
+        for code in ('Z58.7', 'Z87.7', 'F17.2'):
+            Diagnosis.ensure(code)
+        patient.refresh_clinical_flags()
+        self.assertEqual((patient.effective_smoking_status, patient.smoking_info_source),
+                         ('assumed_non_smoker', 'patient_setting'))
+
+        expected = [('Z58.7', ('non_smoker', 'Z58.7')), ('Z87.7', ('non_smoker', 'Z87.7')),
+                    ('F17.2', ('smoker', 'F17.2'))]
+        for code, flags in expected:
+            VisitDiagnosis.objects.create(visit=visit, diagnosis_code=code)
+            patient.refresh_from_db()
+            self.assertEqual((patient.effective_smoking_status, patient.smoking_info_source), flags)
+            self.assertEqual(PatientClinicalSnapshot.load(patient).get_smoking_status(), flags)
@@ -6,6 +6,7 @@ app_name = 'patients'
 urlpatterns = [
     # Patient list and search
     path('', views.PatientListView.as_view(), name='patient_list'),
+    path('json/', views.PatientListJsonView.as_view(), name='patient_list_json'),
     path('search/', views.PatientSearchView.as_view(), name='patient_search'),
     
     # Patient detail
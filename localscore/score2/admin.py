@@ -1,7 +1,7 @@
 from django.contrib import admin
 from django.utils.html import format_html
 from django.db.models import Count, Avg
-from .models import Score2Result
+from .models import Score2Result, ReferenceStatistic, RecomputeRun
 
 
 @admin.register(Score2Result)
@@ -153,9 +153,9 @@ class Score2ResultAdmin(admin.ModelAdmin):
     
     def recalculate_selected(self, request, queryset):
         """Recalculate SCORE2 for selected results"""
-        from score2.views import CalculateAllScore2View
+        from score2.views import CalculateScore2View
         
-        calculator = CalculateAllScore2View()
+        calculator = CalculateScore2View()
         updated_count = 0
         
         for result in queryset:
@@ -179,4 +179,35 @@ class Score2ResultAdmin(admin.ModelAdmin):
                 level='SUCCESS'
             )
     
-    recalculate_selected.short_description = 'Przelicz SCORE2 dla wybranych'
\ No newline at end of file
+    recalculate_selected.short_description = 'Przelicz SCORE2 dla wybranych'
+
+
+@admin.register(ReferenceStatistic)
+class ReferenceStatisticAdmin(admin.ModelAdmin):
+    list_display = ['field', 'age_band_display', 'sex', 'median', 'sample_size', 'computed_at']
+    list_filter = ['field', 'sex']
+    readonly_fields = ['field', 'age_band', 'sex', 'median', 'sample_size', 'computed_at']
+    
+    def age_band_display(self, obj):
+        return f"{obj.age_band}-{obj.age_band + 9} lat"
+    age_band_display.short_description = 'Grupa wiekowa'
+    age_band_display.admin_order_field = 'age_band'
+    
+    def has_add_permission(self, request):
+        return False
+
+
+@admin.register(RecomputeRun)
+class RecomputeRunAdmin(admin.ModelAdmin):
+    list_display = ['id', 'group', 'status', 'patient_range', 'patients_done', 'started_at', 'finished_at']
+    list_filter = ['status']
+    readonly_fields = [f.name for f in RecomputeRun._meta.fields]
+    
+    def patient_range(self, obj):
+        if obj.first_patient_id is None and obj.last_patient_id is None:
+            return 'Wszyscy'
+        return f"{obj.first_patient_id}-{obj.last_patient_id}"
+    patient_range.short_description = 'Zakres id pacjentów'
+    
+    def has_add_permission(self, request):
+        return False
@@ -0,0 +1,173 @@
+import threading
+from typing import Dict, Sequence
+
+import numpy as np
+import pandas as pd
+from django.db.models import F
+
+from patients.models import data_version
+from .models import Score2Result
+
+# Frame column -> Score2Result lookup; one row per patient's current result
+FRAME_COLUMNS = {
+    'patient_id': 'patient_id',
+    'sex': 'patient__gender',
+    'age': 'age_at_calculation',
+    'diabetes': 'has_diabetes',
+    'smoking': 'smoking_status',
+    'data_source': 'data_source',
+    'score_type': 'score_type',
+    'risk_level': 'risk_level',
+    'successful': 'is_calculation_successful',
+    'score': 'score_value',
+}
+
+# Columns reports may group or filter by
+DIMENSIONS = ('age_band', 'sex', 'diabetes', 'smoking', 'data_source', 'score_type', 'risk_level', 'successful')
+BOOLEAN_DIMENSIONS = ('diabetes', 'successful')
+
+# Upper bound on histogram bins, so a tiny ?width= cannot allocate millions of edges
+MAX_BINS = 1000
+
+_lock = threading.Lock()
+_frame = None
+_frame_version = None
+
+
+def load_frame() -> pd.DataFrame:
+    """Current SCORE2 results (those of each patient's latest scored visit) as a columnar frame"""
+    rows = (
+        Score2Result.objects.filter(visit__visit_date=F('patient__current_score_visit_date'))
+        .order_by()
+        .values_list(*FRAME_COLUMNS.values())
+    )
+    return build_frame(list(rows))
+
+
+def build_frame(records) -> pd.DataFrame:
+    """Frame from tuples in FRAME_COLUMNS order, with typed columns and age_band added"""
+    frame = pd.DataFrame.from_records(records, columns=list(FRAME_COLUMNS))
+    frame['score'] = frame['score'].astype('float64')
+    frame['age'] = frame['age'].astype('int64')
+    frame['diabetes'] = frame['diabetes'].astype(bool)
+    frame['successful'] = frame['successful'].astype(bool)
+    band = (frame['age'] // 10) * 10
+    labels = {start: f'{start}-{start + 9}' for start in np.unique(band)}
+    frame['age_band'] = pd.Categorical(band.map(labels), categories=[labels[start] for start in sorted(labels)],
+                                       ordered=True)
+    for column in ('sex', 'smoking', 'data_source', 'score_type', 'risk_level'):
+        frame[column] = frame[column].fillna('').astype('category')
+    return frame
+
+
+def get_frame() -> pd.DataFrame:
+    """load_frame() cached in this process until the data version changes"""
+    global _frame, _frame_version
+    version = data_version()
+    with _lock:
+        if _frame is not None and _frame_version == version:
+            return _frame
+    frame = load_frame()
+    with _lock:
+        _frame, _frame_version = frame, version
+    return frame
+
+
+def _check_dimensions(dimensions: Sequence[str]):
+    unknown = [d for d in dimensions if d not in DIMENSIONS]
+    if unknown:
+        raise ValueError(f"Nieznany wymiar: {', '.join(unknown)}. Dostępne: {', '.join(DIMENSIONS)}")
+
+
+def filter_frame(frame: pd.DataFrame, filters: Dict[str, str]) -> pd.DataFrame:
+    """Rows whose dimensions equal the given values; booleans accept 1/0, true/false, tak/nie"""
+    _check_dimensions(list(filters))
+    mask = np.ones(len(frame), dtype=bool)
+    for dimension, value in filters.items():
+        if dimension in BOOLEAN_DIMENSIONS:
+            value = value.lower() in ('1', 'true', 'tak')
+        mask &= (frame[dimension] == value).to_numpy()
+    return frame[mask]
+
+
+def crosstab(frame: pd.DataFrame, rows: Sequence[str], columns: Sequence[str] = (),
+             normalize: str = None) -> dict:
+    """Result counts by `rows` x `columns`; normalize='rows' or 'all' gives percentages"""
+    _check_dimensions([*rows, *columns])
+    if not rows:
+        raise ValueError('Podaj co najmniej jeden wymiar wierszy')
+    counts = frame.groupby([*rows, *columns], observed=True).size()
+    table = counts.unstack(list(columns), fill_value=0) if columns else counts.to_frame('count')
+    if normalize == 'rows':
+        table = table.div(table.sum(axis=1), axis=0) * 100
+    elif normalize == 'all':
+        table = table / table.to_numpy().sum() * 100
+    elif normalize is not None:
+        raise ValueError("normalize: 'rows' albo 'all'")
+    return _table(table.round(2) if normalize else table)
+
+
+def percentiles(frame: pd.DataFrame, by: Sequence[str] = (), q: Sequence[float] = (25, 50, 75, 90)) -> dict:
+    """Percentiles of the score of successful results, per group of `by`"""
+    _check_dimensions(by)
+    scores = frame.loc[frame['successful'] & frame['score'].notna(), [*by, 'score']]
+    columns = ['n', *[f'p{value:g}' for value in q]]
+    if scores.empty:
+        return {'rows': [], 'columns': columns, 'values': []}
+    fractions = [value / 100 for value in q]
+    if by:
+        grouped = scores.groupby(list(by), observed=True)['score']
+        table = grouped.quantile(fractions).unstack()
+        table.insert(0, 'n', grouped.size())
+    else:
+        table = scores['score'].quantile(fractions).to_frame().T
+        table.insert(0, 'n', len(scores))
+        table.index = ['wszystkie']
+    table.columns = columns
+    table = table.round(2)
+    table['n'] = table['n'].astype('int64')
+    return _table(table)
+
+
+def histogram(frame: pd.DataFrame, by: Sequence[str] = (), width: float = 1.0) -> dict:
+    """Counts of successful-result scores in bins of `width` percentage points, per group of `by`"""
+    _check_dimensions(by)
+    if not np.isfinite(width) or width <= 0:
+        raise ValueError('Szerokość przedziału musi być dodatnia')
+    scores = frame.loc[frame['successful'] & frame['score'].notna(), [*by, 'score']]
+    top = scores['score'].max() if len(scores) else 0.0
+    if top / width > MAX_BINS:
+        raise ValueError(f'Zbyt wąski przedział: najwyżej {MAX_BINS} przedziałów')
+    edges = np.arange(0.0, top + width, width)
+    if len(edges) < 2:
+        edges = np.array([0.0, width])
+    if by:
+        # A single key gives scalar group labels, as in the other reports
+        groups = list(scores.groupby(list(by) if len(by) > 1 else by[0], observed=True)['score'])
+    else:
+        groups = [('wszystkie', scores['score'])]
+    return {
+        'edges': [round(float(edge), 4) for edge in edges],
+        'rows': [_label(key) for key, _ in groups],
+        'values': [np.histogram(values.to_numpy(), bins=edges)[0].tolist() for _, values in groups],
+    }
+
+
+def _label(value):
+    """JSON-friendly label or value: tuples (several dimensions) become lists, NaN becomes None"""
+    if isinstance(value, tuple):
+        return [_label(v) for v in value]
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    return value
+
+
+def _table(table: pd.DataFrame) -> dict:
+    return {
+        'rows': [_label(key) for key in table.index],
+        'columns': [_label(key) for key in table.columns],
+        # object dtype keeps integer columns (counts) as ints next to float ones
+        'values': [[_label(v) for v in row] for row in table.astype(object).to_numpy().tolist()],
+    }
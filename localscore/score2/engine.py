@@ -0,0 +1,488 @@
+"""SCORE2, SCORE2-Diabetes and SCORE2-OP calculation kernels.
+
+Coefficients live here once. ``SCORE2_MODELS`` & co. hold a compiled model
+per (sex, region) pair that the scalar ``Score2Result.calculate_*``
+staticmethods use. The ``*_batch`` functions take column arrays (one element
+per patient) and score a whole cohort in a single NumPy pass; rows that the
+scalar version would reject (missing inputs, age outside the validated
+range, unknown sex/region) come back as ``nan`` instead of raising.
+"""
+import hashlib
+import math
+from typing import NamedTuple, Optional
+
+import numpy as np
+
+SEXES = ('M', 'F')
+REGIONS = ('low', 'moderate', 'high', 'very_high')
+
+MGDL_TO_MMOL = 1 / 38.67
+EPS = 1e-15
+
+# Default lab values used by SCORE2-Diabetes when a value is not available
+DEFAULT_A1C_MMOL = 31.0   # ~5.0% (normal)
+DEFAULT_EGFR = 95.0       # typical normal value
+
+SCORE2_TERMS = (
+    'cage', 'smoke', 'csbp', 'ctchol', 'chdl',
+    'smoke_cage', 'csbp_cage', 'ctchol_cage', 'chdl_cage',
+)
+SCORE2_BETA = {
+    'M': {
+        'cage': 0.3742, 'smoke': 0.6012, 'csbp': 0.2777,
+        'ctchol': 0.1458, 'chdl': -0.2698,
+        'smoke_cage': -0.0755, 'csbp_cage': -0.0255,
+        'ctchol_cage': -0.0281, 'chdl_cage': 0.0426,
+        'baseline_survival': 0.9605,
+    },
+    'F': {
+        'cage': 0.4648, 'smoke': 0.7744, 'csbp': 0.3131,
+        'ctchol': 0.1002, 'chdl': -0.2606,
+        'smoke_cage': -0.1088, 'csbp_cage': -0.0277,
+        'ctchol_cage': -0.0226, 'chdl_cage': 0.0613,
+        'baseline_survival': 0.9776,
+    },
+}
+
+SCORE2_DIABETES_TERMS = (
+    'cage', 'smoke', 'csbp', 'diab', 'ctchol', 'chdl', 'smoke_cage',
+    'csbp_cage', 'diab_cage', 'ctchol_cage', 'chdl_cage', 'cagediab',
+    'ca1c', 'cegfr', 'cegfr2', 'ca1c_cage', 'cegfr_cage',
+)
+SCORE2_DIABETES_BETA = {
+    'M': {
+        'cage': 0.5368, 'smoke': 0.4774, 'csbp': 0.1322, 'diab': 0.6457,
+        'ctchol': 0.1102, 'chdl': -0.1087, 'smoke_cage': -0.0672,
+        'csbp_cage': -0.0268, 'diab_cage': -0.0983, 'ctchol_cage': -0.0181,
+        'chdl_cage': 0.0095, 'cagediab': -0.0998, 'ca1c': 0.0955,
+        'cegfr': -0.0591, 'cegfr2': 0.0058, 'ca1c_cage': -0.0134,
+        'cegfr_cage': 0.0115, 'baseline_survival': 0.9605,
+    },
+    'F': {
+        'cage': 0.6624, 'smoke': 0.6139, 'csbp': 0.1421, 'diab': 0.8096,
+        'ctchol': 0.1127, 'chdl': -0.1568, 'smoke_cage': -0.1122,
+        'csbp_cage': -0.0167, 'diab_cage': -0.1272, 'ctchol_cage': -0.0200,
+        'chdl_cage': 0.0186, 'cagediab': -0.1180, 'ca1c': 0.1173,
+        'cegfr': -0.0640, 'cegfr2': 0.0062, 'ca1c_cage': -0.0196,
+        'cegfr_cage': 0.0169, 'baseline_survival': 0.9776,
+    },
+}
+
+SCORE2_OP_TERMS = (
+    'cage', 'diab', 'smoke', 'csbp', 'ctchol', 'chdl', 'diab_cage',
+    'smoke_cage', 'csbp_cage', 'ctchol_cage', 'chdl_cage',
+)
+SCORE2_OP_BETA = {
+    'M': {
+        'cage': 0.0634, 'diab': 0.4245, 'smoke': 0.3524, 'csbp': 0.0094,
+        'ctchol': 0.0850, 'chdl': -0.3564, 'diab_cage': -0.0174,
+        'smoke_cage': -0.0247, 'csbp_cage': -0.0005, 'ctchol_cage': 0.0073,
+        'chdl_cage': 0.0091, 'baseline_survival': 0.7576, 'mean_lp': 0.0929,
+    },
+    'F': {
+        'cage': 0.0789, 'diab': 0.6010, 'smoke': 0.4921, 'csbp': 0.0102,
+        'ctchol': 0.0605, 'chdl': -0.3040, 'diab_cage': -0.0107,
+        'smoke_cage': -0.0255, 'csbp_cage': -0.0004, 'ctchol_cage': -0.0009,
+        'chdl_cage': 0.0154, 'baseline_survival': 0.8082, 'mean_lp': 0.2290,
+    },
+}
+
+# Regional recalibration scales, shared by SCORE2 and SCORE2-Diabetes
+SCORE2_SCALES = {
+    'M': {
+        'low': (-0.5699, 0.7476), 'moderate': (-0.1565, 0.8009),
+        'high': (0.3207, 0.9360), 'very_high': (0.5836, 0.8294),
+    },
+    'F': {
+        'low': (-0.7380, 0.7019), 'moderate': (-0.3143, 0.7701),
+        'high': (0.5710, 0.9369), 'very_high': (0.9412, 0.8329),
+    },
+}
+
+SCORE2_OP_SCALES = {
+    'M': {
+        'low': (-0.34, 1.19), 'moderate': (0.01, 1.25),
+        'high': (0.08, 1.15), 'very_high': (0.05, 0.70),
+    },
+    'F': {
+        'low': (-0.52, 1.01), 'moderate': (-0.10, 1.10),
+        'high': (0.38, 1.09), 'very_high': (0.38, 0.69),
+    },
+}
+
+
+# Risk clamping of the reference, r_uncal in [EPS, 1 - EPS], expressed on the
+# log(-log(1 - r)) scale the kernels work on.
+LOGLOG_MIN = math.log(-math.log(1 - EPS))
+LOGLOG_MAX = math.log(-math.log(EPS))
+
+
+def _engine_version() -> str:
+    """Short hash of every coefficient table; changes whenever the model does"""
+    tables = (SCORE2_BETA, SCORE2_DIABETES_BETA, SCORE2_OP_BETA, SCORE2_SCALES, SCORE2_OP_SCALES,
+              MGDL_TO_MMOL, DEFAULT_A1C_MMOL, DEFAULT_EGFR)
+    return hashlib.sha256(repr(tables).encode()).hexdigest()[:16]
+
+
+# Stored with every result so a coefficient change invalidates old results
+ENGINE_VERSION = _engine_version()
+
+
+def to_mmol(value: float) -> float:
+    """Convert mg/dL to mmol/L if needed"""
+    return value * MGDL_TO_MMOL if value > 20 else value
+
+
+class _CompiledModel:
+    """Coefficients of one score type for one (sex, region) pair.
+
+    Betas are flattened into a tuple in the order of the score's TERMS and
+    everything that does not depend on the patient is folded into constants,
+    so calibration works in log space:
+
+        log(-log(1 - r_uncal)) = lp + log(-log(S0)) - mean_lp
+        r_cal = 1 - exp(-exp(s1 + s2 * log(-log(1 - r_uncal))))
+    """
+    __slots__ = ('beta', 'offset', 's1', 's2')
+
+    def __init__(self, beta: dict, terms: tuple, scales: tuple, mean_lp: float = 0.0):
+        self.beta = tuple(beta[t] for t in terms)
+        self.offset = math.log(-math.log(beta['baseline_survival'])) - mean_lp
+        self.s1, self.s2 = scales
+
+    def _calibrate(self, lp: float) -> float:
+        z = lp + self.offset
+        z = LOGLOG_MIN if z < LOGLOG_MIN else LOGLOG_MAX if z > LOGLOG_MAX else z
+        return round(-math.expm1(-math.exp(self.s1 + self.s2 * z)) * 100, 2)
+
+
+class Score2Model(_CompiledModel):
+    __slots__ = ()
+
+    def score(self, age: float, sbp: float, tchol: float, hdl: float, smoker: bool) -> float:
+        b_cage, b_smoke, b_csbp, b_ctchol, b_chdl, b_smoke_cage, b_csbp_cage, b_ctchol_cage, b_chdl_cage = self.beta
+        cage = (age - 60) / 5
+        csbp = (sbp - 120) / 20
+        ctchol = to_mmol(tchol) - 6
+        chdl = (to_mmol(hdl) - 1.3) / 0.5
+        smoke = 1 if smoker else 0
+        return self._calibrate(
+            (b_cage + b_smoke_cage * smoke + b_csbp_cage * csbp + b_ctchol_cage * ctchol + b_chdl_cage * chdl) * cage
+            + b_smoke * smoke + b_csbp * csbp + b_ctchol * ctchol + b_chdl * chdl
+        )
+
+
+class Score2DiabetesModel(_CompiledModel):
+    __slots__ = ()
+
+    def score(self, age: float, sbp: float, tchol: float, hdl: float, smoker: bool, diabetes: bool,
+              age_at_diagnosis: Optional[float], a1c_mmol: float, egfr: float) -> float:
+        (b_cage, b_smoke, b_csbp, b_diab, b_ctchol, b_chdl, b_smoke_cage, b_csbp_cage, b_diab_cage,
+         b_ctchol_cage, b_chdl_cage, b_cagediab, b_ca1c, b_cegfr, b_cegfr2, b_ca1c_cage,
+         b_cegfr_cage) = self.beta
+        cage = (age - 60) / 5
+        csbp = (sbp - 120) / 20
+        ctchol = to_mmol(tchol) - 6
+        chdl = (to_mmol(hdl) - 1.3) / 0.5
+        smoke = 1 if smoker else 0
+        diab = 1 if diabetes else 0
+        cagediab = diab * ((age_at_diagnosis - 50) / 5 if age_at_diagnosis else 0)
+        ca1c = (a1c_mmol - 31) / 9.34
+        cegfr = (math.log(egfr) - 4.5) / 0.15
+        return self._calibrate(
+            (b_cage + b_smoke_cage * smoke + b_csbp_cage * csbp + b_diab_cage * diab
+             + b_ctchol_cage * ctchol + b_chdl_cage * chdl + b_ca1c_cage * ca1c + b_cegfr_cage * cegfr) * cage
+            + b_smoke * smoke + b_csbp * csbp + b_diab * diab + b_ctchol * ctchol + b_chdl * chdl
+            + b_cagediab * cagediab + b_ca1c * ca1c + b_cegfr * cegfr + b_cegfr2 * cegfr * cegfr
+        )
+
+
+class Score2OPModel(_CompiledModel):
+    __slots__ = ()
+
+    def score(self, age: float, sbp: float, tchol: float, hdl: float, smoker: bool, diabetes: bool) -> float:
+        (b_cage, b_diab, b_smoke, b_csbp, b_ctchol, b_chdl, b_diab_cage, b_smoke_cage, b_csbp_cage,
+         b_ctchol_cage, b_chdl_cage) = self.beta
+        cage = age - 73
+        csbp = sbp - 150
+        ctchol = to_mmol(tchol) - 6
+        chdl = to_mmol(hdl) - 1.4
+        diab = 1 if diabetes else 0
+        smoke = 1 if smoker else 0
+        return self._calibrate(
+            (b_cage + b_diab_cage * diab + b_smoke_cage * smoke + b_csbp_cage * csbp
+             + b_ctchol_cage * ctchol + b_chdl_cage * chdl) * cage
+            + b_diab * diab + b_smoke * smoke + b_csbp * csbp + b_ctchol * ctchol + b_chdl * chdl
+        )
+
+
+# Compiled models keyed by (sex, region), built once at import time
+SCORE2_MODELS = {
+    (sex, region): Score2Model(SCORE2_BETA[sex], SCORE2_TERMS, SCORE2_SCALES[sex][region])
+    for sex in SEXES for region in REGIONS
+}
+SCORE2_DIABETES_MODELS = {
+    (sex, region): Score2DiabetesModel(SCORE2_DIABETES_BETA[sex], SCORE2_DIABETES_TERMS,
+                                       SCORE2_SCALES[sex][region])
+    for sex in SEXES for region in REGIONS
+}
+SCORE2_OP_MODELS = {
+    (sex, region): Score2OPModel(SCORE2_OP_BETA[sex], SCORE2_OP_TERMS, SCORE2_OP_SCALES[sex][region],
+                                 mean_lp=SCORE2_OP_BETA[sex]['mean_lp'])
+    for sex in SEXES for region in REGIONS
+}
+
+
+def _beta_matrix(beta, terms):
+    """(sex, term) coefficient matrix in SEXES order"""
+    return np.array([[beta[sex][t] for t in terms] for sex in SEXES])
+
+
+def _scale_tensor(scales):
+    """(sex, region, 2) calibration tensor in SEXES/REGIONS order"""
+    return np.array([[scales[sex][region] for region in REGIONS] for sex in SEXES])
+
+
+def _loglog_offset(beta, mean_lp=None):
+    """log(-log(S0)) - mean_lp per sex, the constant part of the log-space predictor"""
+    return np.array([
+        math.log(-math.log(beta[sex]['baseline_survival'])) - (beta[sex][mean_lp] if mean_lp else 0.0)
+        for sex in SEXES
+    ])
+
+
+_SCORE2_B = _beta_matrix(SCORE2_BETA, SCORE2_TERMS)
+_SCORE2_OFFSET = _loglog_offset(SCORE2_BETA)
+_SCORE2_DIABETES_B = _beta_matrix(SCORE2_DIABETES_BETA, SCORE2_DIABETES_TERMS)
+_SCORE2_DIABETES_OFFSET = _loglog_offset(SCORE2_DIABETES_BETA)
+_SCORE2_OP_B = _beta_matrix(SCORE2_OP_BETA, SCORE2_OP_TERMS)
+_SCORE2_OP_OFFSET = _loglog_offset(SCORE2_OP_BETA, 'mean_lp')
+_SCORE2_K = _scale_tensor(SCORE2_SCALES)
+_SCORE2_OP_K = _scale_tensor(SCORE2_OP_SCALES)
+
+
+class Score2Batch(NamedTuple):
+    """Per-row outcome of calculate_batch"""
+    score_type: np.ndarray   # '', 'SCORE2', 'SCORE2-Diabetes' or 'SCORE2-OP'
+    score_value: np.ndarray  # percent rounded to 2 decimals, nan if not calculated
+    risk_level: np.ndarray   # Score2Result.RISK_LEVEL_CHOICES keys
+
+
+def _as_float(values, n: Optional[int] = None) -> np.ndarray:
+    """Float column; None/Decimal are accepted, None becomes nan"""
+    arr = np.asarray(values, dtype=float)
+    if n is not None and arr.ndim == 0:
+        arr = np.full(n, float(arr))
+    return arr
+
+
+def _as_bool(values, n: int) -> np.ndarray:
+    arr = np.asarray(values, dtype=bool)
+    return np.full(n, bool(arr)) if arr.ndim == 0 else arr
+
+
+def _as_index(values, labels, n: int) -> np.ndarray:
+    """Map string labels to positions in `labels`; unknown labels give -1"""
+    arr = np.asarray(values, dtype=object)
+    if arr.ndim == 0:
+        arr = np.full(n, arr.item(), dtype=object)
+    idx = np.full(n, -1, dtype=np.intp)
+    for i, label in enumerate(labels):
+        idx[arr == label] = i
+    return idx
+
+
+def _to_mmol_array(chol: np.ndarray) -> np.ndarray:
+    """Vectorized to_mmol"""
+    return np.where(chol > 20, chol * MGDL_TO_MMOL, chol)
+
+
+def _calibrate(lp: np.ndarray, offset: np.ndarray, scales: np.ndarray,
+               sex_idx: np.ndarray, region_idx: np.ndarray) -> np.ndarray:
+    """Turn linear predictors into calibrated 10-year risk in percent (see _CompiledModel)"""
+    valid = (sex_idx >= 0) & (region_idx >= 0)
+    s_i = np.where(sex_idx >= 0, sex_idx, 0)
+    r_i = np.where(region_idx >= 0, region_idx, 0)
+
+    z = np.clip(lp + offset[s_i], LOGLOG_MIN, LOGLOG_MAX)
+    k = scales[s_i, r_i]
+    with np.errstate(over='ignore', invalid='ignore'):
+        r_cal = -np.expm1(-np.exp(k[:, 0] + k[:, 1] * z))
+
+    return np.where(valid, np.round(r_cal * 100, 2), np.nan)
+
+
+def score2_batch(age, sbp, tchol, hdl, smoker, sex, region='high') -> np.ndarray:
+    """Vectorized SCORE2 for non-diabetic patients aged 40-69"""
+    age = _as_float(age)
+    n = age.shape[0]
+    sbp, tchol, hdl = _as_float(sbp, n), _as_float(tchol, n), _as_float(hdl, n)
+    smoke = _as_bool(smoker, n).astype(float)
+    sex_idx = _as_index(sex, SEXES, n)
+    region_idx = _as_index(region, REGIONS, n)
+
+    cage = (age - 60) / 5
+    csbp = (sbp - 120) / 20
+    ctchol = _to_mmol_array(tchol) - 6
+    chdl = (_to_mmol_array(hdl) - 1.3) / 0.5
+
+    X = np.column_stack([
+        cage, smoke, csbp, ctchol, chdl,
+        smoke * cage, csbp * cage, ctchol * cage, chdl * cage,
+    ])
+    lp = np.einsum('ij,ij->i', X, _SCORE2_B[np.where(sex_idx >= 0, sex_idx, 0)])
+    return _calibrate(lp, _SCORE2_OFFSET, _SCORE2_K, sex_idx, region_idx)
+
+
+def score2_diabetes_batch(age, sbp, tchol, hdl, smoker, diabetes, age_at_diagnosis=None,
+                          a1c=None, egfr=None, sex='M', region='high') -> np.ndarray:
+    """Vectorized SCORE2-Diabetes for patients aged 40-69.
+
+    ``a1c`` is HbA1c in percent (converted to mmol/mol like the reference);
+    missing a1c/egfr fall back to the same defaults as the scalar version.
+    """
+    age = _as_float(age)
+    n = age.shape[0]
+    sbp, tchol, hdl = _as_float(sbp, n), _as_float(tchol, n), _as_float(hdl, n)
+    smoke = _as_bool(smoker, n).astype(float)
+    diab = _as_bool(diabetes, n).astype(float)
+    age_dx = _as_float(age_at_diagnosis, n)
+    a1c = _as_float(a1c, n)
+    egfr = _as_float(egfr, n)
+    sex_idx = _as_index(sex, SEXES, n)
+    region_idx = _as_index(region, REGIONS, n)
+
+    a1c = np.where(np.isnan(a1c), DEFAULT_A1C_MMOL, (a1c - 2.15) * 10.929)
+    egfr = np.where(np.isnan(egfr), DEFAULT_EGFR, egfr)
+
+    cage = (age - 60) / 5
+    csbp = (sbp - 120) / 20
+    ctchol = _to_mmol_array(tchol) - 6
+    chdl = (_to_mmol_array(hdl) - 1.3) / 0.5
+    # The reference treats a diagnosis age of 0 like a missing one
+    cagediab = diab * np.where(np.nan_to_num(age_dx) != 0, (age_dx - 50) / 5, 0.0)
+    ca1c = (a1c - 31) / 9.34
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cegfr = (np.log(egfr) - 4.5) / 0.15
+
+    X = np.column_stack([
+        cage, smoke, csbp, diab, ctchol, chdl, smoke * cage,
+        csbp * cage, diab * cage, ctchol * cage, chdl * cage, cagediab,
+        ca1c, cegfr, cegfr ** 2, ca1c * cage, cegfr * cage,
+    ])
+    lp = np.einsum('ij,ij->i', X, _SCORE2_DIABETES_B[np.where(sex_idx >= 0, sex_idx, 0)])
+    risk = _calibrate(lp, _SCORE2_DIABETES_OFFSET, _SCORE2_K, sex_idx, region_idx)
+
+    invalid = (age < 40) | (age > 69) | ((diab > 0) & np.isnan(age_dx))
+    return np.where(invalid, np.nan, risk)
+
+
+def score2_op_batch(age, sbp, tchol, hdl, smoker, diabetes, sex='M', region='moderate') -> np.ndarray:
+    """Vectorized SCORE2-OP for patients aged 70-89"""
+    age = _as_float(age)
+    n = age.shape[0]
+    sbp, tchol, hdl = _as_float(sbp, n), _as_float(tchol, n), _as_float(hdl, n)
+    smoke = _as_bool(smoker, n).astype(float)
+    diab = _as_bool(diabetes, n).astype(float)
+    sex_idx = _as_index(sex, SEXES, n)
+    region_idx = _as_index(region, REGIONS, n)
+    s_i = np.where(sex_idx >= 0, sex_idx, 0)
+
+    cage = age - 73
+    csbp = sbp - 150
+    ctchol = _to_mmol_array(tchol) - 6
+    chdl = _to_mmol_array(hdl) - 1.4
+
+    X = np.column_stack([
+        cage, diab, smoke, csbp, ctchol, chdl, diab * cage,
+        smoke * cage, csbp * cage, ctchol * cage, chdl * cage,
+    ])
+    lp = np.einsum('ij,ij->i', X, _SCORE2_OP_B[s_i])
+    risk = _calibrate(lp, _SCORE2_OP_OFFSET, _SCORE2_OP_K, sex_idx, region_idx)
+
+    invalid = (age < 70) | (age > 89)
+    return np.where(invalid, np.nan, risk)
+
+
+def risk_level_batch(age, score_value, score_type) -> np.ndarray:
+    """Vectorized Score2Result.get_risk_level; nan scores are 'not_applicable'"""
+    age = _as_float(age)
+    n = age.shape[0]
+    score = _as_float(score_value, n)
+    score_type = np.asarray(score_type, dtype=object)
+    if score_type.ndim == 0:
+        score_type = np.full(n, score_type.item(), dtype=object)
+
+    op = (score_type == 'SCORE2-OP') | (age >= 70)
+    young = ~op & (age < 50)
+    middle = ~op & (age >= 50) & (age <= 69)
+
+    low_cut = np.select([op, young, middle], [7.5, 2.5, 5.0], np.nan)
+    high_cut = np.select([op, young, middle], [15.0, 7.5, 10.0], np.nan)
+
+    levels = np.where(score < low_cut, 'low_to_moderate',
+                      np.where(score < high_cut, 'high', 'very_high')).astype(object)
+    levels[~(op | young | middle)] = 'age_out_of_range'
+    levels[np.isnan(score)] = 'not_applicable'
+    return levels
+
+
+def calculate_batch(age, sbp, tchol, hdl, smoker, sex, region='high', diabetes=False,
+                    age_at_diagnosis=None, a1c=None, egfr=None, op_region='moderate') -> Score2Batch:
+    """Pick the score type per row the same way CalculateScore2View does and score everything.
+
+    Diabetic patients aged 40-69 get SCORE2-Diabetes, everyone aged 70+ with
+    diabetes or 70-89 without gets SCORE2-OP (always with ``op_region``, as in
+    the view), non-diabetic patients aged 40-69 get SCORE2. Missing SBP gives
+    an empty score type with 'not_applicable', other ages 'age_out_of_range'.
+    """
+    age = _as_float(age)
+    n = age.shape[0]
+    sbp = _as_float(sbp, n)
+    diab = _as_bool(diabetes, n)
+
+    no_sbp = np.isnan(sbp)
+    is_diabetes = ~no_sbp & diab & (age >= 40) & (age <= 69)
+    is_op = ~no_sbp & ((diab & (age >= 70)) | (~diab & (age >= 70) & (age <= 89)))
+    is_score2 = ~no_sbp & ~diab & (age >= 40) & (age <= 69)
+
+    score_type = np.full(n, '', dtype=object)
+    score_type[is_score2] = 'SCORE2'
+    score_type[is_diabetes] = 'SCORE2-Diabetes'
+    score_type[is_op] = 'SCORE2-OP'
+
+    score = np.full(n, np.nan)
+    if is_score2.any():
+        m = is_score2
+        score[m] = score2_batch(
+            age[m], sbp[m], _pick(tchol, m), _pick(hdl, m), _pick(smoker, m),
+            _pick(sex, m), _pick(region, m),
+        )
+    if is_diabetes.any():
+        m = is_diabetes
+        score[m] = score2_diabetes_batch(
+            age[m], sbp[m], _pick(tchol, m), _pick(hdl, m), _pick(smoker, m), True,
+            _pick(age_at_diagnosis, m), _pick(a1c, m), _pick(egfr, m),
+            _pick(sex, m), _pick(region, m),
+        )
+    if is_op.any():
+        m = is_op
+        score[m] = score2_op_batch(
+            age[m], sbp[m], _pick(tchol, m), _pick(hdl, m), _pick(smoker, m),
+            diab[m], _pick(sex, m), _pick(op_region, m),
+        )
+
+    risk_level = risk_level_batch(age, score, score_type)
+    risk_level[score_type == ''] = 'age_out_of_range'
+    risk_level[no_sbp] = 'not_applicable'
+    return Score2Batch(score_type, score, risk_level)
+
+
+def _pick(values, mask: np.ndarray):
+    """Select masked rows of a column, passing scalars and None through"""
+    if values is None:
+        return None
+    arr = np.asarray(values, dtype=object)
+    if arr.ndim == 0:
+        return arr.item()
+    return arr[mask]
@@ -0,0 +1,50 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from score2 import pipeline
+from score2.stats import refresh_statistics
+
+
+class Command(BaseCommand):
+    help = 'Przelicza SCORE2 dla wszystkich kwalifikujących się pacjentów'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Liczba procesów; pacjenci są dzieleni na zakresy id')
+        parser.add_argument('--chunk-size', type=int, default=pipeline.DEFAULT_CHUNK_SIZE,
+                            help='Liczba pacjentów w jednej partii zapisu')
+        parser.add_argument('--force', action='store_true',
+                            help='Przelicz wszystkich, także pacjentów bez zmian w danych')
+        parser.add_argument('--resume', action='store_true',
+                            help='Dokończ ostatnie przerwane przeliczenie od zapisanego punktu kontrolnego')
+
+    def handle(self, *args, **options):
+        workers = options['workers']
+        if workers < 1:
+            raise CommandError('--workers musi być >= 1')
+
+        started = time.monotonic()
+        if options['resume']:
+            results = pipeline.resume(workers)
+            if results is None:
+                self.stdout.write('Brak przerwanego przeliczenia do wznowienia.')
+                return
+        elif workers == 1:
+            results = pipeline.recompute_all(chunk_size=options['chunk_size'], force=options['force'])
+        else:
+            results = pipeline.recompute_parallel(
+                workers, options['chunk_size'], force=options['force'],
+                progress=lambda done, shards, counters: self.stdout.write(
+                    f"Zakończono {done}/{shards} zakresów, przeliczono {counters['total_processed']} pacjentów"
+                ),
+            )
+        elapsed = time.monotonic() - started
+        refresh_statistics()
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Sprawdzono {results['total_processed'] + results['skipped_unchanged']} pacjentów w {elapsed:.1f} s, "
+            f"przeliczono {results['total_processed']}: "
+            f"udane {results['successful_calculations']}, nieudane {results['failed_calculations']}, "
+            f"wykluczone {results['excluded_patients']}; bez zmian {results['skipped_unchanged']}"
+        ))
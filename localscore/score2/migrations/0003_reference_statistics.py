@@ -0,0 +1,58 @@
+# Generated by Django 5.2.4 on 2026-10-17 14:59
+
+from django.db import migrations, models
+
+
+POPULATE_SQL = """
+    INSERT INTO score2_reference_statistics (field, age_band, sex, median, sample_size, computed_at)
+    SELECT field,
+           age_band,
+           CASE WHEN GROUPING(gender) = 1 THEN '' ELSE gender END,
+           percentile_cont(0.5) WITHIN GROUP (ORDER BY value),
+           count(*),
+           now()
+    FROM (
+        SELECT m.field,
+               (date_part('year', age(CURRENT_DATE, p.date_of_birth))::int / 10) * 10 AS age_band,
+               p.gender,
+               m.value::float8 AS value
+        FROM visits v
+        JOIN patients p ON p.id = v.patient_id
+        CROSS JOIN LATERAL (VALUES
+            ('cholesterol_total', v.cholesterol_total),
+            ('cholesterol_hdl', v.cholesterol_hdl),
+            ('egfr', v.egfr),
+            ('hba1c', v.hba1c)
+        ) AS m(field, value)
+        WHERE m.value IS NOT NULL
+    ) AS measurements
+    GROUP BY GROUPING SETS ((field, age_band, gender), (field, age_band))
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('score2', '0002_alter_score2result_options_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReferenceStatistic',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('field', models.CharField(choices=[('cholesterol_total', 'Cholesterol całkowity'), ('cholesterol_hdl', 'Cholesterol HDL'), ('egfr', 'eGFR'), ('hba1c', 'HbA1c')], max_length=30)),
+                ('age_band', models.IntegerField(help_text='Początek 10-letniego przedziału wieku (obecny wiek pacjenta)')),
+                ('sex', models.CharField(blank=True, default='', help_text='Pusta wartość = obie płcie', max_length=1)),
+                ('median', models.FloatField()),
+                ('sample_size', models.IntegerField()),
+                ('computed_at', models.DateTimeField()),
+            ],
+            options={
+                'db_table': 'score2_reference_statistics',
+                'ordering': ['field', 'age_band', 'sex'],
+                'unique_together': {('field', 'age_band', 'sex')},
+            },
+        ),
+        migrations.RunSQL(POPULATE_SQL, reverse_sql=migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.4 on 2026-10-17 15:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('score2', '0003_reference_statistics'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='score2result',
+            name='engine_version',
+            field=models.CharField(blank=True, default='', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='score2result',
+            name='input_fingerprint',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
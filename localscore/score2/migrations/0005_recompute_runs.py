@@ -0,0 +1,39 @@
+# Generated by Django 5.2.4 on 2026-10-17 15:09
+
+import datetime
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('score2', '0004_score2result_input_fingerprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecomputeRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('group', models.UUIDField(db_index=True, default=uuid.uuid4)),
+                ('status', models.CharField(choices=[('running', 'W trakcie'), ('completed', 'Zakończone'), ('failed', 'Przerwane')], default='running', max_length=20)),
+                ('as_of', models.DateField(default=datetime.date.today)),
+                ('first_patient_id', models.BigIntegerField(blank=True, null=True)),
+                ('last_patient_id', models.BigIntegerField(blank=True, null=True)),
+                ('chunk_size', models.IntegerField()),
+                ('force', models.BooleanField(default=False)),
+                ('checkpoint_patient_id', models.BigIntegerField(blank=True, null=True)),
+                ('patients_done', models.IntegerField(default=0)),
+                ('counters', models.JSONField(default=dict)),
+                ('error', models.TextField(blank=True, null=True)),
+                ('started_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'db_table': 'score2_recompute_runs',
+                'ordering': ['-started_at'],
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.4 on 2026-10-17 15:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('score2', '0005_recompute_runs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StatisticsSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('data', models.JSONField()),
+                ('data_version', models.PositiveBigIntegerField()),
+                ('as_of', models.DateField()),
+                ('computed_at', models.DateTimeField()),
+            ],
+            options={
+                'db_table': 'score2_statistics_snapshot',
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-17 16:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('score2', '0006_statistics_snapshot'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='recomputerun',
+            name='status',
+            field=models.CharField(choices=[('running', 'W trakcie'), ('completed', 'Zakończone'), ('failed', 'Przerwane'), ('superseded', 'Zastąpione nowym przeliczeniem')], default='running', max_length=20),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.4 on 2026-10-17 18:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('score2', '0007_recompute_run_superseded'),
+    ]
+
+    operations = [
+        # Existing results are assumed to depend on the medians: the next change
+        # of the medians rescores them once and stores the real value
+        migrations.AddField(
+            model_name='score2result',
+            name='uses_reference_medians',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AlterField(
+            model_name='score2result',
+            name='uses_reference_medians',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -1,10 +1,16 @@
 from django.db import models
+from django.utils import timezone
 from django.core.validators import MinValueValidator, MaxValueValidator
 from patients.models import Patient, Visit
-from datetime import date
-import math
+from datetime import date, timedelta
 from decimal import Decimal
 from typing import Union, Literal
+import uuid
+
+from .engine import (
+    SCORE2_MODELS, SCORE2_DIABETES_MODELS, SCORE2_OP_MODELS,
+    DEFAULT_A1C_MMOL, DEFAULT_EGFR,
+)
 
 
 class Score2Result(models.Model):
@@ -72,6 +78,13 @@ class Score2Result(models.Model):
         choices=DATA_SOURCE_CHOICES,
         default='visit'
     )
+    # Set when an input was looked up in the reference medians, so a change of
+    # the medians makes the result out of date (see pipeline.changed_patients)
+    uses_reference_medians = models.BooleanField(default=False)
+    # Hash of the resolved inputs; recompute skips results whose inputs are unchanged
+    input_fingerprint = models.CharField(max_length=64, blank=True, default='')
+    engine_version = models.CharField(max_length=16, blank=True, default='')
+    
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
@@ -125,67 +138,7 @@ class Score2Result(models.Model):
         tchol = Score2Result._convert_to_float(tchol)
         hdl = Score2Result._convert_to_float(hdl)
         
-        # SCORE2 constants
-        BETA = {
-            "M": {
-                "cage": 0.3742, "smoke": 0.6012, "csbp": 0.2777,
-                "ctchol": 0.1458, "chdl": -0.2698,
-                "smoke_cage": -0.0755, "csbp_cage": -0.0255,
-                "ctchol_cage": -0.0281, "chdl_cage": 0.0426,
-                "baseline_survival": 0.9605,
-            },
-            "F": {
-                "cage": 0.4648, "smoke": 0.7744, "csbp": 0.3131,
-                "ctchol": 0.1002, "chdl": -0.2606,
-                "smoke_cage": -0.1088, "csbp_cage": -0.0277,
-                "ctchol_cage": -0.0226, "chdl_cage": 0.0613,
-                "baseline_survival": 0.9776,
-            },
-        }
-
-        SCALES = {
-            "M": {
-                "low": (-0.5699, 0.7476), "moderate": (-0.1565, 0.8009),
-                "high": (0.3207, 0.9360), "very_high": (0.5836, 0.8294),
-            },
-            "F": {
-                "low": (-0.7380, 0.7019), "moderate": (-0.3143, 0.7701),
-                "high": (0.5710, 0.9369), "very_high": (0.9412, 0.8329),
-            },
-        }
-        
-        MGDL_TO_MMOL = 1 / 38.67
-        
-        def _to_mmol(value: float) -> float:
-            """Convert mg/dL to mmol/L if needed"""
-            return value * MGDL_TO_MMOL if value > 20 else value
-
-        tchol = _to_mmol(tchol)
-        hdl = _to_mmol(hdl)
-
-        β = BETA[sex]
-        cage = (age - 60) / 5
-        csbp = (sbp - 120) / 20
-        ctchol = tchol - 6
-        chdl = (hdl - 1.3) / 0.5
-        smoke = 1 if smoker else 0
-
-        x = (
-            β["cage"]*cage + β["smoke"]*smoke + β["csbp"]*csbp +
-            β["ctchol"]*ctchol + β["chdl"]*chdl +
-            β["smoke_cage"]*smoke*cage + β["csbp_cage"]*csbp*cage +
-            β["ctchol_cage"]*ctchol*cage + β["chdl_cage"]*chdl*cage
-        )
-
-        S0 = β["baseline_survival"]
-        r_uncal = 1 - S0 ** math.exp(x)
-        r_uncal = max(1e-15, min(1 - 1e-15, r_uncal))
-
-        s1, s2 = SCALES[sex][region]
-        y = s1 + s2 * math.log(-math.log(1 - r_uncal))
-        r_cal = 1 - math.exp(-math.exp(y))
-
-        return round(r_cal * 100, 2)
+        return SCORE2_MODELS[sex, region].score(age, sbp, tchol, hdl, smoker)
     
     @staticmethod
     def calculate_score2_diabetes(age: float, sbp: float, tchol: float, hdl: float, 
@@ -206,42 +159,6 @@ class Score2Result(models.Model):
             a1c = Score2Result.calc_hb(a1c)
         if egfr is not None:
             egfr = Score2Result._convert_to_float(egfr)
-        
-        # SCORE2-Diabetes constants
-        BETA = {
-            "M": {
-                "cage": 0.5368, "smoke": 0.4774, "csbp": 0.1322, "diab": 0.6457,
-                "ctchol": 0.1102, "chdl": -0.1087, "smoke_cage": -0.0672,
-                "csbp_cage": -0.0268, "diab_cage": -0.0983, "ctchol_cage": -0.0181,
-                "chdl_cage": 0.0095, "cagediab": -0.0998, "ca1c": 0.0955,
-                "cegfr": -0.0591, "cegfr2": 0.0058, "ca1c_cage": -0.0134,
-                "cegfr_cage": 0.0115, "baseline_survival": 0.9605,
-            },
-            "F": {
-                "cage": 0.6624, "smoke": 0.6139, "csbp": 0.1421, "diab": 0.8096,
-                "ctchol": 0.1127, "chdl": -0.1568, "smoke_cage": -0.1122,
-                "csbp_cage": -0.0167, "diab_cage": -0.1272, "ctchol_cage": -0.0200,
-                "chdl_cage": 0.0186, "cagediab": -0.1180, "ca1c": 0.1173,
-                "cegfr": -0.0640, "cegfr2": 0.0062, "ca1c_cage": -0.0196,
-                "cegfr_cage": 0.0169, "baseline_survival": 0.9776,
-            },
-        }
-
-        SCALES = {
-            "M": {
-                "low": (-0.5699, 0.7476), "moderate": (-0.1565, 0.8009),
-                "high": (0.3207, 0.9360), "very_high": (0.5836, 0.8294),
-            },
-            "F": {
-                "low": (-0.7380, 0.7019), "moderate": (-0.3143, 0.7701),
-                "high": (0.5710, 0.9369), "very_high": (0.9412, 0.8329),
-            },
-        }
-        
-        MGDL_TO_MMOL = 1 / 38.67
-        
-        def _chol_to_mmol(value: float) -> float:
-            return value * MGDL_TO_MMOL if value > 20 else value
 
         if not 40 <= age <= 69:
             raise ValueError("SCORE2‑Diabetes validated for age 40‑69 years")
@@ -250,48 +167,13 @@ class Score2Result(models.Model):
             raise ValueError("age_at_diagnosis required for diabetes patients")
         
         if a1c is None:
-            a1c = 31.0  # ~5.0% (normal)
+            a1c = DEFAULT_A1C_MMOL
         if egfr is None:
-            egfr = 95.0  # typical normal value
+            egfr = DEFAULT_EGFR
 
-        tchol = _chol_to_mmol(tchol)
-        hdl = _chol_to_mmol(hdl)
-
-        β = BETA[sex]
-
-        cage = (age - 60) / 5
-        csbp = (sbp - 120) / 20
-        ctchol = tchol - 6
-        chdl = (hdl - 1.3) / 0.5
-        smoke = 1 if smoker else 0
-        diab = 1 if diabetes else 0
-        cagediab = diab * ((age_at_diagnosis - 50) / 5 if age_at_diagnosis else 0)
-        ca1c = (a1c - 31) / 9.34
-        ln_egfr = math.log(egfr)
-        cegfr = (ln_egfr - 4.5) / 0.15
-        cegfr2 = cegfr ** 2
-
-        x = (
-            β["cage"] * cage + β["smoke"] * smoke + β["csbp"] * csbp +
-            β["diab"] * diab + β["ctchol"] * ctchol + β["chdl"] * chdl +
-            β["smoke_cage"] * smoke * cage + β["csbp_cage"] * csbp * cage +
-            β["diab_cage"] * diab * cage + β["ctchol_cage"] * ctchol * cage +
-            β["chdl_cage"] * chdl * cage + β["cagediab"] * cagediab +
-            β["ca1c"] * ca1c + β["cegfr"] * cegfr + β["cegfr2"] * cegfr2 +
-            β["ca1c_cage"] * ca1c * cage + β["cegfr_cage"] * cegfr * cage
+        return SCORE2_DIABETES_MODELS[sex, region].score(
+            age, sbp, tchol, hdl, smoker, diabetes, age_at_diagnosis, a1c, egfr
         )
-
-        S0 = β["baseline_survival"]
-        r_uncal = 1 - S0 ** math.exp(x)
-
-        eps = 1e-15
-        r_uncal = max(eps, min(1 - eps, r_uncal))
-
-        s1, s2 = SCALES[sex][region]
-        y = s1 + s2 * math.log(-math.log(1 - r_uncal))
-        r_cal = 1 - math.exp(-math.exp(y))
-
-        return round(r_cal * 100, 2)
     
     @staticmethod
     def calculate_score2_op(age: float, sbp: float, tchol: float, hdl: float, 
@@ -303,74 +185,11 @@ class Score2Result(models.Model):
         sbp = Score2Result._convert_to_float(sbp)
         tchol = Score2Result._convert_to_float(tchol)
         hdl = Score2Result._convert_to_float(hdl)
-        
-        # SCORE2-OP constants
-        BETA = {
-            "M": {
-                "cage": 0.0634, "diab": 0.4245, "smoke": 0.3524, "csbp": 0.0094,
-                "ctchol": 0.0850, "chdl": -0.3564, "diab_cage": -0.0174,
-                "smoke_cage": -0.0247, "csbp_cage": -0.0005, "ctchol_cage": 0.0073,
-                "chdl_cage": 0.0091, "baseline_survival": 0.7576, "mean_lp": 0.0929,
-            },
-            "F": {
-                "cage": 0.0789, "diab": 0.6010, "smoke": 0.4921, "csbp": 0.0102,
-                "ctchol": 0.0605, "chdl": -0.3040, "diab_cage": -0.0107,
-                "smoke_cage": -0.0255, "csbp_cage": -0.0004, "ctchol_cage": -0.0009,
-                "chdl_cage": 0.0154, "baseline_survival": 0.8082, "mean_lp": 0.2290,
-            },
-        }
-
-        SCALES = {
-            "M": {
-                "low": (-0.34, 1.19), "moderate": (0.01, 1.25),
-                "high": (0.08, 1.15), "very_high": (0.05, 0.70),
-            },
-            "F": {
-                "low": (-0.52, 1.01), "moderate": (-0.10, 1.10),
-                "high": (0.38, 1.09), "very_high": (0.38, 0.69),
-            },
-        }
-
-        MGDL_TO_MMOL = 1 / 38.67
-
-        def _chol_to_mmol(value: float) -> float:
-            return value * MGDL_TO_MMOL if value > 20 else value
 
         if not 70 <= age <= 89:
             raise ValueError("SCORE2‐OP validated for age 70‐89 years")
 
-        tchol = _chol_to_mmol(tchol)
-        hdl = _chol_to_mmol(hdl)
-
-        β = BETA[sex]
-
-        cage = age - 73
-        csbp = sbp - 150
-        ctchol = tchol - 6
-        chdl = hdl - 1.4
-        diab = 1 if diabetes else 0
-        smoke = 1 if smoker else 0
-
-        x = (
-            β["cage"] * cage + β["diab"] * diab + β["smoke"] * smoke +
-            β["csbp"] * csbp + β["ctchol"] * ctchol + β["chdl"] * chdl +
-            β["diab_cage"] * diab * cage + β["smoke_cage"] * smoke * cage +
-            β["csbp_cage"] * csbp * cage + β["ctchol_cage"] * ctchol * cage +
-            β["chdl_cage"] * chdl * cage
-        )
-
-        S0 = β["baseline_survival"]
-        mlp = β["mean_lp"]
-        r_uncal = 1 - S0 ** math.exp(x - mlp)
-
-        eps = 1e-15
-        r_uncal = max(eps, min(1 - eps, r_uncal))
-
-        s1, s2 = SCALES[sex][region]
-        y = s1 + s2 * math.log(-math.log(1 - r_uncal))
-        r_cal = 1 - math.exp(-math.exp(y))
-
-        return round(r_cal * 100, 2)
+        return SCORE2_OP_MODELS[sex, region].score(age, sbp, tchol, hdl, smoker, diabetes)
     
     @staticmethod
     def get_risk_level(age: int, score_value, score_type: str = "SCORE2") -> str:
@@ -406,4 +225,131 @@ class Score2Result(models.Model):
                 else:
                     return 'very_high'
             else:
-                return 'age_out_of_range'
\ No newline at end of file
+                return 'age_out_of_range'
+
+class ReferenceStatistic(models.Model):
+    """Population median of a visit measurement for a 10-year age band, used to impute missing values"""
+    FIELD_CHOICES = [
+        ('cholesterol_total', 'Cholesterol całkowity'),
+        ('cholesterol_hdl', 'Cholesterol HDL'),
+        ('egfr', 'eGFR'),
+        ('hba1c', 'HbA1c'),
+    ]
+    
+    field = models.CharField(max_length=30, choices=FIELD_CHOICES)
+    age_band = models.IntegerField(help_text='Początek 10-letniego przedziału wieku (obecny wiek pacjenta)')
+    sex = models.CharField(max_length=1, blank=True, default='', help_text='Pusta wartość = obie płcie')
+    median = models.FloatField()
+    sample_size = models.IntegerField()
+    # When the median last changed; a refresh that yields the same value keeps it
+    computed_at = models.DateTimeField()
+    
+    class Meta:
+        db_table = 'score2_reference_statistics'
+        ordering = ['field', 'age_band', 'sex']
+        unique_together = ['field', 'age_band', 'sex']
+    
+    def __str__(self):
+        return f"{self.field} {self.age_band}-{self.age_band + 9} {self.sex or 'M+F'}: {self.median:.2f} (n={self.sample_size})"
+
+
+class RecomputeRun(models.Model):
+    """Checkpoint of a batch SCORE2 recompute over one range of patient ids.
+
+    Runs started together (parallel shards) share a group. Every chunk is
+    committed together with last_patient_id and the counters, so an
+    interrupted run resumes after the last committed chunk.
+    """
+    STATUS_CHOICES = [
+        ('running', 'W trakcie'),
+        ('completed', 'Zakończone'),
+        ('failed', 'Przerwane'),
+        ('superseded', 'Zastąpione nowym przeliczeniem'),
+    ]
+    
+    # A 'running' run with no checkpoint for this long was left behind by a killed process
+    STALE_AFTER = timedelta(minutes=15)
+    
+    group = models.UUIDField(default=uuid.uuid4, db_index=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='running')
+    # Eligibility (current age 40-89) is evaluated on this date for the whole run
+    as_of = models.DateField(default=date.today)
+    first_patient_id = models.BigIntegerField(blank=True, null=True)
+    last_patient_id = models.BigIntegerField(blank=True, null=True)
+    chunk_size = models.IntegerField()
+    force = models.BooleanField(default=False)
+    
+    checkpoint_patient_id = models.BigIntegerField(blank=True, null=True)
+    patients_done = models.IntegerField(default=0)
+    counters = models.JSONField(default=dict)
+    error = models.TextField(blank=True, null=True)
+    
+    started_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+    
+    class Meta:
+        db_table = 'score2_recompute_runs'
+        ordering = ['-started_at']
+    
+    def __str__(self):
+        return f"Przeliczenie #{self.pk} ({self.get_status_display()}, {self.patients_done} pacjentów)"
+    
+    @classmethod
+    def stopped(cls):
+        """Runs that failed or stopped checkpointing (left 'running' by a killed process)"""
+        return cls.objects.filter(
+            models.Q(status='failed')
+            | models.Q(status='running', updated_at__lt=timezone.now() - cls.STALE_AFTER)
+        )
+    
+    @classmethod
+    def unfinished_group(cls, group=None) -> list:
+        """Stopped runs of `group`, by default the most recent group; runs still
+        being executed are never handed out twice."""
+        if group is None:
+            latest = cls.objects.order_by('-started_at', '-pk').first()
+            if latest is None:
+                return []
+            group = latest.group
+        return list(cls.stopped().filter(group=group).order_by('pk'))
+    
+    @classmethod
+    def supersede_stopped(cls) -> int:
+        """Give up on every stopped run before a new pass starts; returns how many"""
+        return cls.stopped().update(status='superseded', finished_at=timezone.now(), updated_at=timezone.now())
+    
+    def scope(self, patients):
+        if self.first_patient_id is not None:
+            patients = patients.filter(pk__gte=self.first_patient_id)
+        if self.last_patient_id is not None:
+            patients = patients.filter(pk__lte=self.last_patient_id)
+        return patients
+    
+    def checkpoint(self, patient_id: int, patients: int, counters: dict):
+        self.checkpoint_patient_id = patient_id
+        self.patients_done += patients
+        self.counters = dict(counters)
+        self.save(update_fields=['checkpoint_patient_id', 'patients_done', 'counters', 'updated_at'])
+    
+    def finish(self, error: str = None):
+        self.status = 'failed' if error else 'completed'
+        self.error = error
+        self.finished_at = timezone.now()
+        self.save(update_fields=['status', 'error', 'finished_at', 'updated_at'])
+
+
+class StatisticsSnapshot(models.Model):
+    """Precomputed numbers of the SCORE2 dashboard (see score2.stats), a single row"""
+    data = models.JSONField()
+    # patients.models.data_version() the numbers were computed at
+    data_version = models.PositiveBigIntegerField()
+    # Eligibility (current age 40-89) was evaluated on this date
+    as_of = models.DateField()
+    computed_at = models.DateTimeField()
+
+    class Meta:
+        db_table = 'score2_statistics_snapshot'
+
+    def is_current(self, version: int, today: date) -> bool:
+        return self.data_version == version and self.as_of == today
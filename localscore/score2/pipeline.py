@@ -0,0 +1,354 @@
+import logging
+import multiprocessing
+import uuid
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import django
+import numpy as np
+from dateutil.relativedelta import relativedelta
+from django.db import connections, transaction
+from django.db.models import DurationField, Exists, F, Max, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Cast, Greatest
+from django.utils import timezone
+
+from patients.models import Patient, Visit, refresh_summary
+from patients.snapshot import PatientClinicalSnapshot
+from . import engine
+from .models import RecomputeRun, ReferenceStatistic, Score2Result
+
+logger = logging.getLogger('score2')
+
+DEFAULT_CHUNK_SIZE = 500
+
+# Current ages at which eligibility or the score type changes
+AGE_BOUNDARIES = (40, 70, 90)
+
+BATCH_CALCULATORS = {
+    'SCORE2': engine.score2_batch,
+    'SCORE2-Diabetes': engine.score2_diabetes_batch,
+    'SCORE2-OP': engine.score2_op_batch,
+}
+
+# Everything except the (patient, visit) key is rewritten on conflict,
+# which leaves the row as if it had been deleted and created again.
+UPSERT_FIELDS = [
+    f.name for f in Score2Result._meta.concrete_fields
+    if f.name not in ('id', 'patient', 'visit')
+]
+
+
+def eligible_patients(today: date = None):
+    """Patients with visits whose current age is 40-89"""
+    today = today or date.today()
+    return Patient.objects.filter(
+        Exists(Visit.objects.filter(patient=OuterRef('pk'))),
+        date_of_birth__gt=today - relativedelta(years=90),
+        date_of_birth__lte=today - relativedelta(years=40),
+    )
+
+
+def changed_patients(patients, today: date = None):
+    """Narrow a patient queryset to those whose stored result may be out of date.
+
+    A patient is kept when the latest visit has no result, or its result
+    is older than a change to the patient, their visits or diagnoses
+    (inputs_changed_at), was computed by another engine version, or looked
+    up reference medians before the medians last changed.
+    Patients whose current age crossed one of AGE_BOUNDARIES since their
+    score was computed are kept as well. Everything else is skipped without
+    loading it; recompute_chunk still compares input fingerprints.
+    """
+    today = today or date.today()
+    latest_visit = Visit.objects.filter(patient=OuterRef('pk')).order_by('-visit_date').values('pk')[:1]
+    up_to_date = Score2Result.objects.filter(
+        visit_id=OuterRef('latest_visit_id'),
+        engine_version=engine.ENGINE_VERSION,
+        # GREATEST skips the NULL of patients never marked as changed
+        updated_at__gte=Greatest(OuterRef('updated_at'), OuterRef('inputs_changed_at')),
+    )
+    medians_at = ReferenceStatistic.objects.aggregate(at=Max('computed_at'))['at']
+    if medians_at is not None:
+        up_to_date = up_to_date.filter(
+            Q(updated_at__gte=medians_at) | Q(uses_reference_medians=False)
+        )
+    crossed = Q()
+    for years in AGE_BOUNDARIES:
+        crossed |= Q(
+            date_of_birth__lte=today - relativedelta(years=years),
+            score_computed_at__lt=F('date_of_birth') + Cast(Value(f'{years} years'), DurationField()),
+        )
+    return patients.alias(latest_visit_id=Subquery(latest_visit)).filter(~Exists(up_to_date) | crossed)
+
+
+def iter_patient_chunks(patients, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[List[Patient]]:
+    """Walk a patient queryset in primary-key order, one chunk per query"""
+    patients = patients.order_by('pk')
+    last_pk = None
+    while True:
+        page = patients if last_pk is None else patients.filter(pk__gt=last_pk)
+        chunk = list(page[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        last_pk = chunk[-1].pk
+
+
+def new_counters() -> Dict[str, int]:
+    return {
+        'total_processed': 0,
+        'successful_calculations': 0,
+        'failed_calculations': 0,
+        'excluded_patients': 0,
+        'skipped_unchanged': 0,
+    }
+
+
+def recompute_chunk(patients: List[Patient], counters: Dict[str, int], force: bool = False) -> List[Score2Result]:
+    """Score the latest visit of each patient in the chunk and upsert the results.
+
+    Unless `force` is set, visits whose stored result has the same input
+    fingerprint are not rescored; only the result's timestamp is renewed.
+    """
+    from score2.views import CalculateScore2View
+    calculator = CalculateScore2View()
+    snapshots = PatientClinicalSnapshot.load_many(patients)
+
+    # Stage 1: resolve inputs (fallbacks, medians, eligibility) in memory
+    prepared = []
+    for patient in patients:
+        snapshot = snapshots[patient.pk]
+        latest_visit = snapshot.latest_visit
+        if not latest_visit:
+            logger.warning(f"NO_VISIT;{patient.pesel};;;No visits found;")
+            continue
+        try:
+            result_data, calculation = calculator._prepare_result_data(patient, latest_visit, snapshot)
+        except Exception as e:
+            logger.error(f"ERROR;{patient.pesel};;;Processing error;{str(e)}")
+            counters['failed_calculations'] += 1
+            continue
+        prepared.append((result_data, calculation))
+
+    unchanged = {}  # visit id -> patient id
+    if not force:
+        stored = _stored_fingerprints([result_data['visit'].pk for result_data, _ in prepared])
+        changed = []
+        for result_data, calculation in prepared:
+            if stored.get(result_data['visit'].pk) == result_data['input_fingerprint']:
+                unchanged[result_data['visit'].pk] = result_data['patient'].pk
+            else:
+                changed.append((result_data, calculation))
+        counters['skipped_unchanged'] += len(unchanged)
+        prepared = changed
+    if unchanged:
+        # Checked against the current inputs (the fingerprint covers the engine
+        # version); the newer timestamp keeps them out of changed_patients()
+        Score2Result.objects.filter(visit_id__in=list(unchanged)).update(
+            updated_at=timezone.now(), engine_version=engine.ENGINE_VERSION,
+        )
+
+    rows = []
+    pending = defaultdict(list)
+    for result_data, calculation in prepared:
+        rows.append(result_data)
+        if calculation is not None:
+            pending[calculation.score_type].append((result_data, calculation))
+
+    # Stage 2: one vectorized call per score type
+    for score_type, items in pending.items():
+        _score_group(calculator, score_type, items)
+
+    # Stage 3: one upsert for the whole chunk
+    results = []
+    if rows:
+        results = Score2Result.objects.bulk_create(
+            [Score2Result(**result_data) for result_data in rows],
+            update_conflicts=True,
+            unique_fields=['patient', 'visit'],
+            update_fields=UPSERT_FIELDS,
+        )
+    if rows or unchanged:
+        # Neither write sends signals; refresh the patients' list columns here
+        refresh_summary(Patient.objects.filter(
+            pk__in=[result_data['patient'].pk for result_data in rows] + list(unchanged.values())
+        ))
+
+    for result in results:
+        counters['total_processed'] += 1
+        if result.is_calculation_successful:
+            counters['successful_calculations'] += 1
+        elif result.missing_data_reason:
+            counters['failed_calculations'] += 1
+        else:
+            counters['excluded_patients'] += 1
+    return results
+
+
+def _stored_fingerprints(visit_ids: List[int]) -> Dict[int, str]:
+    return dict(
+        Score2Result.objects.filter(visit_id__in=visit_ids).order_by().values_list('visit_id', 'input_fingerprint')
+    )
+
+
+def _score_group(calculator, score_type: str, items):
+    columns = {
+        name: [calculation.inputs[name] for _, calculation in items]
+        for name in items[0][1].inputs
+    }
+    scores = BATCH_CALCULATORS[score_type](**columns)
+    risk_levels = engine.risk_level_batch(columns['age'], scores, score_type)
+
+    for (result_data, calculation), score_value, risk_level in zip(items, scores, risk_levels):
+        if np.isnan(score_value):
+            # Rejected input: let the scalar calculator raise the usual error
+            calculator._run_calculation(result_data, calculation)
+            continue
+        try:
+            calculator._apply_score(result_data, calculation, float(score_value), str(risk_level))
+        except Exception as e:
+            calculator._apply_error(result_data, calculation, e)
+
+
+def recompute_all(patients=None, chunk_size: int = DEFAULT_CHUNK_SIZE, progress=None,
+                  force: bool = False, run: RecomputeRun = None) -> Dict[str, int]:
+    """Recompute SCORE2 for the latest visit of every eligible patient.
+
+    Each chunk commits together with a checkpoint on `run` (a new run unless
+    one is given to resume), so progress is visible to other connections and
+    an interrupted run continues after its last committed chunk.
+    `progress(done, total, counters)` is called after each chunk.
+    """
+    if run is None:
+        run = RecomputeRun.objects.create(chunk_size=chunk_size, force=force)
+    elif run.status != 'running':
+        run.status = 'running'
+        run.save(update_fields=['status', 'updated_at'])
+    if patients is None:
+        patients = eligible_patients(run.as_of)
+    patients = run.scope(patients)
+    counters = {**new_counters(), **run.counters}
+
+    remaining = patients if run.force else changed_patients(patients, run.as_of)
+    if run.checkpoint_patient_id is not None:
+        remaining = remaining.filter(pk__gt=run.checkpoint_patient_id)
+        total = run.patients_done + remaining.count()
+        logger.info(f"BATCH_RESUME;;;Resuming run {run.pk} after patient id {run.checkpoint_patient_id};"
+                    f"{run.patients_done}/{total} patients done;")
+    else:
+        total = remaining.count()
+        if not run.force:
+            # Patients left out by changed_patients count as unchanged
+            counters['skipped_unchanged'] += patients.count() - total
+            run.counters = dict(counters)
+            run.save(update_fields=['counters', 'updated_at'])
+        logger.info(f"BATCH_START;;;Starting batch calculation;{total} patients;")
+
+    try:
+        for chunk in iter_patient_chunks(remaining, run.chunk_size):
+            with transaction.atomic():
+                recompute_chunk(chunk, counters, run.force)
+                run.checkpoint(chunk[-1].pk, len(chunk), counters)
+            if progress is not None:
+                progress(run.patients_done, total, counters)
+    except Exception as e:
+        logger.error(f"ERROR;;;Run {run.pk} interrupted after patient id {run.checkpoint_patient_id};{str(e)}")
+        run.finish(error=str(e))
+        raise
+    run.finish()
+
+    logger.info(
+        f"BATCH_END;;;Processed: {counters['total_processed']};"
+        f"Success: {counters['successful_calculations']} Failed: {counters['failed_calculations']} "
+        f"Excluded: {counters['excluded_patients']} Unchanged: {counters['skipped_unchanged']};"
+    )
+    return counters
+
+
+def resume(workers: int = 1, progress=None, group=None) -> Optional[Dict[str, int]]:
+    """Continue the unfinished runs of `group` (by default the most recent recompute); None if there are none"""
+    runs = RecomputeRun.unfinished_group(group)
+    if not runs:
+        return None
+    if workers == 1:
+        for run in runs:
+            recompute_all(run=run, progress=progress)
+        return group_counters(runs[0].group)
+    return recompute_parallel(workers, progress=progress, runs=runs)
+
+
+def group_counters(group) -> Dict[str, int]:
+    """Counters summed over all runs of a group"""
+    counters = new_counters()
+    for run_counters in RecomputeRun.objects.filter(group=group).values_list('counters', flat=True):
+        for key, value in run_counters.items():
+            counters[key] = counters.get(key, 0) + value
+    return counters
+
+
+def shard_ranges(patients, shards: int) -> List[Tuple[int, int]]:
+    """Split patients into at most `shards` inclusive (first_pk, last_pk) ranges of similar size"""
+    ids = list(patients.order_by('pk').values_list('pk', flat=True))
+    if not ids:
+        return []
+    shards = max(1, min(shards, len(ids)))
+    size = -(-len(ids) // shards)
+    return [(ids[i], ids[min(i + size, len(ids)) - 1]) for i in range(0, len(ids), size)]
+
+
+def _recompute_shard(run_id: int) -> Dict[str, int]:
+    try:
+        return recompute_all(run=RecomputeRun.objects.get(pk=run_id))
+    finally:
+        connections.close_all()
+
+
+def recompute_parallel(workers: int, chunk_size: int = DEFAULT_CHUNK_SIZE, progress=None,
+                       force: bool = False, runs: List[RecomputeRun] = None) -> Dict[str, int]:
+    """Recompute all eligible patients in `workers` processes, one id-range shard (run) each.
+
+    Pass `runs` to resume the shards of an interrupted recompute instead of
+    starting new ones. Workers are spawned rather than forked so none of them
+    shares the parent's database connection; django.setup() runs before any
+    model module is unpickled in the child. `progress(shards_done, shards, counters)`
+    is called as shards finish.
+    """
+    if runs is None:
+        today = date.today()
+        group = uuid.uuid4()
+        patients = eligible_patients(today)
+        ranges = shard_ranges(patients if force else changed_patients(patients, today), workers)
+        # Contiguous, open-ended shards: each starts right after the previous one ends,
+        # so every eligible patient, changed or not, falls into exactly one run
+        ends = [last_pk for _, last_pk in ranges[:-1]]
+        ranges = list(zip([None] + [pk + 1 for pk in ends], ends + [None])) if ranges else []
+        runs = [
+            RecomputeRun.objects.create(group=group, as_of=today, first_patient_id=first_pk,
+                                        last_patient_id=last_pk, chunk_size=chunk_size, force=force)
+            for first_pk, last_pk in ranges
+        ]
+    if not runs:
+        return new_counters()
+
+    logger.info(f"PARALLEL_START;;;Starting parallel calculation;{len(runs)} shards;")
+
+    connections.close_all()
+    with ProcessPoolExecutor(max_workers=min(workers, len(runs)), mp_context=multiprocessing.get_context('spawn'),
+                             initializer=django.setup) as executor:
+        futures = [executor.submit(_recompute_shard, run.pk) for run in runs]
+        finished = new_counters()
+        for done, future in enumerate(as_completed(futures), start=1):
+            for key, value in future.result().items():
+                finished[key] += value
+            if progress is not None:
+                progress(done, len(runs), finished)
+
+    counters = group_counters(runs[0].group)
+    logger.info(
+        f"PARALLEL_END;;;Processed: {counters['total_processed']};"
+        f"Success: {counters['successful_calculations']} Failed: {counters['failed_calculations']} "
+        f"Excluded: {counters['excluded_patients']} Unchanged: {counters['skipped_unchanged']};"
+    )
+    return counters
@@ -0,0 +1,127 @@
+import logging
+import threading
+import time
+from typing import Optional
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from jobs.models import BackgroundJob
+from .models import ReferenceStatistic
+
+logger = logging.getLogger('score2')
+
+# How long a process keeps its copy of the table before re-reading it.
+# Refreshes done in this process invalidate the copy immediately.
+CACHE_TTL = 300
+
+REFRESH_JOB_KIND = 'score2_reference_refresh'
+
+# One pass over all visits: unpivot the four measurements, bucket patients by
+# current age into 10-year bands and take the median per (field, band, sex)
+# and per (field, band) for both sexes together ('').
+# The rows are upserted, and computed_at only moves for a median that changed,
+# so MAX(computed_at) tells when the medians last changed (see
+# pipeline.changed_patients). Rows no longer produced are deleted and counted.
+_TABLE = ReferenceStatistic._meta.db_table
+REFRESH_SQL = f"""
+    WITH fresh AS (
+        SELECT field,
+               age_band,
+               CASE WHEN GROUPING(gender) = 1 THEN '' ELSE gender END AS sex,
+               percentile_cont(0.5) WITHIN GROUP (ORDER BY value) AS median,
+               count(*) AS sample_size
+        FROM (
+            SELECT m.field,
+                   (date_part('year', age(CURRENT_DATE, p.date_of_birth))::int / 10) * 10 AS age_band,
+                   p.gender,
+                   m.value::float8 AS value
+            FROM visits v
+            JOIN patients p ON p.id = v.patient_id
+            CROSS JOIN LATERAL (VALUES
+                ('cholesterol_total', v.cholesterol_total),
+                ('cholesterol_hdl', v.cholesterol_hdl),
+                ('egfr', v.egfr),
+                ('hba1c', v.hba1c)
+            ) AS m(field, value)
+            WHERE m.value IS NOT NULL
+        ) AS measurements
+        GROUP BY GROUPING SETS ((field, age_band, gender), (field, age_band))
+    ), upserted AS (
+        INSERT INTO {_TABLE} (field, age_band, sex, median, sample_size, computed_at)
+        SELECT field, age_band, sex, median, sample_size, now() FROM fresh
+        ON CONFLICT (field, age_band, sex) DO UPDATE SET
+            median = EXCLUDED.median,
+            sample_size = EXCLUDED.sample_size,
+            computed_at = CASE WHEN {_TABLE}.median IS DISTINCT FROM EXCLUDED.median
+                               THEN EXCLUDED.computed_at ELSE {_TABLE}.computed_at END
+        RETURNING 1
+    ), removed AS (
+        DELETE FROM {_TABLE} r
+        WHERE NOT EXISTS (SELECT 1 FROM fresh f WHERE (f.field, f.age_band, f.sex) = (r.field, r.age_band, r.sex))
+        RETURNING 1
+    )
+    SELECT (SELECT count(*) FROM upserted), (SELECT count(*) FROM removed)
+"""
+
+_lock = threading.Lock()
+_medians = {}
+_loaded_at = None
+
+
+def refresh_reference_statistics():
+    """Recompute the whole reference table set-based in PostgreSQL; returns the number of medians"""
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            # Overlapping refreshes (import worker, visit edits) run one after another,
+            # so each compares its medians with the ones the other committed.
+            cursor.execute('SELECT pg_advisory_xact_lock(hashtext(%s))', [_TABLE])
+            cursor.execute(REFRESH_SQL)
+            rows, removed = cursor.fetchone()
+            if removed:
+                # A median that disappeared is a change too
+                ReferenceStatistic.objects.update(computed_at=timezone.now())
+    invalidate_cache()
+    logger.info(f"REFERENCE_REFRESH;;;Reference statistics recomputed;{rows} rows;")
+    return rows
+
+
+def schedule_refresh():
+    """Queue a refresh of the reference table for the worker once the current transaction commits.
+
+    The refresh is a pass over every visit, so it never runs in a web
+    request; edits made while a refresh job is still waiting share it.
+    """
+    transaction.on_commit(_enqueue_refresh)
+
+
+def _enqueue_refresh():
+    if not BackgroundJob.objects.filter(kind=REFRESH_JOB_KIND, status='queued').exists():
+        BackgroundJob.enqueue(REFRESH_JOB_KIND)
+
+
+def invalidate_cache():
+    global _loaded_at
+    with _lock:
+        _loaded_at = None
+
+
+def _load():
+    global _medians, _loaded_at
+    medians = {
+        (field, age_band, sex): median
+        for field, age_band, sex, median in ReferenceStatistic.objects.values_list(
+            'field', 'age_band', 'sex', 'median'
+        )
+    }
+    with _lock:
+        _medians = medians
+        _loaded_at = time.monotonic()
+
+
+def get_reference_median(field: str, age_band: int, sex: str = '') -> Optional[float]:
+    """Median of `field` for patients currently in the 10-year band starting at `age_band`"""
+    loaded_at = _loaded_at
+    if loaded_at is None or time.monotonic() - loaded_at > CACHE_TTL:
+        _load()
+    return _medians.get((field, age_band, sex))
@@ -0,0 +1,11 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from patients.models import Patient, refresh_summary
+from .models import Score2Result
+
+
+@receiver([post_save, post_delete], sender=Score2Result)
+def score2_result_changed(sender, instance, **kwargs):
+    # Bulk upserts in score2.pipeline send no signals and refresh per chunk instead
+    refresh_summary(Patient.objects.filter(pk=instance.patient_id))
@@ -0,0 +1,152 @@
+import logging
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import date
+
+from django.db import connection, transaction
+from django.db.models import Count, Sum
+from django.utils import timezone
+
+from patients.models import Patient, data_version
+from patients.stats import list_statistics_aggregates
+from .models import Score2Result, StatisticsSnapshot
+
+logger = logging.getLogger('score2')
+
+# How long a process serves its copy before checking the stored row again.
+# A row older than the data is still served while one refresh runs in the background.
+CACHE_TTL = 30
+
+PATIENT_COUNTS = ('total_patients', 'eligible_patients', 'patients_with_visits', 'patients_with_scores')
+
+_lock = threading.Lock()
+_data = None
+_checked_at = None
+_refreshing = False
+
+
+def compute_statistics(today: date) -> dict:
+    """Dashboard numbers from two aggregate queries: patient counts and results grouped by type and risk level"""
+    counts = Patient.objects.aggregate(**list_statistics_aggregates(today))
+    groups = (
+        Score2Result.objects.order_by()
+        .values_list('score_type', 'risk_level', 'is_calculation_successful')
+        .annotate(count=Count('pk'), total=Sum('score_value'))
+    )
+    return {
+        'patients': {name: counts[name] for name in PATIENT_COUNTS},
+        # JSON-friendly rows; dashboard_context() orders and sums them
+        'groups': [
+            [score_type, risk_level, successful, count, None if total is None else float(total)]
+            for score_type, risk_level, successful, count, total in groups
+        ],
+    }
+
+
+def refresh_statistics() -> dict:
+    """Recompute the dashboard snapshot row and this process's copy"""
+    today = date.today()
+    # Read first: changes committed during the computation leave the row stale
+    version = data_version()
+    data = compute_statistics(today)
+    StatisticsSnapshot.objects.update_or_create(pk=1, defaults={
+        'data': data, 'data_version': version, 'as_of': today, 'computed_at': timezone.now(),
+    })
+    _store(data)
+    logger.info(f"STATS_REFRESH;;;Dashboard statistics recomputed;{len(data['groups'])} groups;")
+    return data
+
+
+def schedule_statistics_refresh():
+    """Refresh the dashboard snapshot once the current transaction commits"""
+    transaction.on_commit(refresh_statistics)
+
+
+def get_statistics() -> dict:
+    """Dashboard numbers, stale-while-revalidate.
+
+    Served from this process's copy for CACHE_TTL, then from the stored row.
+    When the row predates the current data version (an import or recompute
+    has committed since) it is still served, and one background thread per
+    process recomputes it, so the dashboard never waits for the aggregates.
+    Only the very first request, before any row exists, computes inline.
+    """
+    data, checked_at = _data, _checked_at
+    if data is not None and time.monotonic() - checked_at < CACHE_TTL:
+        return data
+
+    snapshot = StatisticsSnapshot.objects.filter(pk=1).first()
+    if snapshot is None:
+        return refresh_statistics()
+    _store(snapshot.data)
+    if not snapshot.is_current(data_version(), date.today()):
+        _revalidate()
+    return snapshot.data
+
+
+def _store(data: dict):
+    global _data, _checked_at
+    with _lock:
+        _data = data
+        _checked_at = time.monotonic()
+
+
+def _revalidate():
+    global _refreshing
+    with _lock:
+        if _refreshing:
+            return
+        _refreshing = True
+    threading.Thread(target=_refresh_in_background, daemon=True).start()
+
+
+def _refresh_in_background():
+    global _refreshing
+    try:
+        refresh_statistics()
+    except Exception as e:
+        logger.error(f"STATS_REFRESH;;;Background refresh failed;{str(e)};")
+    finally:
+        with _lock:
+            _refreshing = False
+        # The thread's connection is not closed by the request cycle
+        connection.close()
+
+
+def dashboard_context(data: dict) -> dict:
+    """Template context of the dashboard from snapshot data"""
+    by_type = defaultdict(lambda: [0, 0.0])
+    by_risk = Counter()
+    failed_calculations = 0
+    for score_type, risk_level, successful, count, total in data['groups']:
+        if not successful:
+            failed_calculations += count
+            continue
+        by_type[score_type][0] += count
+        by_type[score_type][1] += total or 0.0
+        by_risk[risk_level] += count
+
+    score_type_stats = {}
+    for score_type, _ in Score2Result.SCORE_TYPE_CHOICES:
+        count, total = by_type.get(score_type, (0, 0.0))
+        if count > 0:
+            score_type_stats[score_type] = {'count': count, 'avg_score': round(total / count, 2)}
+
+    risk_stats = {}
+    total_successful = sum(by_risk.values())
+    for risk_level, display_name in Score2Result.RISK_LEVEL_CHOICES:
+        count = by_risk[risk_level]
+        if count > 0:
+            risk_stats[risk_level] = {
+                'count': count,
+                'display_name': display_name,
+                'percentage': round(count / total_successful * 100, 1),
+            }
+
+    return {
+        **data['patients'],
+        'score_type_stats': score_type_stats,
+        'risk_stats': risk_stats,
+        'failed_calculations': failed_calculations,
+    }
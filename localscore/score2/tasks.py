@@ -0,0 +1,32 @@
+from . import pipeline, reference
+from .models import RecomputeRun
+from .stats import schedule_statistics_refresh
+
+
+def calculate_all(job):
+    """Background job: recompute SCORE2 for all eligible patients.
+
+    The job stores the run group it starts in its params. Claimed again after
+    its worker died, it continues that group from the last checkpoint; any
+    other unfinished runs are superseded and a new pass covers everyone.
+    """
+    progress = lambda done, total, counters: job.set_progress(done, total, dict(counters))
+    results = None
+    if job.params.get('group') and job.attempts > 1:
+        results = pipeline.resume(progress=progress, group=job.params['group'])
+    if results is None:
+        RecomputeRun.supersede_stopped()
+        run = RecomputeRun.objects.create(
+            chunk_size=job.params.get('chunk_size', pipeline.DEFAULT_CHUNK_SIZE),
+            force=job.params.get('force', False),
+        )
+        job.params['group'] = str(run.group)
+        job.save(update_fields=['params', 'updated_at'])
+        results = pipeline.recompute_all(progress=progress, run=run)
+    schedule_statistics_refresh()
+    return results
+
+
+def refresh_reference(job):
+    """Background job: recompute the reference medians (queued by reference.schedule_refresh)"""
+    return {'rows': reference.refresh_reference_statistics()}
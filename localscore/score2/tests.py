@@ -1,3 +1,679 @@
-from django.test import TestCase
+from concurrent.futures import Future
+from datetime import date, datetime
+from decimal import Decimal
+import math
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+from django.db import connection, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.urls import reverse
+from django.utils import timezone
+import numpy as np
+
+from jobs.models import BackgroundJob
+from jobs.runner import run_job
+from patients.models import Patient, Visit
+from patients.snapshot import ChronicDiagnosis, PatientClinicalSnapshot
+from .models import RecomputeRun, ReferenceStatistic, Score2Result
+from .views import CalculateScore2View
+from . import analytics, engine, pipeline, reference, stats, tasks
+
+
+def _cohort(n, age_range, seed):
+    """Random but clinically plausible inputs; some cholesterol values in mg/dL"""
+    rng = np.random.default_rng(seed)
+    tchol = rng.uniform(3.0, 8.5, n)
+    hdl = rng.uniform(0.7, 2.4, n)
+    mgdl = rng.random(n) < 0.2
+    tchol[mgdl] *= 38.67
+    hdl[mgdl] *= 38.67
+    return {
+        'age': rng.integers(age_range[0], age_range[1] + 1, n).astype(float),
+        'sbp': rng.integers(95, 200, n).astype(float),
+        'tchol': tchol,
+        'hdl': hdl,
+        'smoker': rng.random(n) < 0.3,
+        'diabetes': rng.random(n) < 0.5,
+        'age_at_diagnosis': rng.uniform(25, 65, n).round(2),
+        'a1c': rng.uniform(5.0, 11.0, n).round(1),
+        'egfr': rng.uniform(25, 120, n).round(1),
+        'sex': rng.choice(engine.SEXES, n),
+        'region': rng.choice(engine.REGIONS, n),
+    }
+
+
+# Frozen copy of the original per-call formulas (before the batch engine),
+# kept as an independent oracle: the engine and the compiled per-(sex, region)
+# models are both built from engine.py's own coefficient tables.
+_BASELINE_SCALES = {
+    'M': {'low': (-0.5699, 0.7476), 'moderate': (-0.1565, 0.8009),
+          'high': (0.3207, 0.9360), 'very_high': (0.5836, 0.8294)},
+    'F': {'low': (-0.7380, 0.7019), 'moderate': (-0.3143, 0.7701),
+          'high': (0.5710, 0.9369), 'very_high': (0.9412, 0.8329)},
+}
+_BASELINE_OP_SCALES = {
+    'M': {'low': (-0.34, 1.19), 'moderate': (0.01, 1.25), 'high': (0.08, 1.15), 'very_high': (0.05, 0.70)},
+    'F': {'low': (-0.52, 1.01), 'moderate': (-0.10, 1.10), 'high': (0.38, 1.09), 'very_high': (0.38, 0.69)},
+}
+_BASELINE_BETA = {
+    'M': {'cage': 0.3742, 'smoke': 0.6012, 'csbp': 0.2777, 'ctchol': 0.1458, 'chdl': -0.2698,
+          'smoke_cage': -0.0755, 'csbp_cage': -0.0255, 'ctchol_cage': -0.0281, 'chdl_cage': 0.0426,
+          'baseline_survival': 0.9605},
+    'F': {'cage': 0.4648, 'smoke': 0.7744, 'csbp': 0.3131, 'ctchol': 0.1002, 'chdl': -0.2606,
+          'smoke_cage': -0.1088, 'csbp_cage': -0.0277, 'ctchol_cage': -0.0226, 'chdl_cage': 0.0613,
+          'baseline_survival': 0.9776},
+}
+_BASELINE_DIABETES_BETA = {
+    'M': {'cage': 0.5368, 'smoke': 0.4774, 'csbp': 0.1322, 'diab': 0.6457, 'ctchol': 0.1102, 'chdl': -0.1087,
+          'smoke_cage': -0.0672, 'csbp_cage': -0.0268, 'diab_cage': -0.0983, 'ctchol_cage': -0.0181,
+          'chdl_cage': 0.0095, 'cagediab': -0.0998, 'ca1c': 0.0955, 'cegfr': -0.0591, 'cegfr2': 0.0058,
+          'ca1c_cage': -0.0134, 'cegfr_cage': 0.0115, 'baseline_survival': 0.9605},
+    'F': {'cage': 0.6624, 'smoke': 0.6139, 'csbp': 0.1421, 'diab': 0.8096, 'ctchol': 0.1127, 'chdl': -0.1568,
+          'smoke_cage': -0.1122, 'csbp_cage': -0.0167, 'diab_cage': -0.1272, 'ctchol_cage': -0.0200,
+          'chdl_cage': 0.0186, 'cagediab': -0.1180, 'ca1c': 0.1173, 'cegfr': -0.0640, 'cegfr2': 0.0062,
+          'ca1c_cage': -0.0196, 'cegfr_cage': 0.0169, 'baseline_survival': 0.9776},
+}
+_BASELINE_OP_BETA = {
+    'M': {'cage': 0.0634, 'diab': 0.4245, 'smoke': 0.3524, 'csbp': 0.0094, 'ctchol': 0.0850, 'chdl': -0.3564,
+          'diab_cage': -0.0174, 'smoke_cage': -0.0247, 'csbp_cage': -0.0005, 'ctchol_cage': 0.0073,
+          'chdl_cage': 0.0091, 'baseline_survival': 0.7576, 'mean_lp': 0.0929},
+    'F': {'cage': 0.0789, 'diab': 0.6010, 'smoke': 0.4921, 'csbp': 0.0102, 'ctchol': 0.0605, 'chdl': -0.3040,
+          'diab_cage': -0.0107, 'smoke_cage': -0.0255, 'csbp_cage': -0.0004, 'ctchol_cage': -0.0009,
+          'chdl_cage': 0.0154, 'baseline_survival': 0.8082, 'mean_lp': 0.2290},
+}
+
+
+def _baseline_mmol(value):
+    value = float(value)
+    return value / 38.67 if value > 20 else value
+
+
+def _baseline_calibrate(r_uncal, scales):
+    r_uncal = max(1e-15, min(1 - 1e-15, r_uncal))
+    s1, s2 = scales
+    return round((1 - math.exp(-math.exp(s1 + s2 * math.log(-math.log(1 - r_uncal))))) * 100, 2)
+
+
+def _baseline_score2(age, sbp, tchol, hdl, smoker, sex, region):
+    b = _BASELINE_BETA[sex]
+    cage, csbp = (float(age) - 60) / 5, (float(sbp) - 120) / 20
+    ctchol, chdl = _baseline_mmol(tchol) - 6, (_baseline_mmol(hdl) - 1.3) / 0.5
+    smoke = 1 if smoker else 0
+    x = (b['cage'] * cage + b['smoke'] * smoke + b['csbp'] * csbp + b['ctchol'] * ctchol + b['chdl'] * chdl
+         + b['smoke_cage'] * smoke * cage + b['csbp_cage'] * csbp * cage
+         + b['ctchol_cage'] * ctchol * cage + b['chdl_cage'] * chdl * cage)
+    return _baseline_calibrate(1 - b['baseline_survival'] ** math.exp(x), _BASELINE_SCALES[sex][region])
+
+
+def _baseline_score2_diabetes(age, sbp, tchol, hdl, smoker, diabetes, age_at_diagnosis, a1c, egfr, sex, region):
+    b = _BASELINE_DIABETES_BETA[sex]
+    a1c = 31.0 if a1c is None else (float(a1c) - 2.15) * 10.929
+    egfr = 95.0 if egfr is None else float(egfr)
+    cage, csbp = (float(age) - 60) / 5, (float(sbp) - 120) / 20
+    ctchol, chdl = _baseline_mmol(tchol) - 6, (_baseline_mmol(hdl) - 1.3) / 0.5
+    smoke, diab = (1 if smoker else 0), (1 if diabetes else 0)
+    cagediab = diab * ((float(age_at_diagnosis) - 50) / 5 if age_at_diagnosis else 0)
+    ca1c = (a1c - 31) / 9.34
+    cegfr = (math.log(egfr) - 4.5) / 0.15
+    x = (b['cage'] * cage + b['smoke'] * smoke + b['csbp'] * csbp + b['diab'] * diab
+         + b['ctchol'] * ctchol + b['chdl'] * chdl + b['smoke_cage'] * smoke * cage
+         + b['csbp_cage'] * csbp * cage + b['diab_cage'] * diab * cage + b['ctchol_cage'] * ctchol * cage
+         + b['chdl_cage'] * chdl * cage + b['cagediab'] * cagediab + b['ca1c'] * ca1c
+         + b['cegfr'] * cegfr + b['cegfr2'] * cegfr ** 2 + b['ca1c_cage'] * ca1c * cage
+         + b['cegfr_cage'] * cegfr * cage)
+    return _baseline_calibrate(1 - b['baseline_survival'] ** math.exp(x), _BASELINE_SCALES[sex][region])
+
+
+def _baseline_score2_op(age, sbp, tchol, hdl, smoker, diabetes, sex, region):
+    b = _BASELINE_OP_BETA[sex]
+    cage, csbp = float(age) - 73, float(sbp) - 150
+    ctchol, chdl = _baseline_mmol(tchol) - 6, _baseline_mmol(hdl) - 1.4
+    smoke, diab = (1 if smoker else 0), (1 if diabetes else 0)
+    x = (b['cage'] * cage + b['diab'] * diab + b['smoke'] * smoke + b['csbp'] * csbp
+         + b['ctchol'] * ctchol + b['chdl'] * chdl + b['diab_cage'] * diab * cage
+         + b['smoke_cage'] * smoke * cage + b['csbp_cage'] * csbp * cage
+         + b['ctchol_cage'] * ctchol * cage + b['chdl_cage'] * chdl * cage)
+    return _baseline_calibrate(1 - b['baseline_survival'] ** math.exp(x - b['mean_lp']),
+                               _BASELINE_OP_SCALES[sex][region])
+
+
+class BatchEngineEquivalenceTests(SimpleTestCase):
+    """The vectorized engine and the scalar calculators must reproduce the original formulas"""
+
+    N = 2000
+
+    def assertScoresMatch(self, batch, reference):
+        # Both round to 2 decimals; allow one unit in the last place for
+        # values that land exactly on a rounding boundary.
+        np.testing.assert_allclose(batch, reference, rtol=0, atol=0.0100001)
+
+    def test_score2(self):
+        c = _cohort(self.N, (40, 69), seed=1)
+        batch = engine.score2_batch(c['age'], c['sbp'], c['tchol'], c['hdl'],
+                                    c['smoker'], c['sex'], c['region'])
+        args = [(c['age'][i], c['sbp'][i], c['tchol'][i], c['hdl'][i], bool(c['smoker'][i]),
+                 c['sex'][i], c['region'][i]) for i in range(self.N)]
+        reference = [_baseline_score2(*a) for a in args]
+        self.assertScoresMatch(batch, reference)
+        self.assertScoresMatch([Score2Result.calculate_score2(*a) for a in args], reference)
+
+    def test_score2_diabetes(self):
+        c = _cohort(self.N, (40, 69), seed=2)
+        a1c = c['a1c'].astype(object)
+        egfr = c['egfr'].astype(object)
+        a1c[::7] = None
+        egfr[::11] = None
+        batch = engine.score2_diabetes_batch(
+            c['age'], c['sbp'], c['tchol'], c['hdl'], c['smoker'], c['diabetes'],
+            c['age_at_diagnosis'], a1c, egfr, c['sex'], c['region'],
+        )
+        args = [(c['age'][i], c['sbp'][i], c['tchol'][i], c['hdl'][i], bool(c['smoker'][i]),
+                 bool(c['diabetes'][i]), c['age_at_diagnosis'][i], a1c[i], egfr[i], c['sex'][i], c['region'][i])
+                for i in range(self.N)]
+        reference = [_baseline_score2_diabetes(*a) for a in args]
+        self.assertScoresMatch(batch, reference)
+        self.assertScoresMatch([Score2Result.calculate_score2_diabetes(*a) for a in args], reference)
+
+    def test_score2_op(self):
+        c = _cohort(self.N, (70, 89), seed=3)
+        batch = engine.score2_op_batch(c['age'], c['sbp'], c['tchol'], c['hdl'], c['smoker'],
+                                       c['diabetes'], c['sex'], c['region'])
+        args = [(c['age'][i], c['sbp'][i], c['tchol'][i], c['hdl'][i], bool(c['smoker'][i]),
+                 bool(c['diabetes'][i]), c['sex'][i], c['region'][i]) for i in range(self.N)]
+        reference = [_baseline_score2_op(*a) for a in args]
+        self.assertScoresMatch(batch, reference)
+        self.assertScoresMatch([Score2Result.calculate_score2_op(*a) for a in args], reference)
+
+    def test_out_of_range_rows_are_nan(self):
+        op = engine.score2_op_batch([69, 90, 75], 150, 6, 1.4, False, False, 'M', 'moderate')
+        self.assertTrue(np.isnan(op[0]) and np.isnan(op[1]))
+        self.assertFalse(np.isnan(op[2]))
+
+        diabetes = engine.score2_diabetes_batch([39, 55, 55], 140, 5, 1.2, False, True,
+                                                [50, None, 50], sex='F')
+        self.assertTrue(np.isnan(diabetes[:2]).all())
+        self.assertFalse(np.isnan(diabetes[2]))
+
+    def test_risk_levels(self):
+        rng = np.random.default_rng(4)
+        age = rng.integers(35, 95, self.N).astype(float)
+        score = rng.uniform(0, 30, self.N).round(2)
+        score_type = rng.choice(['SCORE2', 'SCORE2-Diabetes', 'SCORE2-OP'], self.N)
+        batch = engine.risk_level_batch(age, score, score_type)
+        reference = [Score2Result.get_risk_level(age[i], score[i], score_type[i]) for i in range(self.N)]
+        self.assertEqual(list(batch), reference)
+
+    def test_calculate_batch_dispatch(self):
+        result = engine.calculate_batch(
+            age=[50, 55, 75, 80, 30, 95, 60],
+            sbp=[140, 140, 150, 160, 130, 140, None],
+            tchol=[5.5, 5.0, 6.0, 6.0, 5.0, 6.0, 5.0],
+            hdl=[1.2, 1.1, 1.3, 1.0, 1.0, 1.0, 1.0],
+            smoker=[True, False, False, True, False, False, False],
+            sex=['M', 'F', 'F', 'M', 'F', 'M', 'M'],
+            diabetes=[False, True, False, True, False, False, False],
+            age_at_diagnosis=[None, 48, None, 60, None, None, None],
+        )
+        self.assertEqual(list(result.score_type),
+                         ['SCORE2', 'SCORE2-Diabetes', 'SCORE2-OP', 'SCORE2-OP', '', '', ''])
+        self.assertEqual(result.score_value[0],
+                         Score2Result.calculate_score2(50, 140, 5.5, 1.2, True, 'M', 'high'))
+        self.assertEqual(result.score_value[2],
+                         Score2Result.calculate_score2_op(75, 150, 6.0, 1.3, False, False, 'F', 'moderate'))
+        self.assertEqual(list(result.risk_level[4:]),
+                         ['age_out_of_range', 'age_out_of_range', 'not_applicable'])
+
+
+class ReferenceValueTests(SimpleTestCase):
+    """Known outputs of the scalar calculators, pinned to catch coefficient drift"""
+
+    def test_score2(self):
+        self.assertEqual(Score2Result.calculate_score2(55, 140, 5.5, 1.3, True, 'M', 'high'), 10.49)
+        self.assertEqual(Score2Result.calculate_score2(62, 125, 6.2, 1.6, False, 'F', 'moderate'), 4.3)
+        self.assertEqual(Score2Result.calculate_score2(45, 150, 220, 45, True, 'F', 'very_high'), 13.82)
+
+    def test_score2_diabetes(self):
+        self.assertEqual(Score2Result.calculate_score2_diabetes(
+            58, 145, 5.0, 1.1, False, True, 50, 7.2, 70, 'M', 'high'), 15.44)
+        self.assertEqual(Score2Result.calculate_score2_diabetes(
+            66, 135, 4.8, 1.4, True, True, 45.5, 8.1, 55, 'F', 'low'), 18.15)
+
+    def test_score2_op(self):
+        self.assertEqual(Score2Result.calculate_score2_op(75, 155, 5.8, 1.2, False, True, 'M', 'moderate'), 32.06)
+        self.assertEqual(Score2Result.calculate_score2_op(84, 170, 6.5, 1.5, True, False, 'F', 'high'), 54.48)
+
+
+class ReferenceRefreshTests(TransactionTestCase):
+    """Overlapping reference refreshes must not trip over each other's rows"""
+
+    def setUp(self):
+        patient = Patient.objects.create(pesel='55010112345', date_of_birth=date(1955, 1, 1), gender='M')
+        Visit.objects.create(patient=patient, visit_date=date(2025, 1, 10), cholesterol_total=Decimal('5.5'))
+
+    def test_concurrent_refreshes_are_serialized(self):
+        errors = []
+
+        def refresh():
+            try:
+                reference.refresh_reference_statistics()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        with transaction.atomic():
+            reference.refresh_reference_statistics()
+            other = threading.Thread(target=refresh)
+            other.start()
+            time.sleep(0.3)
+        other.join()
+        self.assertEqual(errors, [])
+        # one (field, band, sex) row plus the both-sexes row
+        self.assertEqual(ReferenceStatistic.objects.count(), 2)
+
+    def test_timestamps_move_only_when_a_median_changes(self):
+        stamps = lambda: dict(ReferenceStatistic.objects.values_list('sex', 'computed_at'))
+        reference.refresh_reference_statistics()
+        before = stamps()
+        reference.refresh_reference_statistics()
+        self.assertEqual(stamps(), before)
+
+        Visit.objects.create(patient=Patient.objects.get(), visit_date=date(2025, 2, 10),
+                             cholesterol_total=Decimal('6.5'))
+        reference.refresh_reference_statistics()
+        self.assertTrue(all(at > before[sex] for sex, at in stamps().items()))
+
+        # The women's row disappears: the men's row is marked as changed too
+        Patient.objects.create(pesel='55010112346', date_of_birth=date(1955, 1, 1), gender='F')
+        woman = Patient.objects.get(gender='F')
+        visit = Visit.objects.create(patient=woman, visit_date=date(2025, 1, 10), cholesterol_total=Decimal('5.0'))
+        reference.refresh_reference_statistics()
+        before = stamps()
+        visit.delete()
+        reference.refresh_reference_statistics()
+        self.assertEqual(set(stamps()), {'M', ''})
+        self.assertGreater(stamps()['M'], before['M'])
+
+
+class ReferenceRefreshQueueTests(TestCase):
+    """Visit edits queue the reference refresh for the worker instead of running it"""
+
+    def test_visit_edits_share_one_queued_refresh(self):
+        patient = Patient.objects.create(pesel='55010112345', date_of_birth=date(1955, 1, 1), gender='M')
+        visit = Visit.objects.create(patient=patient, visit_date=date(2025, 1, 10))
+        url = reverse('patients:patient_detail', args=[patient.pk])
+        for value in ('5.5', '5.8'):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post(url, {'update_visit': '1', 'visit_id': visit.pk, 'cholesterol_total': value})
+        self.assertFalse(ReferenceStatistic.objects.exists())
+        job = BackgroundJob.objects.get(kind=reference.REFRESH_JOB_KIND)
+
+        run_job(BackgroundJob.claim_next())
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.result), ('succeeded', {'rows': 2}))
+        self.assertEqual(ReferenceStatistic.objects.count(), 2)
+
+
+class PipelineScoringTests(SimpleTestCase):
+    """Chunked scoring must store the same results as the single-visit path"""
+
+    def _prepared(self, calculator):
+        rng = np.random.default_rng(5)
+        prepared = []
+        for i in range(60):
+            birth_year = int(rng.integers(1937, 1985))
+            patient = Patient(pk=i + 1, pesel=f'{i:011d}', date_of_birth=date(birth_year, 1, 1),
+                              gender='MF'[i % 2], smoking_status='assumed_non_smoker')
+            visit = Visit(patient=patient, visit_date=date(2025, 6, 1),
+                          systolic_pressure=int(rng.integers(100, 190)),
+                          cholesterol_total=Decimal(f'{rng.uniform(3, 8):.2f}'),
+                          cholesterol_hdl=Decimal(f'{rng.uniform(0.8, 2.2):.2f}'),
+                          hba1c=Decimal(f'{rng.uniform(5, 10):.1f}'),
+                          egfr=Decimal(f'{rng.uniform(30, 110):.1f}'))
+            diabetic = i % 3 == 0
+            snapshot = PatientClinicalSnapshot(
+                patient, [visit],
+                {'E11.9', 'F17.2'} if diabetic else ({'F17.2'} if i % 4 == 0 else set()),
+                [ChronicDiagnosis('E11.9', date(2015, 1, 1), Decimal('39.50'))] if diabetic else [],
+            )
+            prepared.append(calculator._prepare_result_data(patient, visit, snapshot))
+        return prepared
+
+    def test_batch_matches_scalar(self):
+        calculator = CalculateScore2View()
+        scalar = self._prepared(calculator)
+        batch = self._prepared(calculator)
+
+        for result_data, calculation in scalar:
+            if calculation is not None:
+                calculator._run_calculation(result_data, calculation)
+
+        groups = {}
+        for result_data, calculation in batch:
+            if calculation is not None:
+                groups.setdefault(calculation.score_type, []).append((result_data, calculation))
+        self.assertEqual(set(groups), {'SCORE2', 'SCORE2-Diabetes', 'SCORE2-OP'})
+        for score_type, items in groups.items():
+            pipeline._score_group(calculator, score_type, items)
+
+        for (expected, _), (actual, _) in zip(scalar, batch):
+            self.assertEqual(expected.keys(), actual.keys())
+            for key in expected:
+                if key == 'score_value' and expected[key] is not None:
+                    self.assertAlmostEqual(actual[key], expected[key], delta=0.0100001)
+                elif key not in ('patient', 'visit', 'risk_level'):
+                    self.assertEqual(actual[key], expected[key], key)
+
+    def test_rejected_rows_get_scalar_error(self):
+        calculator = CalculateScore2View()
+        patient = Patient(pk=1, pesel='00000000001', date_of_birth=date(1930, 1, 1), gender='M')
+        result_data = {'patient': patient, 'age_at_calculation': 95}
+        calculation = calculator._prepare_score2_op({
+            **result_data, 'systolic_pressure': 140, 'cholesterol_total': 5.0,
+            'cholesterol_hdl': 1.2, 'smoking_status': 'non_smoker', 'has_diabetes': False,
+        })
+        pipeline._score_group(calculator, 'SCORE2-OP', [(result_data, calculation)])
+        self.assertFalse(result_data['is_calculation_successful'])
+        self.assertIn('70', result_data['calculation_notes'])
+
+    def test_fingerprint_tracks_inputs(self):
+        calculator = CalculateScore2View()
+        first = [result_data['input_fingerprint'] for result_data, _ in self._prepared(calculator)]
+        again = [result_data['input_fingerprint'] for result_data, _ in self._prepared(calculator)]
+        self.assertEqual(first, again)
+        self.assertEqual(len(set(first)), len(first))
+
+        patient = Patient(pk=1, pesel='00000000001', date_of_birth=date(1970, 1, 1), gender='M')
+        visit = Visit(pk=1, patient=patient, visit_date=date(2025, 6, 1), systolic_pressure=140,
+                      cholesterol_total=Decimal('5.00'), cholesterol_hdl=Decimal('1.20'))
+        snapshot = PatientClinicalSnapshot(patient, [visit], set(), [])
+        before = calculator._prepare_result_data(patient, visit, snapshot)[0]['input_fingerprint']
+        visit.systolic_pressure = 150
+        after = calculator._prepare_result_data(patient, visit, snapshot)[0]['input_fingerprint']
+        self.assertNotEqual(before, after)
+
+
+class RecomputeResumeTests(TestCase):
+
+    def _run(self, status, idle=None, **fields):
+        run = RecomputeRun.objects.create(status=status, chunk_size=100, **fields)
+        if idle is not None:
+            RecomputeRun.objects.filter(pk=run.pk).update(updated_at=timezone.now() - idle)
+        return run
+
+    def test_only_the_latest_group_is_resumed(self):
+        self._run('failed')
+        self._run('completed')
+        self.assertEqual(RecomputeRun.unfinished_group(), [])
+
+    def test_live_runs_are_not_resumed(self):
+        failed = self._run('failed')
+        stale = self._run('running', idle=RecomputeRun.STALE_AFTER * 2, group=failed.group)
+        self._run('running', group=failed.group)
+        self.assertEqual([run.pk for run in RecomputeRun.unfinished_group()], [failed.pk, stale.pk])
+
+    def _job(self, attempts=1, **params):
+        return BackgroundJob.objects.create(kind='score2_calculate_all', attempts=attempts,
+                                            params={'chunk_size': 100, 'force': False, **params})
+
+    def test_new_job_supersedes_a_stale_group_and_covers_everyone(self):
+        today = date.today()
+        patients = [
+            Patient.objects.create(pesel=f'{i:011d}', gender='M', date_of_birth=date(today.year - 50 - i, 1, 1))
+            for i in range(3)
+        ]
+        for patient in patients:
+            Visit.objects.create(patient=patient, visit_date=date(2025, 6, 1), systolic_pressure=140,
+                                 cholesterol_total=Decimal('5.50'), cholesterol_hdl=Decimal('1.30'))
+        # Crashed last week after the second patient
+        old = self._run('failed', as_of=date(2020, 1, 1), checkpoint_patient_id=patients[1].pk, patients_done=2)
+
+        job = self._job()
+        results = tasks.calculate_all(job)
+        self.assertEqual(results['total_processed'], 3)
+        old.refresh_from_db()
+        self.assertEqual(old.status, 'superseded')
+        run = RecomputeRun.objects.get(status='completed')
+        self.assertEqual((job.params['group'], run.as_of), (str(run.group), today))
+        self.assertEqual(Score2Result.objects.count(), 3)
+
+    def test_retried_job_resumes_its_own_group(self):
+        interrupted = self._run('running', idle=RecomputeRun.STALE_AFTER * 2)
+        tasks.calculate_all(self._job(attempts=2, group=str(interrupted.group)))
+        interrupted.refresh_from_db()
+        self.assertEqual(interrupted.status, 'completed')
+        self.assertEqual(RecomputeRun.objects.count(), 1)
+
+        # Another job's group is left to its owner
+        other = self._run('failed')
+        tasks.calculate_all(self._job(attempts=2, group=str(interrupted.group)))
+        other.refresh_from_db()
+        self.assertEqual(other.status, 'superseded')
+        self.assertEqual(RecomputeRun.objects.filter(status='completed').count(), 2)
+
+    def test_running_job_with_the_same_params_is_reused(self):
+        job = self._job(chunk_size=pipeline.DEFAULT_CHUNK_SIZE, group='4c1d2a3e-0000-0000-0000-000000000000')
+        BackgroundJob.objects.filter(pk=job.pk).update(status='running')
+        response = self.client.post(reverse('score2:calculate_all'))
+        self.assertEqual(response.json()['job_id'], job.pk)
+        response = self.client.post(reverse('score2:calculate_all'), {'force': '1'})
+        self.assertNotEqual(response.json()['job_id'], job.pk)
+
+
+class RecomputeChunkTests(TestCase):
+    """Chunked recompute against the database: upsert, counters, unchanged visits, list columns"""
+
+    def setUp(self):
+        today = date.today()
+        self.patients = []
+        for i, (age, values) in enumerate([
+            (55, {'systolic_pressure': 150, 'cholesterol_total': Decimal('6.10'), 'cholesterol_hdl': Decimal('1.10')}),
+            (76, {'systolic_pressure': 135, 'cholesterol_total': Decimal('5.40'), 'cholesterol_hdl': Decimal('1.40')}),
+            (48, {'systolic_pressure': 128}),
+            (35, {'systolic_pressure': 120, 'cholesterol_total': Decimal('5.00'), 'cholesterol_hdl': Decimal('1.20')}),
+        ]):
+            patient = Patient.objects.create(pesel=f'{i:011d}', gender='MF'[i % 2],
+                                             date_of_birth=date(today.year - age - 1, 1, 1))
+            Visit.objects.create(patient=patient, visit_date=date(2024, 1, 1), systolic_pressure=110)
+            Visit.objects.create(patient=patient, visit_date=date(2025, 6, 1), **values)
+            self.patients.append(patient)
+
+    def test_chunk_upserts_results_and_skips_unchanged_visits(self):
+        counters = pipeline.recompute_all(chunk_size=2)
+        self.assertEqual(counters, {**pipeline.new_counters(), 'total_processed': 3,
+                                    'successful_calculations': 2, 'failed_calculations': 1})
+        # One result per eligible patient, for the latest visit
+        results = {r.patient_id: r for r in Score2Result.objects.select_related('visit')}
+        self.assertEqual(set(results), {p.pk for p in self.patients[:3]})
+        self.assertTrue(all(r.visit.visit_date == date(2025, 6, 1) for r in results.values()))
+        self.assertEqual(results[self.patients[1].pk].score_type, 'SCORE2-OP')
+        self.assertTrue(results[self.patients[2].pk].missing_data_reason)
+
+        first = self.patients[0]
+        first.refresh_from_db()
+        self.assertEqual((first.score2_count, first.current_score_value, first.current_score_visit_date),
+                         (1, results[first.pk].score_value, date(2025, 6, 1)))
+
+        counters = pipeline.recompute_all(chunk_size=2)
+        self.assertEqual(counters, {**pipeline.new_counters(), 'skipped_unchanged': 3})
+
+        visit = Visit.objects.get(patient=first, visit_date=date(2025, 6, 1))
+        visit.systolic_pressure = 180
+        visit.save()
+        counters = pipeline.recompute_all(chunk_size=2)
+        self.assertEqual(counters, {**pipeline.new_counters(), 'total_processed': 1,
+                                    'successful_calculations': 1, 'skipped_unchanged': 2})
+        updated = Score2Result.objects.get(patient=first)
+        self.assertEqual(updated.pk, results[first.pk].pk)
+        self.assertGreater(updated.score_value, results[first.pk].score_value)
+        first.refresh_from_db()
+        self.assertEqual(first.current_score_value, updated.score_value)
+
+        # Same value as the single-visit path
+        expected = CalculateScore2View()._calculate_score_for_visit(first, updated.visit)
+        self.assertAlmostEqual(float(expected.score_value), float(updated.score_value), delta=0.0100001)
+
+    def test_only_changed_patients_are_loaded(self):
+        first, second, third = self.patients[:3]
+        # Third patient: HDL missing, so it is looked up in the (still empty) medians
+        Visit.objects.filter(patient=third, visit_date=date(2025, 6, 1)).update(cholesterol_total=Decimal('5.00'))
+        pipeline.recompute_all()
+        changed = lambda: {p.pk for p in pipeline.changed_patients(pipeline.eligible_patients())}
+        self.assertEqual(changed(), set())
+
+        first.visits.latest('visit_date').save()
+        self.assertEqual(changed(), {first.pk})
+        Score2Result.objects.filter(patient=second).update(engine_version='old')
+        self.assertEqual(changed(), {first.pk, second.pk})
+        # New medians matter only to the result that looked one up
+        ReferenceStatistic.objects.create(field='cholesterol_hdl', age_band=40, median=1.3, sample_size=10,
+                                          computed_at=timezone.now())
+        reference.invalidate_cache()
+        self.assertEqual(changed(), {first.pk, second.pk, third.pk})
+
+        # Same inputs are not rescored but count as checked; the imputed HDL is new
+        counters = pipeline.recompute_all()
+        self.assertEqual(counters, {**pipeline.new_counters(), 'total_processed': 1,
+                                    'successful_calculations': 1, 'skipped_unchanged': 2})
+        self.assertEqual(changed(), set())
+        result = Score2Result.objects.get(patient=third)
+        # The plain SCORE2 path stores imputed cholesterol as data_source='visit'
+        self.assertEqual((result.data_source, result.uses_reference_medians), ('visit', True))
+
+        ReferenceStatistic.objects.update(median=1.1, computed_at=timezone.now())
+        reference.invalidate_cache()
+        self.assertEqual(changed(), {third.pk})
+        pipeline.recompute_all()
+        self.assertEqual(changed(), set())
+
+        # Turned 40 after the score was computed
+        Patient.objects.filter(pk=first.pk).update(
+            score_computed_at=timezone.make_aware(datetime(first.date_of_birth.year + 39, 6, 1)))
+        self.assertEqual(changed(), {first.pk})
+        pipeline.recompute_all()
+        self.assertEqual(changed(), set())
+
+
+class _InlineExecutor:
+    """Runs shards in the test process, where the test database is configured"""
+
+    def __init__(self, **kwargs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def submit(self, fn, *args):
+        future = Future()
+        future.set_result(fn(*args))
+        return future
+
+
+class ParallelRecomputeTests(TransactionTestCase):
+
+    def setUp(self):
+        today = date.today()
+        self.patients = []
+        for i in range(4):
+            patient = Patient.objects.create(pesel=f'{i:011d}', gender='MF'[i % 2],
+                                             date_of_birth=date(today.year - 50 - i, 1, 1))
+            Visit.objects.create(patient=patient, visit_date=date(2025, 6, 1), systolic_pressure=140,
+                                 cholesterol_total=Decimal('5.50'), cholesterol_hdl=Decimal('1.30'))
+            self.patients.append(patient)
+
+    def _change_outer_patients(self):
+        for patient in (self.patients[0], self.patients[-1]):
+            visit = patient.visits.get()
+            visit.systolic_pressure += 10
+            visit.save()
+
+    def test_shards_cover_patients_between_changed_ones(self):
+        pipeline.recompute_all()
+        # Only the first and last patient changed: the shards are cut between them
+        self._change_outer_patients()
+        with mock.patch.object(pipeline, 'ProcessPoolExecutor', _InlineExecutor):
+            parallel = pipeline.recompute_parallel(workers=2)
+        shards = RecomputeRun.objects.order_by('pk').values_list('first_patient_id', 'last_patient_id')[1:]
+        self.assertEqual(list(shards), [(None, self.patients[0].pk), (self.patients[0].pk + 1, None)])
+        self.assertEqual(parallel, {**pipeline.new_counters(), 'total_processed': 2,
+                                    'successful_calculations': 2, 'skipped_unchanged': 2})
+
+        self._change_outer_patients()
+        self.assertEqual(pipeline.recompute_all(), parallel)
+
+
+class DashboardStatisticsTests(SimpleTestCase):
+
+    def test_context_from_grouped_rows(self):
+        data = {
+            'patients': {'total_patients': 10, 'eligible_patients': 8, 'patients_with_visits': 7,
+                         'patients_with_scores': 5},
+            'groups': [
+                ['SCORE2', 'low_to_moderate', True, 3, 9.0],
+                ['SCORE2', 'high', True, 1, 6.0],
+                ['SCORE2-OP', 'very_high', True, 1, 20.0],
+                ['', 'not_applicable', False, 2, None],
+                ['SCORE2', 'not_applicable', False, 1, None],
+            ],
+        }
+        context = stats.dashboard_context(data)
+        self.assertEqual(context['eligible_patients'], 8)
+        self.assertEqual(context['failed_calculations'], 3)
+        self.assertEqual(list(context['score_type_stats']), ['SCORE2', 'SCORE2-OP'])
+        self.assertEqual(context['score_type_stats']['SCORE2'], {'count': 4, 'avg_score': 3.75})
+        self.assertEqual(list(context['risk_stats']), ['low_to_moderate', 'high', 'very_high'])
+        self.assertEqual(context['risk_stats']['low_to_moderate']['percentage'], 60.0)
+
+
+class CohortAnalyticsTests(SimpleTestCase):
+
+    def setUp(self):
+        self.frame = analytics.build_frame([
+            (1, 'M', 45, False, 'smoker', 'visit', 'SCORE2', 'low_to_moderate', True, Decimal('4.10')),
+            (2, 'F', 48, True, 'non_smoker', 'median', 'SCORE2-Diabetes', 'high', True, Decimal('8.00')),
+            (3, 'F', 52, False, 'non_smoker', 'visit', 'SCORE2', 'low_to_moderate', True, Decimal('2.50')),
+            (4, 'M', 74, False, 'smoker', 'visit', 'SCORE2-OP', 'very_high', True, Decimal('16.20')),
+            (5, 'M', 55, False, None, 'visit', '', 'not_applicable', False, None),
+        ])
+
+    def test_crosstab(self):
+        table = analytics.crosstab(self.frame, ['age_band'], ['sex'])
+        self.assertEqual(table['rows'], ['40-49', '50-59', '70-79'])
+        self.assertEqual(table['columns'], ['F', 'M'])
+        self.assertEqual(table['values'], [[1, 1], [1, 1], [0, 1]])
+        shares = analytics.crosstab(self.frame, ['sex', 'diabetes'], normalize='all')
+        self.assertEqual(shares['rows'][0], ['F', False])
+        self.assertEqual(sum(row[0] for row in shares['values']), 100.0)
+        with self.assertRaises(ValueError):
+            analytics.crosstab(self.frame, ['pesel'])
+
+    def test_filters_percentiles_and_histogram(self):
+        women = analytics.filter_frame(self.frame, {'sex': 'F', 'diabetes': '0'})
+        self.assertEqual(women['patient_id'].tolist(), [3])
+        table = analytics.percentiles(self.frame, q=[50])
+        self.assertEqual(table['values'], [[4, 6.05]])
+        hist = analytics.histogram(self.frame, ['sex'], width=5)
+        self.assertEqual(hist['edges'], [0.0, 5.0, 10.0, 15.0, 20.0])
+        self.assertEqual(hist['rows'], ['F', 'M'])
+        self.assertEqual(hist['values'], [[1, 1, 0, 0], [1, 0, 0, 1]])
+
+    def test_percentiles_of_an_empty_selection(self):
+        by_sex = analytics.percentiles(self.frame, ['sex'])
+        self.assertEqual(by_sex['values'][0][0], 2)
+        self.assertIsInstance(by_sex['values'][0][0], int)
+        nobody = analytics.filter_frame(self.frame, {'sex': 'X'})
+        self.assertEqual(analytics.percentiles(nobody, ['sex']),
+                         {'rows': [], 'columns': ['n', 'p25', 'p50', 'p75', 'p90'], 'values': []})
+        failed = analytics.filter_frame(self.frame, {'successful': '0'})
+        self.assertEqual(analytics.percentiles(failed)['values'], [])
+
+    def test_histogram_rejects_too_many_bins(self):
+        with self.assertRaises(ValueError):
+            analytics.histogram(self.frame, width=1e-9)
+        with self.assertRaises(ValueError):
+            analytics.histogram(self.frame, width=float('nan'))
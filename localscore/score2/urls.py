@@ -6,6 +6,7 @@ app_name = 'score2'
 urlpatterns = [
     # Statistics
     path('stats/', views.Score2StatsView.as_view(), name='stats'),
+    path('analytics/', views.Score2AnalyticsView.as_view(), name='analytics'),
     
     # Calculate SCORE2
     path('calculate/<int:patient_id>/', views.CalculateScore2View.as_view(), name='calculate_single'),
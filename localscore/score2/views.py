@@ -2,28 +2,60 @@ from django.shortcuts import render, get_object_or_404, redirect
 from django.contrib import messages
 from django.views import View
 from django.http import JsonResponse
-from django.db import transaction
-from django.db.models import Q, Count, Avg, Min, Max
+from django.urls import reverse
+from django.db.models import Q, Count, Min, Max
 from django.core.paginator import Paginator
 from datetime import date
-import numpy as np
-from typing import Optional, Tuple
-from dateutil.relativedelta import relativedelta
+from typing import Callable, NamedTuple, Optional, Tuple
+import hashlib
 import logging
 
 from patients.models import Patient, Visit
+from patients.snapshot import PatientClinicalSnapshot
+from jobs.models import BackgroundJob
+from .engine import ENGINE_VERSION
 from .models import Score2Result
+from . import analytics, pipeline
+from .reference import get_reference_median
+from .stats import dashboard_context, get_statistics
 
 # Configure logger
 logger = logging.getLogger('score2')
 
+SCALAR_CALCULATORS = {
+    'SCORE2': Score2Result.calculate_score2,
+    'SCORE2-Diabetes': Score2Result.calculate_score2_diabetes,
+    'SCORE2-OP': Score2Result.calculate_score2_op,
+}
+
+
+class PendingCalculation(NamedTuple):
+    """A score whose inputs are resolved and which only needs computing"""
+    score_type: str
+    inputs: dict  # keyword arguments of the calculator for score_type
+    notes: Callable[[], str]
+    data_source: str
+    error_data_source: str
+
+
+def input_fingerprint(result_data: dict, calculation: Optional[PendingCalculation]) -> str:
+    """Hash of everything a result is computed from, including the engine version"""
+    parts = [ENGINE_VERSION, result_data['patient'].pk, result_data['visit'].pk]
+    parts += sorted(
+        (key, str(value)) for key, value in result_data.items() if key not in ('patient', 'visit')
+    )
+    if calculation is not None:
+        parts += [calculation.score_type, sorted((key, str(value)) for key, value in calculation.inputs.items())]
+    return hashlib.sha256(repr(parts).encode()).hexdigest()
+
 
 class CalculateScore2View(View):
     """Calculate SCORE2 for a single patient's latest visit"""
     
     def post(self, request, patient_id):
         patient = get_object_or_404(Patient, pk=patient_id)
-        latest_visit = patient.get_latest_visit()
+        snapshot = PatientClinicalSnapshot.load(patient)
+        latest_visit = snapshot.latest_visit
         
         if not latest_visit:
             return JsonResponse({
@@ -32,7 +64,7 @@ class CalculateScore2View(View):
             })
         
         try:
-            result = self._calculate_score_for_visit(patient, latest_visit)
+            result = self._calculate_score_for_visit(patient, latest_visit, snapshot)
             return JsonResponse({
                 'success': True,
                 'result': {
@@ -52,23 +84,44 @@ class CalculateScore2View(View):
                 'error': str(e)
             })
 
-    def _calculate_score_for_visit(self, patient: Patient, visit: Visit) -> Score2Result:
+    def _calculate_score_for_visit(self, patient: Patient, visit: Visit,
+                                   snapshot: Optional[PatientClinicalSnapshot] = None) -> Score2Result:
         """Calculate appropriate SCORE2 for a patient's visit - ONE result per visit"""
+        if snapshot is None:
+            snapshot = PatientClinicalSnapshot.load(patient)
         
         # Remove existing result for this visit
         Score2Result.objects.filter(patient=patient, visit=visit).delete()
         
+        result_data, calculation = self._prepare_result_data(patient, visit, snapshot)
+        if calculation is not None:
+            self._run_calculation(result_data, calculation)
+        return Score2Result.objects.create(**result_data)
+    
+    def _prepare_result_data(self, patient: Patient, visit: Visit,
+                             snapshot: PatientClinicalSnapshot) -> Tuple[dict, Optional[PendingCalculation]]:
+        """Resolve inputs and pick the score type for a visit.
+        
+        Returns the result data and the calculation still to run, or None if
+        the result is already final (missing data or age exclusion).
+        """
+        result_data, calculation = self._resolve_inputs(patient, visit, snapshot)
+        result_data['input_fingerprint'] = input_fingerprint(result_data, calculation)
+        result_data['engine_version'] = ENGINE_VERSION
+        return result_data, calculation
+    
+    def _resolve_inputs(self, patient: Patient, visit: Visit,
+                        snapshot: PatientClinicalSnapshot) -> Tuple[dict, Optional[PendingCalculation]]:
         # Use visit age for both qualification AND calculation (like original script)
         age_at_visit = patient.calculate_age(visit.visit_date)
-        has_diabetes = patient.has_diabetes()
-        smoking_status, smoking_info = patient.get_smoking_status()
-        smoker = smoking_status == 'smoker'
+        has_diabetes = snapshot.has_diabetes
+        smoking_status, smoking_info = snapshot.get_smoking_status()
         
         # Get systolic pressure with fallback logic
-        sbp, sbp_info = self._get_systolic_pressure(patient, visit.visit_date)
+        sbp, sbp_info = self._get_systolic_pressure(snapshot, visit.visit_date)
         
         # Get cholesterol values with fallback logic
-        total_chol, hdl_chol, chol_info, chol_source = self._get_cholesterol_values(patient, visit.visit_date)
+        total_chol, hdl_chol, chol_info, chol_source = self._get_cholesterol_values(snapshot, visit.visit_date)
         
         # Base result object
         result_data = {
@@ -83,6 +136,8 @@ class CalculateScore2View(View):
             'has_diabetes': has_diabetes,
             'cholesterol_info': f"{chol_info}, ciśnienie: {sbp_info}",
             'region': 'high',
+            # A reference median was looked up (found or not); data_source does not always say so
+            'uses_reference_medians': chol_source == 'median',
         }
         
         # Check if we have systolic pressure (critical for all calculations)
@@ -97,22 +152,22 @@ class CalculateScore2View(View):
                 'calculation_notes': 'Nie można obliczyć bez ciśnienia skurczowego',
                 'data_source': 'visit'
             })
-            return Score2Result.objects.create(**result_data)
+            return result_data, None
         
         # Use visit age for qualification (same as original script)
         if has_diabetes and age_at_visit >= 40:
             if age_at_visit <= 69:
                 logger.info(f"QUALIFYING;{patient.pesel};{age_at_visit};SCORE2-Diabetes;;sbp from {sbp_info}")
-                return self._calculate_score2_diabetes(result_data)
+                return result_data, self._prepare_score2_diabetes(result_data, snapshot, chol_source)
             else:  # age 70+
                 logger.info(f"QUALIFYING;{patient.pesel};{age_at_visit};SCORE2-OP;diabetic;sbp from {sbp_info}")
-                return self._calculate_score2_op(result_data)
+                return result_data, self._prepare_score2_op(result_data)
         elif not has_diabetes and 40 <= age_at_visit <= 69:
             logger.info(f"QUALIFYING;{patient.pesel};{age_at_visit};SCORE2;;sbp from {sbp_info}")
-            return self._calculate_score2(result_data)
+            return result_data, self._prepare_score2(result_data)
         elif 70 <= age_at_visit <= 89:
             logger.info(f"QUALIFYING;{patient.pesel};{age_at_visit};SCORE2-OP;;sbp from {sbp_info}")
-            return self._calculate_score2_op(result_data)
+            return result_data, self._prepare_score2_op(result_data)
         else:
             # Age exclusion based on visit age
             if age_at_visit < 40:
@@ -134,19 +189,62 @@ class CalculateScore2View(View):
                 'calculation_notes': f'Pacjent wykluczony: {exclusion_reason}',
                 'data_source': 'visit'
             })
-            return Score2Result.objects.create(**result_data)
-    def _get_systolic_pressure(self, patient: Patient, visit_date: date) -> Tuple[Optional[int], str]:
+            return result_data, None
+    
+    def _run_calculation(self, result_data: dict, calculation: PendingCalculation):
+        """Run a pending calculation with the scalar calculator and store its outcome"""
+        try:
+            score_value = SCALAR_CALCULATORS[calculation.score_type](**calculation.inputs)
+            risk_level = Score2Result.get_risk_level(
+                result_data['age_at_calculation'], score_value, calculation.score_type
+            )
+            self._apply_score(result_data, calculation, score_value, risk_level)
+        except Exception as e:
+            self._apply_error(result_data, calculation, e)
+    
+    def _apply_score(self, result_data: dict, calculation: PendingCalculation, score_value: float, risk_level: str):
+        """Store a successful calculation"""
+        patient = result_data['patient']
+        age = result_data['age_at_calculation']
+        
+        logger.info(f"SUCCESS;{patient.pesel};{age};{calculation.score_type};{score_value}%;{risk_level}")
+        
+        result_data.update({
+            'score_type': calculation.score_type,
+            'score_value': score_value,
+            'risk_level': risk_level,
+            'is_calculation_successful': True,
+            'missing_data_reason': None,
+            'calculation_notes': calculation.notes(),
+            'data_source': calculation.data_source
+        })
+    
+    def _apply_error(self, result_data: dict, calculation: PendingCalculation, error: Exception):
+        """Store a failed calculation"""
+        patient = result_data['patient']
+        age = result_data['age_at_calculation']
+        
+        logger.error(f"ERROR;{patient.pesel};{age};{calculation.score_type};Calculation failed;{str(error)}")
+        
+        result_data.update({
+            'score_type': calculation.score_type,
+            'score_value': None,
+            'risk_level': 'not_applicable',
+            'is_calculation_successful': False,
+            'missing_data_reason': None,
+            'calculation_notes': f'Błąd obliczenia {calculation.score_type}: {str(error)}',
+            'data_source': calculation.error_data_source
+        })
+    
+    def _get_systolic_pressure(self, snapshot: PatientClinicalSnapshot, visit_date: date) -> Tuple[Optional[int], str]:
         """Get systolic pressure with fallback to previous visits"""
         # First try current visit
-        current_visit = patient.visits.filter(visit_date=visit_date).first()
+        current_visit = snapshot.visit_on(visit_date)
         if current_visit and current_visit.systolic_pressure:
             return current_visit.systolic_pressure, "aktualna wizyta"
         
         # Look for previous visits with systolic pressure
-        previous_visits = patient.visits.filter(
-            visit_date__lt=visit_date,
-            systolic_pressure__isnull=False
-        ).order_by('-visit_date')[:5]
+        previous_visits = snapshot.previous_visits(visit_date, 'systolic_pressure')
         
         for visit in previous_visits:
             if visit.systolic_pressure:
@@ -154,8 +252,8 @@ class CalculateScore2View(View):
         
         return None, "brak danych"
 
-    def _calculate_score2(self, result_data: dict) -> Score2Result:
-        """Calculate SCORE2 for non-diabetic patients aged 40-69"""
+    def _prepare_score2(self, result_data: dict) -> Optional[PendingCalculation]:
+        """Prepare SCORE2 for non-diabetic patients aged 40-69"""
         age = result_data['age_at_calculation']
         sbp = result_data['systolic_pressure']
         total_chol = result_data['cholesterol_total']
@@ -182,72 +280,49 @@ class CalculateScore2View(View):
                 'calculation_notes': f'SCORE2: Brakuje {", ".join(missing)}',
                 'data_source': 'visit'
             })
-            return Score2Result.objects.create(**result_data)
-        
-        try:
-            smoker = smoking_status == 'smoker'
-            score_value = Score2Result.calculate_score2(
-                age=age,
-                sbp=sbp,
-                tchol=total_chol,
-                hdl=hdl_chol,
-                smoker=smoker,
-                sex=patient.gender,
-                region=result_data['region']
-            )
-            
-            risk_level = Score2Result.get_risk_level(age, score_value, 'SCORE2')
-            
-            logger.info(f"SUCCESS;{patient.pesel};{age};SCORE2;{score_value}%;{risk_level}")
-            
-            result_data.update({
-                'score_type': 'SCORE2',
-                'score_value': score_value,
-                'risk_level': risk_level,
-                'is_calculation_successful': True,
-                'missing_data_reason': None,
-                'calculation_notes': f'SCORE2: sbp={sbp}, tchol={total_chol:.1f}, hdl={hdl_chol:.1f}',
-                'data_source': result_data.get('data_source', 'visit')
-            })
-            
-        except Exception as e:
-            logger.error(f"ERROR;{patient.pesel};{age};SCORE2;Calculation failed;{str(e)}")
-            result_data.update({
-                'score_type': 'SCORE2',
-                'score_value': None,
-                'risk_level': 'not_applicable',
-                'is_calculation_successful': False,
-                'missing_data_reason': None,
-                'calculation_notes': f'Błąd obliczenia SCORE2: {str(e)}',
-                'data_source': 'visit'
-            })
+            return None
         
-        return Score2Result.objects.create(**result_data)
+        return PendingCalculation(
+            score_type='SCORE2',
+            inputs={
+                'age': age,
+                'sbp': sbp,
+                'tchol': total_chol,
+                'hdl': hdl_chol,
+                'smoker': smoking_status == 'smoker',
+                'sex': patient.gender,
+                'region': result_data['region'],
+            },
+            notes=lambda: f'SCORE2: sbp={sbp}, tchol={total_chol:.1f}, hdl={hdl_chol:.1f}',
+            data_source=result_data.get('data_source', 'visit'),
+            error_data_source='visit',
+        )
     
-    def _calculate_score2_diabetes(self, result_data: dict) -> Score2Result:
-        """Calculate SCORE2-Diabetes for diabetic patients aged 40-69"""
+    def _prepare_score2_diabetes(self, result_data: dict, snapshot: PatientClinicalSnapshot,
+                                 chol_source: str) -> Optional[PendingCalculation]:
+        """Prepare SCORE2-Diabetes for diabetic patients aged 40-69"""
         age = result_data['age_at_calculation']
         sbp = result_data['systolic_pressure']
         patient = result_data['patient']
         visit = result_data['visit']
         
         # Get diabetes-specific data
-        age_at_diagnosis = patient.get_diabetes_age_at_diagnosis()
+        age_at_diagnosis = snapshot.get_diabetes_age_at_diagnosis()
         
-        # Get cholesterol values (allow max 1 missing)
-        total_chol, hdl_chol, chol_info, chol_source = self._get_cholesterol_values(patient, visit.visit_date)
+        # Cholesterol values were resolved by the caller (allow max 1 missing)
+        total_chol = result_data['cholesterol_total']
+        hdl_chol = result_data['cholesterol_hdl']
         missing_chol_count = (total_chol is None) + (hdl_chol is None)
         
         # Get lab values (allow max 1 missing) 
-        hba1c, egfr, lab_info, lab_source = self._get_diabetes_lab_values(patient, visit.visit_date)
+        hba1c, egfr, lab_info, lab_source = self._get_diabetes_lab_values(snapshot, visit.visit_date)
         missing_lab_count = (egfr is None) + (hba1c is None)
         
         result_data.update({
             'age_at_diabetes_diagnosis': age_at_diagnosis,
             'hba1c': hba1c,
             'egfr': egfr,
-            'cholesterol_total': total_chol,
-            'cholesterol_hdl': hdl_chol,
+            'uses_reference_medians': result_data['uses_reference_medians'] or lab_source == 'median',
         })
         
         # Check required data - same logic as original script
@@ -272,66 +347,40 @@ class CalculateScore2View(View):
                 'calculation_notes': f'SCORE2-Diabetes: Brakuje {", ".join(missing_items)}',
                 'data_source': 'mixed' if lab_source != 'visit' or chol_source != 'visit' else 'visit'
             })
-            return Score2Result.objects.create(**result_data)
-        
-        try:
-            smoking_status = result_data['smoking_status']
-            smoker = smoking_status == 'smoker'
-            
-            score_value = Score2Result.calculate_score2_diabetes(
-                age=age,
-                sbp=sbp,
-                tchol=total_chol,
-                hdl=hdl_chol,
-                smoker=smoker,
-                diabetes=True,
-                age_at_diagnosis=age_at_diagnosis,
-                a1c=hba1c,
-                egfr=egfr,
-                sex=patient.gender,
-                region=result_data['region']
-            )
-            
-            risk_level = Score2Result.get_risk_level(age, score_value, 'SCORE2-Diabetes')
-            
-            logger.info(f"SUCCESS;{patient.pesel};{age};SCORE2-Diabetes;{score_value}%;{risk_level}")
-            
-            # Determine data source
-            data_source = 'visit'
-            if lab_source != 'visit' or chol_source != 'visit':
-                data_source = 'mixed'
-            elif lab_source == 'median' or chol_source == 'median':
-                data_source = 'median'
-            
-            result_data.update({
-                'score_type': 'SCORE2-Diabetes',
-                'score_value': score_value,
-                'risk_level': risk_level,
-                'is_calculation_successful': True,
-                'missing_data_reason': None,
-                'calculation_notes': (
-                    f'SCORE2-Diabetes: sbp={sbp}, tchol={total_chol:.1f}, hdl={hdl_chol:.1f}, '
-                    f'egfr={egfr:.1f}, hba1c={hba1c:.1f}, wiek_dx={age_at_diagnosis}'
-                ),
-                'data_source': data_source
-            })
-            
-        except Exception as e:
-            logger.error(f"ERROR;{patient.pesel};{age};SCORE2-Diabetes;Calculation failed;{str(e)}")
-            result_data.update({
-                'score_type': 'SCORE2-Diabetes',
-                'score_value': None,
-                'risk_level': 'not_applicable',
-                'is_calculation_successful': False,
-                'missing_data_reason': None,
-                'calculation_notes': f'Błąd obliczenia SCORE2-Diabetes: {str(e)}',
-                'data_source': 'mixed' if lab_source != 'visit' or chol_source != 'visit' else 'visit'
-            })
+            return None
         
-        return Score2Result.objects.create(**result_data)
+        # Determine data source
+        data_source = 'visit'
+        if lab_source != 'visit' or chol_source != 'visit':
+            data_source = 'mixed'
+        elif lab_source == 'median' or chol_source == 'median':
+            data_source = 'median'
+        
+        return PendingCalculation(
+            score_type='SCORE2-Diabetes',
+            inputs={
+                'age': age,
+                'sbp': sbp,
+                'tchol': total_chol,
+                'hdl': hdl_chol,
+                'smoker': result_data['smoking_status'] == 'smoker',
+                'diabetes': True,
+                'age_at_diagnosis': age_at_diagnosis,
+                'a1c': hba1c,
+                'egfr': egfr,
+                'sex': patient.gender,
+                'region': result_data['region'],
+            },
+            notes=lambda: (
+                f'SCORE2-Diabetes: sbp={sbp}, tchol={total_chol:.1f}, hdl={hdl_chol:.1f}, '
+                f'egfr={egfr:.1f}, hba1c={hba1c:.1f}, wiek_dx={age_at_diagnosis}'
+            ),
+            data_source=data_source,
+            error_data_source='mixed' if lab_source != 'visit' or chol_source != 'visit' else 'visit',
+        )
     
-    def _calculate_score2_op(self, result_data: dict) -> Score2Result:
-        """Calculate SCORE2-OP for patients aged 70-89"""
+    def _prepare_score2_op(self, result_data: dict) -> Optional[PendingCalculation]:
+        """Prepare SCORE2-OP for patients aged 70-89"""
         age = result_data['age_at_calculation']
         sbp = result_data['systolic_pressure']
         total_chol = result_data['cholesterol_total']
@@ -359,56 +408,33 @@ class CalculateScore2View(View):
                 'calculation_notes': f'SCORE2-OP: Brakuje {", ".join(missing)}',
                 'data_source': 'visit'
             })
-            return Score2Result.objects.create(**result_data)
-        
-        try:
-            smoker = smoking_status == 'smoker'
-            score_value = Score2Result.calculate_score2_op(
-                age=age,
-                sbp=sbp,
-                tchol=total_chol,
-                hdl=hdl_chol,
-                smoker=smoker,
-                diabetes=has_diabetes,
-                sex=patient.gender,
-                region='moderate'  # SCORE2-OP uses moderate as default
-            )
-            
-            risk_level = Score2Result.get_risk_level(age, score_value, 'SCORE2-OP')
-            
-            logger.info(f"SUCCESS;{patient.pesel};{age};SCORE2-OP;{score_value}%;{risk_level}")
-            
-            result_data.update({
-                'score_type': 'SCORE2-OP',
-                'score_value': score_value,
-                'risk_level': risk_level,
-                'is_calculation_successful': True,
-                'missing_data_reason': None,
-                'calculation_notes': (
-                    f'SCORE2-OP: sbp={sbp}, tchol={total_chol:.1f}, hdl={hdl_chol:.1f}, '
-                    f'diabetes={has_diabetes}'
-                ),
-                'data_source': result_data.get('data_source', 'visit')
-            })
-            
-        except Exception as e:
-            logger.error(f"ERROR;{patient.pesel};{age};SCORE2-OP;Calculation failed;{str(e)}")
-            result_data.update({
-                'score_type': 'SCORE2-OP',
-                'score_value': None,
-                'risk_level': 'not_applicable',
-                'is_calculation_successful': False,
-                'missing_data_reason': None,
-                'calculation_notes': f'Błąd obliczenia SCORE2-OP: {str(e)}',
-                'data_source': 'visit'
-            })
+            return None
         
-        return Score2Result.objects.create(**result_data)
+        return PendingCalculation(
+            score_type='SCORE2-OP',
+            inputs={
+                'age': age,
+                'sbp': sbp,
+                'tchol': total_chol,
+                'hdl': hdl_chol,
+                'smoker': smoking_status == 'smoker',
+                'diabetes': has_diabetes,
+                'sex': patient.gender,
+                'region': 'moderate',  # SCORE2-OP uses moderate as default
+            },
+            notes=lambda: (
+                f'SCORE2-OP: sbp={sbp}, tchol={total_chol:.1f}, hdl={hdl_chol:.1f}, '
+                f'diabetes={has_diabetes}'
+            ),
+            data_source=result_data.get('data_source', 'visit'),
+            error_data_source='visit',
+        )
     
-    def _get_cholesterol_values(self, patient: Patient, visit_date: date) -> Tuple[Optional[float], Optional[float], str, str]:
+
+    def _get_cholesterol_values(self, snapshot: PatientClinicalSnapshot, visit_date: date) -> Tuple[Optional[float], Optional[float], str, str]:
         """Get cholesterol values with fallback to previous visits and median - returns data source"""
         # First try current visit
-        current_visit = patient.visits.filter(visit_date=visit_date).first()
+        current_visit = snapshot.visit_on(visit_date)
         if current_visit and current_visit.cholesterol_total and current_visit.cholesterol_hdl:
             return (
                 float(current_visit.cholesterol_total),
@@ -418,11 +444,7 @@ class CalculateScore2View(View):
             )
         
         # Look for previous visits
-        previous_visits = patient.visits.filter(
-            visit_date__lt=visit_date,
-            cholesterol_total__isnull=False,
-            cholesterol_hdl__isnull=False
-        ).order_by('-visit_date')[:5]
+        previous_visits = snapshot.previous_visits(visit_date, 'cholesterol_total', 'cholesterol_hdl')
         
         for visit in previous_visits:
             if visit.cholesterol_total and visit.cholesterol_hdl:
@@ -458,7 +480,7 @@ class CalculateScore2View(View):
         # Use median for missing values (only if max 1 missing)
         missing_count = (total_chol is None) + (hdl_chol is None)
         if missing_count <= 1:
-            age = patient.calculate_age(visit_date)
+            age = snapshot.patient.calculate_age(visit_date)
             age_group_start = (age // 10) * 10
             age_group_end = age_group_start + 9
             
@@ -477,10 +499,10 @@ class CalculateScore2View(View):
         
         return total_chol, hdl_chol, "niepełne dane", data_source
     
-    def _get_diabetes_lab_values(self, patient: Patient, visit_date: date) -> Tuple[Optional[float], Optional[float], str, str]:
+    def _get_diabetes_lab_values(self, snapshot: PatientClinicalSnapshot, visit_date: date) -> Tuple[Optional[float], Optional[float], str, str]:
         """Get eGFR and HbA1c values with fallback logic - returns data source"""
         # First try current visit
-        current_visit = patient.visits.filter(visit_date=visit_date).first()
+        current_visit = snapshot.visit_on(visit_date)
         if current_visit and current_visit.egfr and current_visit.hba1c:
             return (
                 float(current_visit.hba1c),
@@ -490,11 +512,7 @@ class CalculateScore2View(View):
             )
         
         # Look for previous visits
-        previous_visits = patient.visits.filter(
-            visit_date__lt=visit_date,
-            egfr__isnull=False,
-            hba1c__isnull=False
-        ).order_by('-visit_date')[:5]
+        previous_visits = snapshot.previous_visits(visit_date, 'egfr', 'hba1c')
         
         for visit in previous_visits:
             if visit.egfr and visit.hba1c:
@@ -530,7 +548,7 @@ class CalculateScore2View(View):
         # Use median for missing values (only if max 1 missing)
         missing_count = (egfr is None) + (hba1c is None)
         if missing_count <= 1:
-            age = patient.calculate_age(visit_date)
+            age = snapshot.patient.calculate_age(visit_date)
             age_group_start = (age // 10) * 10
             age_group_end = age_group_start + 9
             
@@ -550,10 +568,7 @@ class CalculateScore2View(View):
         return hba1c, egfr, "niepełne dane", data_source
     
     def _get_median_value(self, age_start: int, age_end: int, value_type: str) -> Optional[float]:
-        """Calculate median value for age group"""
-        from django.db.models import Q
-        from datetime import date, timedelta
-        
+        """Median value for age group, from the precomputed reference table"""
         # Map value types to model fields
         field_mapping = {
             'total': 'cholesterol_total',
@@ -566,34 +581,33 @@ class CalculateScore2View(View):
         if not field_name:
             return None
         
-        # Calculate date range for age group
-        today = date.today()
-        end_date = today - timedelta(days=age_start * 365.25)
-        start_date = today - timedelta(days=(age_end + 1) * 365.25)
-        
-        # Get values from visits
-        visits = Visit.objects.filter(
-            patient__date_of_birth__gte=start_date,
-            patient__date_of_birth__lt=end_date
-        ).exclude(**{f"{field_name}__isnull": True})
-        
-        values = list(visits.values_list(field_name, flat=True))
-        
-        if not values:
-            return None
-        
-        return float(np.median([float(v) for v in values]))
+        return get_reference_median(field_name, age_start)
 
 
 class CalculateAllScore2View(View):
     """Calculate SCORE2 for all patients"""
     
+    # Patients scored and written per round trip
+    chunk_size = pipeline.DEFAULT_CHUNK_SIZE
+    
     def post(self, request):
+        """Queue the recalculation for the background worker (reuses a job with the same
+        parameters that is already waiting or running; a started job also records its run group).
+        
+        Patients whose inputs have not changed are skipped unless `force=1` is posted.
+        """
         try:
-            results = self._calculate_scores_for_all()
+            params = {'chunk_size': self.chunk_size, 'force': request.POST.get('force') == '1'}
+            job = (
+                BackgroundJob.objects.filter(
+                    kind='score2_calculate_all', status__in=('queued', 'running'), params__contains=params
+                ).first()
+                or BackgroundJob.enqueue('score2_calculate_all', **params)
+            )
             return JsonResponse({
                 'success': True,
-                'results': results
+                'job_id': job.pk,
+                'status_url': reverse('jobs:status', args=[job.pk]),
             })
         except Exception as e:
             logger.error(f"ERROR;;;CalculateAllScore2View;{str(e)};")
@@ -601,131 +615,42 @@ class CalculateAllScore2View(View):
                 'success': False,
                 'error': str(e)
             })
-    
-    def _calculate_scores_for_all(self):
-        """Calculate scores for all eligible patients"""
-        # Get all patients with visits in score-eligible age range (40-89) - use CURRENT age
-        today = date.today()
-        min_date = today - relativedelta(years=90)
-        max_date = today - relativedelta(years=40)
-        
-        patients = Patient.objects.filter(
-            visits__isnull=False,
-            date_of_birth__gt=min_date,
-            date_of_birth__lte=max_date
-        ).distinct()
-        
-        total_processed = 0
-        successful_calculations = 0
-        failed_calculations = 0
-        excluded_patients = 0
-        
-        logger.info(f"BATCH_START;;;Starting batch calculation;{patients.count()} patients;")
-        
-        calculator = CalculateScore2View()
-        
-        with transaction.atomic():
-            for patient in patients:
-                latest_visit = patient.get_latest_visit()
-                if not latest_visit:
-                    logger.warning(f"NO_VISIT;{patient.pesel};;;No visits found;")
-                    continue
-                
-                try:
-                    result = calculator._calculate_score_for_visit(patient, latest_visit)
-                    total_processed += 1
-                    
-                    if result.is_calculation_successful:
-                        successful_calculations += 1
-                    else:
-                        if result.missing_data_reason:
-                            failed_calculations += 1
-                        else:
-                            excluded_patients += 1
-                            
-                except Exception as e:
-                    logger.error(f"ERROR;{patient.pesel};;;Processing error;{str(e)}")
-                    failed_calculations += 1
-                    continue
-        
-        logger.info(f"BATCH_END;;;Processed: {total_processed};Success: {successful_calculations} Failed: {failed_calculations} Excluded: {excluded_patients};")
-        
-        return {
-            'total_processed': total_processed,
-            'successful_calculations': successful_calculations,
-            'failed_calculations': failed_calculations,
-            'excluded_patients': excluded_patients,
-        }
 
 
 class Score2StatsView(View):
     """View for SCORE2 statistics and dashboard"""
     
     def get(self, request):
-        # Overall statistics - only for score-eligible patients
-        today = date.today()
-        min_date = today - relativedelta(years=90)
-        max_date = today - relativedelta(years=40)
-        
-        eligible_patients = Patient.objects.filter(
-            date_of_birth__gt=min_date,
-            date_of_birth__lte=max_date
-        )
-        
-        total_patients = Patient.objects.count()
-        eligible_count = eligible_patients.count()
-        patients_with_visits = eligible_patients.filter(visits__isnull=False).distinct().count()
-        patients_with_scores = eligible_patients.filter(
-            score2_results__is_calculation_successful=True
-        ).distinct().count()
-        
-        # Score type distribution
-        score_type_stats = {}
-        for score_type, _ in Score2Result.SCORE_TYPE_CHOICES:
-            count = Score2Result.objects.filter(
-                score_type=score_type,
-                is_calculation_successful=True
-            ).count()
-            if count > 0:
-                avg_score = Score2Result.objects.filter(
-                    score_type=score_type,
-                    is_calculation_successful=True
-                ).aggregate(Avg('score_value'))['score_value__avg']
-                
-                score_type_stats[score_type] = {
-                    'count': count,
-                    'avg_score': round(avg_score, 2) if avg_score else 0
-                }
-        
-        # Risk level distribution
-        risk_stats = {}
-        total_successful = Score2Result.objects.filter(is_calculation_successful=True).count()
-        
-        for risk_level, display_name in Score2Result.RISK_LEVEL_CHOICES:
-            count = Score2Result.objects.filter(
-                risk_level=risk_level,
-                is_calculation_successful=True
-            ).count()
-            if count > 0:
-                risk_stats[risk_level] = {
-                    'count': count,
-                    'display_name': display_name,
-                    'percentage': round((count / total_successful * 100), 1) if total_successful > 0 else 0
-                }
+        # Precomputed snapshot, refreshed after imports and recomputes (score2.stats)
+        context = dashboard_context(get_statistics())
         
-        # Failed calculations
-        failed_calculations = Score2Result.objects.filter(
-            is_calculation_successful=False
-        ).count()
-        
-        context = {
-            'total_patients': total_patients,
-            'eligible_patients': eligible_count,
-            'patients_with_visits': patients_with_visits,
-            'patients_with_scores': patients_with_scores,
-            'score_type_stats': score_type_stats,
-            'risk_stats': risk_stats,
-            'failed_calculations': failed_calculations,
-        }
+        return render(request, 'score2/stats.html', context)
+
+
+class Score2AnalyticsView(View):
+    """JSON cohort reports over the current results: ?report=crosstab|percentiles|histogram.
+
+    Dimensions (rows, columns, by and filters such as ?sex=F&diabetes=1) are
+    those of analytics.DIMENSIONS; the frame is cached per data version.
+    """
+    
+    def get(self, request):
+        params = request.GET
+        report = params.get('report', 'crosstab')
+        split = lambda name: [value for value in params.get(name, '').split(',') if value]
+        filters = {name: params[name] for name in analytics.DIMENSIONS if name in params}
+        try:
+            frame = analytics.filter_frame(analytics.get_frame(), filters)
+            if report == 'crosstab':
+                result = analytics.crosstab(frame, split('rows'), split('columns'), params.get('normalize'))
+            elif report == 'percentiles':
+                q = [float(value) for value in split('q')] or [25, 50, 75, 90]
+                result = analytics.percentiles(frame, split('by'), q)
+            elif report == 'histogram':
+                result = analytics.histogram(frame, split('by'), float(params.get('width', 1.0)))
+            else:
+                raise ValueError(f'Nieznany raport: {report}')
+        except ValueError as e:
+            return JsonResponse({'success': False, 'error': str(e)}, status=400)
         
-        return render(request, 'score2/stats.html', context)
\ No newline at end of file
+        return JsonResponse({'success': True, 'report': report, 'results': len(frame), **result})